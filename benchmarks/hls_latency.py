@@ -0,0 +1,176 @@
+"""Compare classic HLS polling with LL-HLS for latency and request volume.
+
+Runs simulated players against a live stream for a fixed time and prints a
+JSON report. Three client models are measured:
+
+- hls: polls playlist.m3u8 like hls.js, every target duration after a
+  change and every half target duration otherwise
+- llhls-poll: LL-HLS playlist polled every half part target, which is
+  what players do without blocking reload
+- llhls-blocking: LL-HLS with _HLS_msn/_HLS_part blocking reload
+
+Latency is how long after its media ended (EXT-X-PROGRAM-DATE-TIME plus
+duration) a segment or part first showed up in the client's playlist, plus
+the hold back a player keeps behind the live edge. Segments that were
+already complete in the first playlist a client fetches are not counted.
+The dash muxer stamps EXT-X-PROGRAM-DATE-TIME to the whole second, so the
+absolute LL-HLS numbers carry up to a second of offset; compare the modes
+against each other rather than reading them as exact latencies.
+
+    python -m benchmarks.hls_latency \\
+        --hls-url http://localhost/hls/<stream>/playlist.m3u8 \\
+        --llhls-url http://localhost/llhls/<stream>/media_0.m3u8 --duration 60
+"""
+import re
+import json
+import time
+import argparse
+import threading
+import statistics
+import urllib.request
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+
+def fetch(url: str) -> str:
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return response.read().decode()
+
+
+def parse_units(body: str, with_parts: bool) -> Tuple[Dict[str, float], float, int, int, Optional[float]]:
+    """Return ({unit id: media end time}, target, next msn, pending parts, part target)
+
+    Units are segments for classic HLS and parts for LL-HLS.
+    """
+    units = {}
+    target = float(re.search(r"#EXT-X-TARGETDURATION:(\d+)", body).group(1))
+    msn = int(re.search(r"#EXT-X-MEDIA-SEQUENCE:(\d+)", body).group(1))
+    part_target = re.search(r"PART-TARGET=([\d.]+)", body)
+
+    program_date_time = None
+    pending_parts: List[Tuple[float, str]] = []
+    for line in body.splitlines():
+        if line.startswith("#EXT-X-PART:") and with_parts:
+            duration = float(re.search(r"DURATION=([\d.]+)", line).group(1))
+            byterange = re.search(r'BYTERANGE="([^"]+)"', line).group(1)
+            pending_parts.append((duration, f"{msn}/{byterange}"))
+        elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+            program_date_time = datetime.fromisoformat(
+                line.split(":", 1)[1].replace("Z", "+00:00").replace("+0000", "+00:00")
+            ).timestamp()
+        elif line.startswith("#EXTINF:"):
+            duration = float(line[8:].split(",", 1)[0])
+            if program_date_time is not None:
+                if with_parts:
+                    part_offset = program_date_time
+                    for part_duration, part_id in pending_parts:
+                        part_offset += part_duration
+                        units[part_id] = part_offset
+                else:
+                    units[str(msn)] = program_date_time + duration
+                program_date_time += duration
+            pending_parts = []
+            msn += 1
+
+    # Parts of the segment still being written follow the last segment
+    if with_parts and program_date_time is not None:
+        part_offset = program_date_time
+        for part_duration, part_id in pending_parts:
+            part_offset += part_duration
+            units[part_id] = part_offset
+    part_target = float(part_target.group(1)) if part_target else None
+    return units, target, msn, len(pending_parts), part_target
+
+
+class Client(threading.Thread):
+    def __init__(self, mode: str, url: str, duration: float):
+        super().__init__(daemon=True)
+        self.mode = mode
+        self.url = url
+        self.duration = duration
+        self.playlist_requests = 0
+        self.unchanged_responses = 0
+        self.media_requests = 0
+        self.latencies: List[float] = []
+        self.hold_back = 0.0
+        self.errors = 0
+
+    def run(self):
+        seen = set()
+        baseline_msn = None
+        previous = None
+        deadline = time.time() + self.duration
+        url = self.url
+        while time.time() < deadline:
+            try:
+                body = fetch(url)
+            except Exception:
+                self.errors += 1
+                time.sleep(0.5)
+                continue
+            observed_at = time.time()
+            self.playlist_requests += 1
+            if body == previous:
+                self.unchanged_responses += 1
+            previous = body
+
+            with_parts = self.mode != "hls"
+            units, target, next_msn, pending_parts, part_target = parse_units(body, with_parts)
+            hold_back = re.search(r"PART-HOLD-BACK=([\d.]+)", body)
+            self.hold_back = float(hold_back.group(1)) if with_parts and hold_back else 3 * target
+
+            first = baseline_msn is None
+            if first:
+                # The first playlist only establishes the baseline
+                baseline_msn = next_msn
+            new = [unit for unit in units if unit not in seen]
+            for unit in new:
+                seen.add(unit)
+                if not first and int(unit.split("/", 1)[0]) >= baseline_msn:
+                    self.latencies.append(observed_at - units[unit])
+                    self.media_requests += 1
+
+            if self.mode == "llhls-blocking":
+                # Ask for the part after the last one we know about
+                url = f"{self.url}?_HLS_msn={next_msn}&_HLS_part={pending_parts}"
+            elif self.mode == "llhls-poll":
+                time.sleep((part_target or 0.5) / 2)
+            else:
+                time.sleep(target if new else target / 2)
+
+    def report(self) -> dict:
+        latencies = sorted(self.latencies)
+        minutes = self.duration / 60
+        return {
+            "playlist_requests_per_minute": round(self.playlist_requests / minutes, 1),
+            "unchanged_playlist_ratio": round(self.unchanged_responses / max(1, self.playlist_requests), 3),
+            "media_requests_per_minute": round(self.media_requests / minutes, 1),
+            "discovery_latency_p50": round(statistics.median(latencies), 3) if latencies else None,
+            "discovery_latency_p95": round(latencies[int(len(latencies) * 0.95) - 1], 3) if latencies else None,
+            "hold_back": self.hold_back,
+            "estimated_live_latency": round(statistics.median(latencies) + self.hold_back, 3) if latencies else None,
+            "errors": self.errors,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hls-url", required=True, help="Classic HLS media playlist")
+    parser.add_argument("--llhls-url", required=True, help="LL-HLS media playlist served by the edge")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to measure")
+    args = parser.parse_args()
+
+    clients = [
+        Client("hls", args.hls_url, args.duration),
+        Client("llhls-poll", args.llhls_url, args.duration),
+        Client("llhls-blocking", args.llhls_url, args.duration),
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    print(json.dumps({client.mode: client.report() for client in clients}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,579 @@
+"""Load-test a worker node and an API instance with synthetic streams.
+
+Needs nothing but ffmpeg, a local Redis and a local Postgres with the
+schema loaded. The run goes through these steps:
+
+1. A test clip is encoded once from ffmpeg's testsrc2 and sine sources,
+   at the agent's 720p/2500k profile.
+2. The worker (python -m src.workers.ffmpeg_worker) is started, and an
+   API (uvicorn) too unless --api-url points at one.
+3. Dashboards connect to /ws/stream-status.
+4. For each stream, a publisher replays the clip in real time into a
+   FIFO the worker reads as its input, which stands in for the RTMP
+   server. With --rtmp-url the clip is published to a real RTMP server
+   instead.
+5. One stream_requests job per stream is pushed in a single burst.
+6. Once the streams are up, HLS viewers play them and an API client
+   queries /streams for --duration seconds.
+
+The run reports:
+
+- time to first segment, from the burst to the segment on disk
+- segment write lag, as in hls_segment_write_lag_seconds
+- how long after landing a segment reached a viewer's playlist
+- ffmpeg CPU and memory per stream, and the worker's own CPU
+- API latency percentiles per endpoint
+- dashboard status latency
+- Redis commands per second
+
+Everything goes out as one JSON document, for comparison between
+releases. LL-HLS is out of scope here, see benchmarks/hls_latency.py.
+
+    python -m benchmarks.pipeline_load --streams 20 --viewers 100 \\
+        --dashboards 200 --duration 120 --output bench.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import statistics
+import urllib.parse
+import urllib.request
+from datetime import datetime, timezone
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+import websockets
+from redis import Redis
+
+from src.workers.metrics import read_proc_stat
+
+CLIP_SECONDS = 30
+POLL_INTERVAL = 0.1  # Seconds between checks of the streams' playlists
+VIEW_HEARTBEAT_INTERVAL = 10  # Seconds between a viewer's POST /streams/{id}/views
+STOP_TIMEOUT = 15
+BENCH_USER = "bench"
+BENCH_PASSWORD = "bench-password"
+
+
+def summarize(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def percentile(p: float) -> float:
+        return round(values[min(len(values) - 1, int(len(values) * p))], 4)
+
+    return {
+        "count": len(values),
+        "mean": round(statistics.fmean(values), 4),
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": round(values[-1], 4),
+    }
+
+
+def parse_playlist(body: str):
+    """Return (target duration, [(duration, uri)]) of a media playlist"""
+    target = re.search(r"#EXT-X-TARGETDURATION:(\d+)", body)
+    segments = []
+    duration = None
+    for line in body.splitlines():
+        line = line.strip()
+        if line.startswith("#EXTINF:"):
+            duration = float(line[8:].split(",", 1)[0])
+        elif line and not line.startswith("#") and duration is not None:
+            segments.append((duration, line))
+            duration = None
+    return float(target.group(1)) if target else 2.0, segments
+
+
+def children_of(pid: int) -> List[int]:
+    """Direct children of a process, from /proc"""
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        if int(stat[stat.rindex(")") + 2:].split()[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+class Latencies:
+    """Thread-safe samples and error counts by name"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, value: float):
+        with self.lock:
+            self.samples.setdefault(name, []).append(value)
+
+    def error(self, name: str):
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def timed(self, name: str, request: urllib.request.Request, timeout: float = 30) -> Optional[bytes]:
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                body = response.read()
+        except Exception:
+            self.error(name)
+            return None
+        self.add(name, time.perf_counter() - started)
+        return body
+
+    def report(self) -> dict:
+        with self.lock:
+            names = set(self.samples) | set(self.errors)
+            return {
+                name: {**summarize(self.samples.get(name, [])), "errors": self.errors.get(name, 0)}
+                for name in sorted(names)
+            }
+
+
+class StreamWatcher(threading.Thread):
+    """Times the segments the worker writes, from the local output directories"""
+
+    def __init__(self, playlists: Dict[str, str], enqueued_at: float):
+        super().__init__(daemon=True)
+        self.playlists = playlists  # Stream id -> playlist path
+        self.enqueued_at = enqueued_at
+        self.first_segment: Dict[str, float] = {}
+        self.write_lag: List[float] = []
+        self.last: Dict[str, tuple] = {}  # Stream id -> (uri, landed at)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for stream_id, playlist in self.playlists.items():
+                try:
+                    with open(playlist) as f:
+                        _, segments = parse_playlist(f.read())
+                except FileNotFoundError:
+                    continue
+                self._observe(stream_id, os.path.dirname(playlist), segments)
+            time.sleep(POLL_INTERVAL)
+
+    def _observe(self, stream_id: str, directory: str, segments: list):
+        uris = [uri for _, uri in segments]
+        last = self.last.get(stream_id)
+        start = uris.index(last[0]) + 1 if last and last[0] in uris else 0
+        for duration, uri in segments[start:]:
+            try:
+                landed_at = os.stat(os.path.join(directory, uri)).st_mtime
+            except FileNotFoundError:
+                continue
+            if stream_id not in self.first_segment:
+                self.first_segment[stream_id] = max(0.0, landed_at - self.enqueued_at)
+            elif last:
+                self.write_lag.append(max(0.0, landed_at - last[1] - duration))
+            last = (uri, landed_at)
+            self.last[stream_id] = last
+
+
+class Viewer(threading.Thread):
+    """Plays one stream like hls.js and sends player heartbeats to the API"""
+
+    def __init__(self, index: int, stream_id: str, playlist_url: str, local_dir: str, api_url: str,
+                 latencies: Latencies, deadline: float):
+        super().__init__(daemon=True)
+        self.viewer_id = f"bench-viewer-{index}"
+        self.stream_id = stream_id
+        self.playlist_url = playlist_url
+        self.local_dir = local_dir
+        self.api_url = api_url
+        self.latencies = latencies
+        self.deadline = deadline
+        self.delivery_latency: List[float] = []
+        self.bytes = 0
+
+    def run(self):
+        seen = set()
+        last_heartbeat = 0.0
+        while time.time() < self.deadline:
+            if time.time() - last_heartbeat >= VIEW_HEARTBEAT_INTERVAL:
+                last_heartbeat = time.time()
+                query = urllib.parse.urlencode({"viewer_id": self.viewer_id})
+                self.latencies.timed(
+                    "POST /streams/{id}/views",
+                    urllib.request.Request(f"{self.api_url}/streams/{self.stream_id}/views?{query}", method="POST")
+                )
+
+            body = self.latencies.timed("GET playlist", urllib.request.Request(self.playlist_url))
+            if body is None:
+                time.sleep(1)
+                continue
+            observed_at = time.time()
+            target, segments = parse_playlist(body.decode())
+            new = [uri for _, uri in segments if uri not in seen]
+            joined = not seen  # Only segments that appear after the first playlist are timed
+            for uri in new:
+                seen.add(uri)
+                if joined:
+                    continue
+                try:
+                    landed_at = os.stat(os.path.join(self.local_dir, uri)).st_mtime
+                    self.delivery_latency.append(max(0.0, observed_at - landed_at))
+                except FileNotFoundError:
+                    pass
+            if new:
+                segment = self.latencies.timed(
+                    "GET segment", urllib.request.Request(urllib.parse.urljoin(self.playlist_url, new[-1]))
+                )
+                self.bytes += len(segment or b"")
+            time.sleep(target if new else target / 2)
+
+
+class Dashboards(threading.Thread):
+    """Holds N status WebSockets open on one event loop"""
+
+    def __init__(self, url: str, count: int):
+        super().__init__(daemon=True)
+        self.url = url
+        self.count = count
+        self.connected = 0
+        self.messages = 0
+        self.disconnects = 0
+        self.status_latency: List[float] = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        await asyncio.gather(*(self._dashboard() for _ in range(self.count)))
+
+    async def _dashboard(self):
+        try:
+            async with websockets.connect(self.url, open_timeout=30) as websocket:
+                self.connected += 1
+                while not self.stopped.is_set():
+                    try:
+                        text = await asyncio.wait_for(websocket.recv(), 1)
+                    except asyncio.TimeoutError:
+                        continue
+                    self.messages += 1
+                    update = json.loads(text)
+                    if "timestamp" in update:
+                        # Workers stamp updates with naive UTC
+                        sent_at = datetime.fromisoformat(update["timestamp"]).replace(tzinfo=timezone.utc)
+                        self.status_latency.append(max(0.0, time.time() - sent_at.timestamp()))
+        except Exception:
+            if not self.stopped.is_set():
+                self.disconnects += 1
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def wait_for_url(url: str, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2):
+                return
+        except Exception:
+            time.sleep(0.5)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+def make_clip(path: str):
+    if os.path.exists(path):
+        return
+    subprocess.run(
+        [
+            "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+            "-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=30",
+            "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100",
+            "-t", str(CLIP_SECONDS),
+            "-c:v", "libx264", "-preset", "veryfast", "-b:v", "2500k", "-pix_fmt", "yuv420p",
+            "-g", "60", "-keyint_min", "60", "-sc_threshold", "0",
+            "-c:a", "aac", "-b:a", "128k",
+            "-f", "flv", path
+        ],
+        check=True
+    )
+
+
+def bench_token(api_url: str, latencies: Latencies) -> Optional[str]:
+    """Register the benchmark user if needed and log in"""
+    query = urllib.parse.urlencode({"username": BENCH_USER, "email": "bench@example.com", "password": BENCH_PASSWORD})
+    latencies.timed("POST /register", urllib.request.Request(f"{api_url}/register?{query}", method="POST"))
+    form = urllib.parse.urlencode({"username": BENCH_USER, "password": BENCH_PASSWORD}).encode()
+    body = latencies.timed("POST /login", urllib.request.Request(f"{api_url}/login", data=form, method="POST"))
+    return json.loads(body)["access_token"] if body else None
+
+
+def query_api(api_url: str, token: str, latencies: Latencies, rate: float, deadline: float):
+    """One client listing streams at rate requests per second"""
+    request = urllib.request.Request(f"{api_url}/streams?limit=50", headers={"Authorization": f"Bearer {token}"})
+    while time.time() < deadline:
+        started = time.time()
+        latencies.timed("GET /streams", request)
+        time.sleep(max(0.0, 1 / rate - (time.time() - started)))
+
+
+def cpu_snapshot(pids: List[int]) -> Dict[int, tuple]:
+    return {pid: usage for pid in pids if (usage := read_proc_stat(pid))}
+
+
+def cpu_cores(before: Dict[int, tuple], after: Dict[int, tuple], elapsed: float) -> List[float]:
+    """Cores used by each process that lived through the window"""
+    return [(after[pid][0] - before[pid][0]) / elapsed for pid in after if pid in before]
+
+
+def redis_counters(client: Redis) -> dict:
+    stats = client.info("stats")
+    commands = {name[len("cmdstat_"):]: value["calls"] for name, value in client.info("commandstats").items()}
+    return {"total": stats["total_commands_processed"], "commands": commands}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=10, help="Synthetic streams pushed at once")
+    parser.add_argument("--viewers", type=int, default=50, help="HLS viewers, spread over the streams")
+    parser.add_argument("--dashboards", type=int, default=50, help="Open /ws/stream-status connections")
+    parser.add_argument("--api-rps", type=float, default=20, help="GET /streams requests per second")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to measure once streams are up")
+    parser.add_argument("--startup-timeout", type=float, default=60, help="Seconds to wait for first segments")
+    parser.add_argument("--ladder", default="", help="ABR ladder for the jobs, e.g. 720p,480p; empty remuxes")
+    parser.add_argument("--rtmp-url", help="Publish to this RTMP server instead of FIFOs")
+    parser.add_argument("--api-url", help="Use a running API instead of starting one")
+    parser.add_argument("--api-port", type=int, default=8100)
+    parser.add_argument("--hls-port", type=int, default=8101)
+    parser.add_argument("--metrics-port", type=int, default=9109, help="Worker Prometheus exporter port")
+    parser.add_argument("--workdir", help="Keeps the clip between runs; a temporary directory by default")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pipeline-load-")
+    hls_dir = os.path.join(workdir, "hls")
+    source_dir = os.path.join(workdir, "sources")
+    os.makedirs(hls_dir, exist_ok=True)
+    os.makedirs(source_dir, exist_ok=True)
+    clip = os.path.join(workdir, "clip.flv")
+    make_clip(clip)
+
+    run_id = f"bench{int(time.time())}"
+    stream_ids = [f"{run_id}-{i}" for i in range(args.streams)]
+    ladder = [name for name in args.ladder.split(",") if name]
+    redis_client = Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        db=int(os.getenv("REDIS_DB", 0)),
+        decode_responses=True
+    )
+    latencies = Latencies()
+    processes: List[subprocess.Popen] = []
+
+    env = {
+        **os.environ,
+        "WORKER_ID": run_id,
+        "HLS_OUTPUT_DIR": hls_dir,
+        "RTMP_INPUT_URL": args.rtmp_url or source_dir,
+        "ARCHIVE_DIR": "",
+        "MAX_STREAMS_PER_WORKER": str(max(args.streams, 1)),
+        "METRICS_PORT": str(args.metrics_port),
+    }
+    worker = subprocess.Popen([sys.executable, "-m", "src.workers.ffmpeg_worker"], env=env)
+    processes.append(worker)
+    api = None
+    api_url = args.api_url
+    if not api_url:
+        api = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "src.api.main:app", "--port", str(args.api_port), "--log-level", "warning"],
+            env=env
+        )
+        processes.append(api)
+        api_url = f"http://127.0.0.1:{args.api_port}"
+
+    hls_server = ThreadingHTTPServer(("127.0.0.1", args.hls_port), partial(QuietHandler, directory=hls_dir))
+    threading.Thread(target=hls_server.serve_forever, daemon=True).start()
+
+    try:
+        wait_for_url(f"http://127.0.0.1:{args.metrics_port}/metrics", 30)
+        wait_for_url(f"{api_url}/metrics", 30)
+        token = bench_token(api_url, latencies)
+
+        dashboards = Dashboards(f"{api_url.replace('http', 'ws', 1)}/ws/stream-status", args.dashboards)
+        dashboards.start()
+        deadline = time.time() + 30
+        while dashboards.connected + dashboards.disconnects < args.dashboards and time.time() < deadline:
+            time.sleep(0.1)
+
+        # Publishers block on their FIFO until the worker opens it
+        for stream_id in stream_ids:
+            if args.rtmp_url:
+                target = f"{args.rtmp_url}/{stream_id}"
+            else:
+                target = os.path.join(source_dir, stream_id)
+                os.mkfifo(target)
+            processes.append(subprocess.Popen(
+                [
+                    "ffmpeg", "-nostdin", "-loglevel", "error", "-re", "-stream_loop", "-1",
+                    "-i", clip, "-c", "copy", "-f", "flv", "-y", target
+                ],
+                stdout=subprocess.DEVNULL
+            ))
+
+        pipe = redis_client.pipeline(transaction=False)
+        for stream_id in stream_ids:
+            job = {"stream_id": stream_id, "rtmp_key": stream_id}
+            if ladder:
+                job["ladder"] = ladder
+            pipe.lpush("stream_requests", json.dumps(job))
+        enqueued_at = time.time()
+        pipe.execute()
+
+        playlist_names = {
+            stream_id: os.path.join(stream_id, ladder[0], "playlist.m3u8") if ladder
+            else os.path.join(stream_id, "playlist.m3u8")
+            for stream_id in stream_ids
+        }
+        watcher = StreamWatcher(
+            {stream_id: os.path.join(hls_dir, name) for stream_id, name in playlist_names.items()}, enqueued_at
+        )
+        watcher.start()
+        deadline = time.time() + args.startup_timeout
+        while len(watcher.first_segment) < len(stream_ids) and time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+
+        # Measurement window
+        ffmpeg_before = cpu_snapshot(children_of(worker.pid))
+        worker_before = cpu_snapshot([worker.pid])
+        api_before = cpu_snapshot([api.pid]) if api else {}
+        redis_before = redis_counters(redis_client)
+        window_start = time.time()
+        window_end = window_start + args.duration
+
+        viewers = []
+        for index in range(args.viewers if stream_ids else 0):
+            stream_id = stream_ids[index % len(stream_ids)]
+            name = playlist_names[stream_id]
+            viewers.append(Viewer(
+                index, stream_id, f"http://127.0.0.1:{args.hls_port}/{name}",
+                os.path.join(hls_dir, os.path.dirname(name)), api_url, latencies, window_end
+            ))
+        clients = [
+            threading.Thread(target=query_api, args=(api_url, token, latencies, args.api_rps / 4, window_end), daemon=True)
+            for _ in range(4 if token and args.api_rps > 0 else 0)
+        ]
+        for thread in viewers + clients:
+            thread.start()
+        for thread in viewers + clients:
+            thread.join(max(0.0, window_end - time.time()) + 30)
+
+        elapsed = time.time() - window_start
+        ffmpeg_after = cpu_snapshot(children_of(worker.pid))
+        worker_after = cpu_snapshot([worker.pid])
+        api_after = cpu_snapshot([api.pid]) if api else {}
+        redis_after = redis_counters(redis_client)
+        watcher.stopped.set()
+        dashboards.stopped.set()
+
+        per_stream = cpu_cores(ffmpeg_before, ffmpeg_after, elapsed)
+        command_calls = {
+            name: calls - redis_before["commands"].get(name, 0)
+            for name, calls in redis_after["commands"].items()
+        }
+        report = {
+            "run": {
+                "started_at": datetime.fromtimestamp(enqueued_at, timezone.utc).isoformat(),
+                "host": platform.node(),
+                "cpus": os.cpu_count(),
+                "streams": args.streams,
+                "viewers": args.viewers,
+                "dashboards": args.dashboards,
+                "api_rps": args.api_rps,
+                "duration": round(elapsed, 1),
+                "ladder": ladder,
+                "source": "rtmp" if args.rtmp_url else "fifo",
+            },
+            "streams": {
+                "started": len(watcher.first_segment),
+                "time_to_first_segment": summarize(list(watcher.first_segment.values())),
+                "segment_write_lag": summarize(watcher.write_lag),
+                "cpu_cores_per_stream": summarize(per_stream),
+                "cpu_cores_total": round(sum(per_stream), 3),
+                "rss_mb_per_stream": summarize([usage[1] / 2**20 for usage in ffmpeg_after.values()]),
+                "worker_cpu_cores": round(sum(cpu_cores(worker_before, worker_after, elapsed)), 3),
+            },
+            "viewers": {
+                "playlist_delivery_latency": summarize(
+                    [latency for viewer in viewers for latency in viewer.delivery_latency]
+                ),
+                "megabits_per_second": round(sum(viewer.bytes for viewer in viewers) * 8 / elapsed / 1e6, 2),
+            },
+            "dashboards": {
+                "connected": dashboards.connected,
+                "disconnects": dashboards.disconnects,
+                "messages": dashboards.messages,
+                "status_latency": summarize(dashboards.status_latency),
+            },
+            "api": {
+                "cpu_cores": round(sum(cpu_cores(api_before, api_after, elapsed)), 3) if api else None,
+                "requests": latencies.report(),
+            },
+            "redis": {
+                "ops_per_second": round((redis_after["total"] - redis_before["total"]) / elapsed, 1),
+                "top_commands_per_second": {
+                    name: round(calls / elapsed, 1)
+                    for name, calls in sorted(command_calls.items(), key=lambda item: -item[1])[:10]
+                    if calls > 0
+                },
+            },
+        }
+    finally:
+        # Let the worker stop its ffmpeg children before it goes itself
+        pipe = redis_client.pipeline(transaction=False)
+        for stream_id in stream_ids:
+            pipe.lpush("stream_stop_requests", json.dumps({"stream_id": stream_id}))
+        pipe.execute()
+        deadline = time.time() + STOP_TIMEOUT
+        while children_of(worker.pid) and time.time() < deadline:
+            time.sleep(0.5)
+        leftover = children_of(worker.pid)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for pid in leftover:
+            try:
+                os.kill(pid, 9)
+            except ProcessLookupError:
+                pass
+        hls_server.shutdown()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,120 @@
-import { FC } from "react";
-import { Grid, Paper, Text } from "@mantine/core";
-import { useAppSelector } from "../store";
+import { FC, useEffect, useState } from "react";
+import axios from "axios";
+import { Box, Grid, Paper, Text } from "@mantine/core";
 import { StreamPlayer } from "./StreamPlayer";
 import { StreamMetadata } from "../types";
 
+// Thumbnails are taken every few seconds; one sprite request refreshes every tile
+const PREVIEW_REFRESH_MS = 5000;
+
+interface SpriteLayout {
+  columns: number;
+  tile_width: number;
+  tile_height: number;
+  tiles: { classroom_id: number; stream_id: string; captured_at: number }[];
+}
+
+interface Sprite {
+  url: string;
+  layout: SpriteLayout;
+  etag: string;
+}
+
 interface StreamGridProps {
   streams: StreamMetadata[];
   columns?: number;
 }
 
+const useThumbnailSprite = () => {
+  const [sprite, setSprite] = useState<Sprite | null>(null);
+
+  useEffect(() => {
+    let current: Sprite | null = null;
+    let cancelled = false;
+
+    const refresh = async () => {
+      const response = await axios.get("/api/thumbnails/sprite", {
+        responseType: "blob",
+        headers: current ? { "If-None-Match": current.etag } : {},
+        validateStatus: (status) => status === 200 || status === 204 || status === 304,
+      });
+      if (cancelled || response.status === 304) return;
+      if (current) URL.revokeObjectURL(current.url);
+      current =
+        response.status === 204
+          ? null
+          : {
+              url: URL.createObjectURL(response.data),
+              layout: JSON.parse(response.headers["x-sprite-layout"]),
+              etag: response.headers["etag"],
+            };
+      setSprite(current);
+    };
+
+    refresh().catch(() => undefined);
+    const interval = setInterval(() => refresh().catch(() => undefined), PREVIEW_REFRESH_MS);
+    return () => {
+      cancelled = true;
+      clearInterval(interval);
+      if (current) URL.revokeObjectURL(current.url);
+    };
+  }, []);
+
+  return sprite;
+};
+
+const SpriteTile: FC<{ sprite: Sprite; index: number }> = ({ sprite, index }) => {
+  const { columns, tile_width, tile_height } = sprite.layout;
+  const rows = Math.ceil(sprite.layout.tiles.length / columns);
+  const column = index % columns;
+  const row = Math.floor(index / columns);
+  return (
+    <Box
+      sx={{
+        width: "100%",
+        aspectRatio: `${tile_width} / ${tile_height}`,
+        backgroundImage: `url(${sprite.url})`,
+        backgroundSize: `${columns * 100}% ${rows * 100}%`,
+        backgroundPosition: `${columns > 1 ? (column * 100) / (columns - 1) : 0}% ${
+          rows > 1 ? (row * 100) / (rows - 1) : 0
+        }%`,
+      }}
+    />
+  );
+};
+
+// Shows previews from a single sprite sheet; a stream is only played when its tile is clicked
 export const StreamGrid: FC<StreamGridProps> = ({ streams, columns = 2 }) => {
+  const sprite = useThumbnailSprite();
+  const [playing, setPlaying] = useState<number | null>(null);
+
   return (
     <Grid>
-      {streams.map((stream) => (
-        <Grid.Col key={stream.id} span={12 / columns}>
-          <Paper p="md" radius="md" sx={{ height: "300px" }}>
-            <StreamPlayer streamUrl={stream.hls_url} autoplay={true} />
-            <Text size="sm" mt="xs" align="center">
-              Classroom {stream.classroom_id} - {stream.stream_status}
-            </Text>
-          </Paper>
-        </Grid.Col>
-      ))}
+      {streams.map((stream) => {
+        const index =
+          sprite?.layout.tiles.findIndex((tile) => tile.stream_id === String(stream.id)) ?? -1;
+        return (
+          <Grid.Col key={stream.id} span={12 / columns}>
+            <Paper
+              p="md"
+              radius="md"
+              sx={{ cursor: "pointer" }}
+              onClick={() => setPlaying(playing === stream.id ? null : stream.id)}
+            >
+              {playing === stream.id ? (
+                <StreamPlayer streamUrl={stream.hls_url} autoplay={true} />
+              ) : sprite && index >= 0 ? (
+                <SpriteTile sprite={sprite} index={index} />
+              ) : (
+                <Box sx={{ width: "100%", aspectRatio: "16 / 9", background: "black" }} />
+              )}
+              <Text size="sm" mt="xs" align="center">
+                Classroom {stream.classroom_id} - {stream.stream_status}
+              </Text>
+            </Paper>
+          </Grid.Col>
+        );
+      })}
     </Grid>
   );
 };
@@ -0,0 +1,126 @@
+import os
+import time
+import logging
+from dataclasses import dataclass
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Adaptive bitrate configuration
+ADAPTIVE_BITRATE = os.getenv("ADAPTIVE_BITRATE", "true").lower() == "true"
+DOWNGRADE_AFTER = float(os.getenv("ABR_DOWNGRADE_AFTER", 10))  # Seconds of congestion before stepping down
+UPGRADE_AFTER = float(os.getenv("ABR_UPGRADE_AFTER", 60))  # Seconds of health before stepping up
+SWITCH_COOLDOWN = float(os.getenv("ABR_SWITCH_COOLDOWN", 20))  # Seconds after a switch before judging the link again
+MAX_UPGRADE_DELAY = 600  # Upper bound on the step-up wait after failed upgrades
+
+# ffmpeg reports speed relative to real time; a live encoder that keeps up stays near 1
+CONGESTED_SPEED = 0.95
+HEALTHY_SPEED = 0.98
+
+
+@dataclass(frozen=True)
+class EncoderProfile:
+    name: str
+    height: int
+    bitrate_kbps: int
+    preset: str
+
+    def video_options(self) -> List[str]:
+        return [
+            "-preset", self.preset,
+            "-b:v", f"{self.bitrate_kbps}k",
+            "-maxrate", f"{self.bitrate_kbps}k",
+            "-bufsize", f"{self.bitrate_kbps * 2}k",
+        ]
+
+
+# Best first; the first profile is what the agent always used to send
+PROFILES = [
+    EncoderProfile("720p", 720, 2500, "veryfast"),
+    EncoderProfile("720p-low", 720, 1800, "veryfast"),
+    EncoderProfile("540p", 540, 1200, "veryfast"),
+    EncoderProfile("480p", 480, 800, "superfast"),
+    EncoderProfile("360p", 360, 500, "superfast"),
+]
+
+
+class BitrateController:
+    """Steps between encoder profiles as the uplink degrades and recovers.
+
+    An encoder that falls behind real time or drops frames cannot push its
+    output through the link, or cannot encode it fast enough. Either way a
+    cheaper profile helps. Stepping down takes DOWNGRADE_AFTER seconds of
+    sustained congestion. Stepping up takes UPGRADE_AFTER seconds of health,
+    and that wait doubles each time an upgrade is followed by a downgrade,
+    so a link at the edge of a profile does not flap between two.
+    """
+
+    def __init__(self, profiles: List[EncoderProfile] = PROFILES, enabled: bool = ADAPTIVE_BITRATE):
+        self.profiles = profiles
+        self.enabled = enabled
+        self.level = 0
+        self.upgrade_after = UPGRADE_AFTER
+        self.switched_at = float("-inf")
+        self.upgraded = False  # The last switch was a step up
+        self.congested_since: Optional[float] = None
+        self.healthy_since: Optional[float] = None
+        self.dropped = 0  # Cumulative dropped frames at the last observation
+
+    @property
+    def profile(self) -> EncoderProfile:
+        return self.profiles[self.level]
+
+    @property
+    def congested(self) -> bool:
+        return self.congested_since is not None
+
+    def restarted(self):
+        """The encoder was restarted, so its counters start over"""
+        self.dropped = 0
+        self.congested_since = None
+        self.healthy_since = None
+
+    def observe(self, speed: Optional[float], dropped: Optional[int], now: Optional[float] = None) -> Optional[EncoderProfile]:
+        """Feed one stats update; returns the profile to switch to, if any"""
+        if not self.enabled or speed is None:
+            return None
+        now = now or time.monotonic()
+        dropping = dropped is not None and dropped > self.dropped
+        if dropped is not None:
+            self.dropped = dropped
+        if now - self.switched_at < SWITCH_COOLDOWN:
+            # The encoder is still settling after a restart
+            return None
+
+        if speed < CONGESTED_SPEED or dropping:
+            self.healthy_since = None
+            if self.congested_since is None:
+                self.congested_since = now
+            elif now - self.congested_since >= DOWNGRADE_AFTER:
+                return self.step_down(now)
+        elif speed >= HEALTHY_SPEED:
+            self.congested_since = None
+            if self.healthy_since is None:
+                self.healthy_since = now
+            elif now - self.healthy_since >= self.upgrade_after:
+                return self._switch(self.level - 1, now)
+        return None
+
+    def step_down(self, now: Optional[float] = None) -> Optional[EncoderProfile]:
+        now = now or time.monotonic()
+        if self.upgraded and now - self.switched_at < self.upgrade_after:
+            # The link could not hold the better profile; wait longer next time
+            self.upgrade_after = min(MAX_UPGRADE_DELAY, self.upgrade_after * 2)
+        else:
+            self.upgrade_after = UPGRADE_AFTER
+        return self._switch(self.level + 1, now)
+
+    def _switch(self, level: int, now: float) -> Optional[EncoderProfile]:
+        if not 0 <= level < len(self.profiles):
+            return None
+        self.upgraded = level < self.level
+        self.level = level
+        self.switched_at = now
+        self.restarted()
+        logger.info(f"Switching encoder to {self.profile.name} ({self.profile.bitrate_kbps}k)")
+        return self.profile
@@ -0,0 +1,197 @@
+import os
+import csv
+import time
+import socket
+import logging
+import threading
+import urllib.error
+import urllib.request
+from collections import deque
+from typing import List, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Store-and-forward configuration
+LOCAL_BUFFER_DIR = os.getenv("LOCAL_BUFFER_DIR", "")  # Empty streams to RTMP only
+LOCAL_BUFFER_BYTES = int(float(os.getenv("LOCAL_BUFFER_GB", 4)) * 2**30)  # Ring size, oldest segments go first
+INGEST_URL = os.getenv("INGEST_URL", "")  # The API's /ingest/segments endpoint
+LOCAL_SEGMENT_SECONDS = 2
+BACKFILL_MARGIN = 6  # Seconds before an outage that are resent too; RTMP loses what was in flight
+UPLOAD_RETRY_DELAY = 5
+REQUEST_TIMEOUT = 30
+
+Segment = Tuple[str, float, float]  # (file name, capture start as Unix time, duration)
+
+
+def server_reachable(rtmp_address: str, timeout: float = 2) -> bool:
+    """Whether the RTMP server accepts connections again"""
+    address = urlparse(rtmp_address)
+    try:
+        with socket.create_connection((address.hostname, address.port or 1935), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+class SegmentBuffer:
+    """Size-bounded ring of locally encoded MPEG-TS segments.
+
+    Each encoder run writes `<run>_<index>.ts` segments and a `<run>.csv`
+    index of the finished ones, where the run id is the Unix time the run
+    started. Segment times in the index are relative to that start.
+    """
+
+    def __init__(self, directory: str = LOCAL_BUFFER_DIR, max_bytes: int = LOCAL_BUFFER_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.run_id = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def new_run(self) -> int:
+        os.makedirs(self.directory, exist_ok=True)
+        self.run_id = max(int(time.time()), self.run_id + 1)
+        return self.run_id
+
+    def output(self, run_id: int) -> str:
+        """tee slave writing this run's segments"""
+        options = ":".join([
+            "f=segment",
+            f"segment_time={LOCAL_SEGMENT_SECONDS}",
+            "segment_format=mpegts",
+            f"segment_list={os.path.join(self.directory, f'{run_id}.csv')}",
+            "segment_list_type=csv",
+        ])
+        return f"[{options}]{os.path.join(self.directory, f'{run_id}_%06d.ts')}"
+
+    def segments(self, run_id: int, since: float = 0) -> List[Segment]:
+        """Finished segments of a run captured from since onwards"""
+        segments = []
+        try:
+            with open(os.path.join(self.directory, f"{run_id}.csv"), newline="") as f:
+                for name, start, end in csv.reader(f):
+                    started_at = run_id + float(start)
+                    if started_at + float(end) - float(start) >= since:
+                        segments.append((name, started_at, float(end) - float(start)))
+        except (FileNotFoundError, ValueError):
+            pass
+        return segments
+
+    def prune(self) -> List[str]:
+        """Delete the oldest segments until the ring fits; returns their names"""
+        if not self.enabled:
+            return []
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(".ts"):
+                    size = entry.stat().st_size
+                    entries.append((self._order(entry.name), entry.name, size))
+                    total += size
+        deleted = []
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+            deleted.append(name)
+        self._remove_orphan_indexes()
+        return deleted
+
+    @staticmethod
+    def _order(name: str) -> Tuple[int, int]:
+        run_id, _, index = os.path.splitext(name)[0].partition("_")
+        return int(run_id), int(index)
+
+    def _remove_orphan_indexes(self):
+        runs = {name.partition("_")[0] for name in os.listdir(self.directory) if name.endswith(".ts")}
+        for name in os.listdir(self.directory):
+            run_id = os.path.splitext(name)[0]
+            if name.endswith(".csv") and run_id not in runs and int(run_id) != self.run_id:
+                os.remove(os.path.join(self.directory, name))
+
+
+class BackfillUploader:
+    """Uploads the segments RTMP missed during an outage, oldest first.
+
+    Runs on its own thread and sends one segment after another as fast as
+    the link allows, so a recovered uplink catches up faster than real time.
+    Failed uploads are retried; the server ignores segments it already has.
+    """
+
+    def __init__(self, buffer: SegmentBuffer, stream_key: str, url: str = INGEST_URL):
+        self.buffer = buffer
+        self.stream_key = stream_key
+        self.url = url
+        self.pending: deque = deque()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name="backfill", daemon=True).start()
+
+    def add(self, segments: List[Segment]):
+        if not segments:
+            return
+        if not self.url:
+            logger.warning(f"{len(segments)} segments missed by RTMP stay local, INGEST_URL is not set")
+            return
+        with self.lock:
+            self.pending.extend(segments)
+        logger.info(f"Backfilling {len(segments)} segments ({sum(s[2] for s in segments):.0f}s)")
+        self.wake.set()
+
+    def upload(self, segment: Segment) -> bool:
+        name, started_at, duration = segment
+        try:
+            with open(os.path.join(self.buffer.directory, name), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            logger.warning(f"Segment {name} left the local buffer before it was uploaded")
+            return True
+        request = urllib.request.Request(
+            self.url,
+            data=data,
+            headers={
+                "Content-Type": "video/mp2t",
+                "X-Stream-Key": self.stream_key,
+                "X-Segment-Start": f"{started_at:.3f}",
+                "X-Segment-Duration": f"{duration:.3f}",
+            },
+            method="PUT"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT):
+                return True
+        except urllib.error.HTTPError as e:
+            if 400 <= e.code < 500 and e.code not in (408, 429):
+                # Retrying cannot help, e.g. no stream was live at that time
+                logger.error(f"Server refused segment {name}: {e.code} {e.reason}")
+                return True
+            logger.warning(f"Could not upload segment {name}, retrying: {str(e)}")
+            return False
+        except Exception as e:
+            logger.warning(f"Could not upload segment {name}, retrying: {str(e)}")
+            return False
+
+    def run(self):
+        while True:
+            self.wake.wait(UPLOAD_RETRY_DELAY)
+            self.wake.clear()
+            try:
+                self.buffer.prune()
+                while True:
+                    with self.lock:
+                        if not self.pending:
+                            break
+                        segment = self.pending[0]
+                    if not self.upload(segment):
+                        break  # Wait before retrying
+                    with self.lock:
+                        self.pending.popleft()
+            except Exception as e:
+                logger.error(f"Error in backfill uploader: {str(e)}")
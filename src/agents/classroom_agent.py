@@ -1,14 +1,28 @@
 import os
+import re
 import time
+import queue
 import subprocess
 import logging
 from typing import Optional
 import random
 
+from src.agents.bitrate import BitrateController
+from src.agents.buffer import BACKFILL_MARGIN, BackfillUploader, SegmentBuffer, server_reachable
+from src.agents.devices import DeviceCapabilities
+from src.agents.progress import EVENT_QUEUE_SIZE, ProgressReader, RollingStats, progress_options
+from src.agents.telemetry import TelemetryShipper
+from src.workers.supervisor import StreamStats
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+EXIT_CHECK_INTERVAL = 0.5  # Seconds between checks that ffmpeg is still running
+RECONNECT_PROBE_INTERVAL = 5  # Seconds between checks whether the RTMP server is back
+RTMP_FAILED = "Slave muxer #0 failed"  # Logged by tee when the RTMP output gives up
+AUDIO_PATTERN = re.compile(r'Audio: .* (\d+) Hz')
+
 class StreamingAgent:
     def __init__(self):
         # Load configuration from environment variables
@@ -32,35 +46,42 @@ class StreamingAgent:
         if not self.stream_key:
             raise ValueError("STREAM_KEY environment variable must be set")
 
+        # Encoder stats for the server's quality history
+        self.telemetry = TelemetryShipper(self.stream_key)
+        # Picks the encoder profile from the uplink's health
+        self.bitrate = BitrateController()
+        # Progress reports and log lines of the running encoder
+        self.events: queue.Queue = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.stats = RollingStats()
+        self.lagging = False
+        self.dropping = False
+        # Local segment ring that keeps recording while the uplink is down
+        self.buffer = SegmentBuffer()
+        self.uploader = BackfillUploader(self.buffer, self.stream_key)
+        self.outage_since: Optional[float] = None
+        self.last_probe = 0.0
+
     def _validate_devices(self):
         """Validate video and audio devices"""
         # Check video device
         if not os.path.exists(self.video_device):
             raise ValueError(f"Video device {self.video_device} not found")
-            
-        # Check audio device using arecord
-        try:
-            subprocess.run(
-                ["arecord", "-L"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=True
-            )
-        except subprocess.CalledProcessError:
-            logger.error("ALSA audio subsystem not available")
-            raise ValueError("Audio system not properly configured")
-            
-        # Test audio device
-        try:
-            subprocess.run(
-                ["arecord", "-d", "1", "-f", "cd", "-D", self.audio_device, "/dev/null"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=True
+
+        # Probes both devices concurrently, or reuses what an earlier start found
+        self.devices = DeviceCapabilities()
+        self.devices.probe(
+            self.video_device, self.video_input_format,
+            self.audio_device, self.audio_channels, self.audio_rate
+        )
+
+        # Capture what the hardware delivers; the encoder converts to the configured layout
+        self.capture_channels = self.devices.audio_channels(self.audio_channels)
+        self.capture_rate = self.devices.audio_rate(self.audio_rate)
+        if (self.capture_channels, self.capture_rate) != (self.audio_channels, self.audio_rate):
+            logger.warning(
+                f"Audio device {self.audio_device} does not support {self.audio_channels}ch/{self.audio_rate}Hz, "
+                f"capturing {self.capture_channels}ch/{self.capture_rate}Hz"
             )
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Audio device test failed: {e.stderr.decode()}")
-            raise ValueError(f"Audio device {self.audio_device} not working properly")
 
     def _get_audio_mapping(self) -> str:
         """Get the audio channel mapping configuration"""
@@ -76,39 +97,43 @@ class StreamingAgent:
 
     def start_stream(self) -> bool:
         """Start the streaming process using FFmpeg"""
+        profile = self.bitrate.profile
+        capture = self.devices.capture_mode(profile.height)
+        pixel_format = capture.encoder_format if capture else "yuv420p"
         command = [
             "ffmpeg",
             # Global options
             "-thread_queue_size", "512",  # Increase queue size for inputs
             "-use_wallclock_as_timestamps", "1",  # Use wallclock for sync
+            *progress_options(),  # Stats as key=value blocks on stdout
             
             # Input options - video
             "-f", self.video_input_format,
+            *(capture.input_options() if capture else []),  # Native format, size and rate
             "-i", self.video_device,
             
             # Input options - audio
             "-f", "alsa",
             "-thread_queue_size", "512",
-            "-ac", str(self.audio_channels),
-            "-ar", str(self.audio_rate),
+            "-ac", str(self.capture_channels),
+            "-ar", str(self.capture_rate),
             "-i", self.audio_device,
             
             # Video encoding
             "-c:v", "libx264",
-            "-preset", "veryfast",
+            *profile.video_options(),  # Preset and bitrate
             "-tune", "zerolatency",
-            "-b:v", "2500k",
-            "-maxrate", "2500k",
-            "-bufsize", "5000k",
-            "-pix_fmt", "yuv420p",
+            "-pix_fmt", pixel_format,
             "-g", "60",
             "-keyint_min", "60",
             "-sc_threshold", "0",  # Disable scene change detection
-            "-filter_complex", "[0:v]format=yuv420p,scale=-2:720[v]",  # Ensure consistent format and resolution
+            # Scaling first lets one swscale pass convert too; a no-op when the camera already matches
+            "-filter_complex", f"[0:v]scale=-2:{profile.height},format={pixel_format}[v]",
             
             # Audio encoding
             "-c:a", "aac",
             "-b:a", "128k",
+            "-ac", str(self.audio_channels),
             "-ar", str(self.audio_rate),
             "-af", self._get_audio_mapping(),
             "-async", "1",  # Audio sync method
@@ -122,9 +147,7 @@ class StreamingAgent:
             "-map", "1:a",    # Mapped audio
             
             # Output options
-            "-f", "flv",
-            "-flvflags", "no_duration_filesize",  # Better live streaming
-            f"{self.server_rtmp_address}/{self.stream_key}"
+            *self._output_options()
         ]
 
         try:
@@ -133,12 +156,54 @@ class StreamingAgent:
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
             )
-            logger.info("Streaming process started")
+            ProgressReader(self.process, self.events).start()
+            self.stats.reset()
+            self.bitrate.restarted()
+            logger.info(f"Streaming process started ({profile.name}, {profile.bitrate_kbps}k)")
             return True
         except Exception as e:
             logger.error(f"Failed to start streaming process: {str(e)}")
             return False
 
+    def _output_options(self) -> list:
+        rtmp_url = f"{self.server_rtmp_address}/{self.stream_key}"
+        if not self.buffer.enabled:
+            return [
+                "-f", "flv",
+                "-flvflags", "no_duration_filesize",  # Better live streaming
+                rtmp_url
+            ]
+        # Queue what the previous run captured during an outage
+        if self.outage_since is not None and self.buffer.run_id:
+            self.uploader.add(self.buffer.segments(self.buffer.run_id, self.outage_since - BACKFILL_MARGIN))
+        # One encode into both RTMP and the local ring; a failing RTMP output
+        # is dropped while recording to disk carries on
+        slaves = [self.buffer.output(self.buffer.new_run())]
+        if server_reachable(self.server_rtmp_address):
+            self.outage_since = None
+            slaves.insert(0, f"[f=flv:flvflags=no_duration_filesize:onfail=ignore]{rtmp_url}")
+        else:
+            # Connecting would stall capture until it timed out, so record locally only
+            self.outage_since = time.time()
+            logger.warning("RTMP server unreachable, recording to the local buffer until it is back")
+        return [
+            "-flags", "+global_header",  # FLV needs the codec headers up front
+            "-f", "tee",
+            "|".join(slaves)
+        ]
+
+    def reconnect(self):
+        """Restart the encoder once the server is reachable, so RTMP resumes"""
+        now = time.monotonic()
+        if now - self.last_probe < RECONNECT_PROBE_INTERVAL:
+            return
+        self.last_probe = now
+        if server_reachable(self.server_rtmp_address):
+            logger.info("RTMP server is reachable again, reconnecting")
+            self.stop_stream()
+            if not self.start_stream():
+                logger.error("Failed to restart stream after the outage")
+
     def stop_stream(self):
         """Stop the streaming process"""
         if self.process:
@@ -150,17 +215,22 @@ class StreamingAgent:
             self.process = None
             logger.info("Streaming process stopped")
 
+    def switch_profile(self):
+        """Restart the encoder with the controller's profile, without backoff"""
+        # The capture device can only be opened once, so the old encoder goes first
+        self.stop_stream()
+        if not self.start_stream():
+            logger.error("Failed to restart stream with the new profile")
+
     def monitor_stream(self):
         """Monitor the streaming process and handle errors"""
-        import re
-        
-        # Patterns to match in FFmpeg output
-        sync_pattern = re.compile(r'speed=(\d+\.\d+)x.*drop=(\d+)')
-        audio_pattern = re.compile(r'Audio: .* (\d+) Hz')
-        
         while True:
             if not self.process or self.process.poll() is not None:
                 logger.warning("Stream process ended unexpectedly")
+
+                # Likely the link could not carry the stream; retry at once with a cheaper profile
+                if self.bitrate.congested and self.bitrate.step_down() and self.start_stream():
+                    continue
                 
                 # Calculate backoff time
                 backoff_time = self.calculate_backoff_time()
@@ -181,40 +251,70 @@ class StreamingAgent:
                 else:
                     logger.error("Failed to restart stream")
                     continue
-            
-            # Check process status
-            if self.process:
-                # Check for process output/errors
-                error = self.process.stderr.readline().decode().strip()
-                if error:
-                    # Check for sync issues
-                    sync_match = sync_pattern.search(error)
-                    if sync_match:
-                        speed, drops = sync_match.groups()
-                        if float(speed) < 0.95 or float(speed) > 1.05:
-                            logger.warning(f"Stream speed outside normal range: {speed}x")
-                        if int(drops) > 0:
-                            logger.warning(f"Detected {drops} dropped frames")
-                    
-                    # Check for audio sample rate mismatches
-                    audio_match = audio_pattern.search(error)
-                    if audio_match and int(audio_match.group(1)) != self.audio_rate:
-                        logger.warning(f"Audio sample rate mismatch: expected {self.audio_rate}Hz")
-                    
-                    # Log general FFmpeg output
-                    if "Non-monotonous DTS" in error or "Timestamps are unset" in error:
-                        logger.warning("Detected A/V sync issues")
-                    elif "error" in error.lower():
-                        logger.error(f"FFmpeg error: {error}")
-                    else:
-                        logger.debug(f"FFmpeg output: {error}")
-            
-            time.sleep(1)  # Prevent tight loop
+
+            if self.outage_since is not None:
+                self.reconnect()
+                if not self.process:
+                    continue
+
+            # Sleeps until ffmpeg reports, so reactions take at most one progress period
+            try:
+                process, kind, payload = self.events.get(timeout=EXIT_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            if process is not self.process:
+                continue  # Left over from an encoder that was replaced
+            if kind == "progress":
+                self.handle_progress(payload)
+            else:
+                self.handle_log(payload)
+
+    def handle_progress(self, stats: StreamStats):
+        """React to one -progress report"""
+        self.stats.add(stats)
+        self.telemetry.record(stats)
+        if self.bitrate.observe(self.stats.speed, stats.drop_frames):
+            self.switch_profile()
+            return
+
+        # Warn when the encoder starts lagging or dropping, not on every report
+        speed = self.stats.speed
+        lagging = speed is not None and (speed < 0.95 or speed > 1.05)
+        if lagging and not self.lagging:
+            logger.warning(f"Stream speed outside normal range: {speed:.2f}x")
+        self.lagging = lagging
+        dropping = self.stats.dropped > 0
+        if dropping and not self.dropping:
+            logger.warning(f"Detected {self.stats.dropped} dropped frames in the last {self.stats.window:.0f}s")
+        self.dropping = dropping
+
+    def handle_log(self, line: str):
+        """Check one line of ffmpeg's log output"""
+        if RTMP_FAILED in line and self.outage_since is None:
+            self.outage_since = time.time()
+            logger.warning("RTMP uplink lost, recording to the local buffer until it is back")
+            return
+
+        # Check for audio sample rate mismatches
+        audio_match = AUDIO_PATTERN.search(line)
+        if audio_match and int(audio_match.group(1)) not in (self.audio_rate, self.capture_rate):
+            logger.warning(f"Audio sample rate mismatch: expected {self.audio_rate}Hz")
+
+        # Log general FFmpeg output
+        if "Non-monotonous DTS" in line or "Timestamps are unset" in line:
+            logger.warning("Detected A/V sync issues")
+        elif "error" in line.lower():
+            logger.error(f"FFmpeg error: {line}")
+        else:
+            logger.debug(f"FFmpeg output: {line}")
 
     def run(self):
         """Main run loop"""
         logger.info("Starting classroom streaming agent")
         
+        self.telemetry.start()
+        if self.buffer.enabled:
+            self.uploader.start()
         try:
             if self.start_stream():
                 self.monitor_stream()
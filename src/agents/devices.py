@@ -0,0 +1,256 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Device probing configuration
+DEVICE_CACHE_FILE = os.getenv("DEVICE_CACHE_FILE") or os.path.expanduser(
+    "~/.cache/classroom-agent/devices.json"
+)  # Probed capabilities, reused until a device changes
+CAPTURE_FPS = int(os.getenv("CAPTURE_FPS", 30))  # Frame rate asked of the camera
+PROBE_TIMEOUT = 10
+
+# v4l2 pixel formats by ffmpeg -input_format name, cheapest to encode first.
+# libx264 takes yuv420p and nv12 as they are; other layouts need a
+# conversion, and MJPEG a decode on top of it.
+ENCODER_FORMATS = ("yuv420p", "nv12")
+PIXEL_FORMAT_COST = {"yuv420p": 0, "nv12": 0, "nv21": 1, "yuyv422": 1, "uyvy422": 1, "mjpeg": 2}
+FOURCC_FORMATS = {
+    "YU12": "yuv420p", "NV12": "nv12", "NV21": "nv21",
+    "YUYV": "yuyv422", "UYVY": "uyvy422", "MJPG": "mjpeg",
+}
+
+FORMAT_PATTERN = re.compile(r"\[\d+\]: '(\w+)'")
+SIZE_PATTERN = re.compile(r"Size: Discrete (\d+)x(\d+)")
+INTERVAL_PATTERN = re.compile(r"Interval: Discrete [\d.]+s \(([\d.]+) fps\)")
+HW_PARAM_PATTERN = re.compile(r"^(CHANNELS|RATE):\s*(.+)$", re.MULTILINE)
+
+
+@dataclass(frozen=True)
+class CaptureMode:
+    pixel_format: str
+    width: int
+    height: int
+    fps: float
+
+    @property
+    def encoder_format(self) -> str:
+        """Pixel format to encode, the camera's own where the encoder takes it"""
+        return self.pixel_format if self.pixel_format in ENCODER_FORMATS else "yuv420p"
+
+    def input_options(self) -> List[str]:
+        return [
+            "-input_format", self.pixel_format,
+            "-video_size", f"{self.width}x{self.height}",
+            "-framerate", f"{min(self.fps, CAPTURE_FPS):g}",
+        ]
+
+
+def parse_v4l2_formats(output: str) -> List[CaptureMode]:
+    """Capture modes from `v4l2-ctl --list-formats-ext`, at each size's highest frame rate"""
+    modes: List[CaptureMode] = []
+    pixel_format = None
+    size = None
+    for line in output.splitlines():
+        if match := FORMAT_PATTERN.search(line):
+            pixel_format = FOURCC_FORMATS.get(match.group(1))
+            size = None
+        elif match := SIZE_PATTERN.search(line):
+            size = (int(match.group(1)), int(match.group(2)))
+        elif (match := INTERVAL_PATTERN.search(line)) and pixel_format and size:
+            fps = float(match.group(1))
+            last = modes[-1] if modes else None
+            if last and (last.pixel_format, last.width, last.height) == (pixel_format, *size):
+                if fps > modes[-1].fps:
+                    modes[-1] = CaptureMode(pixel_format, *size, fps)
+            else:
+                modes.append(CaptureMode(pixel_format, *size, fps))
+    return modes
+
+
+def parse_hw_range(value: str) -> Tuple[int, int]:
+    """An ALSA hw param such as `48000`, `[1 2]` or `(44099 44101)` as an inclusive range"""
+    numbers = [int(n) for n in re.findall(r"\d+", value)]
+    if not numbers:
+        raise ValueError(f"Unexpected hw param: {value}")
+    low, high = numbers[0], numbers[-1]
+    if value.startswith("("):
+        low += 1
+    if value.rstrip().endswith(")"):
+        high -= 1
+    return low, high
+
+
+def choose_capture_mode(modes: List[CaptureMode], height: int, fps: int = CAPTURE_FPS) -> Optional[CaptureMode]:
+    """Cheapest mode that delivers the frame rate at no less than the encoded height.
+
+    Prefers formats the encoder takes without conversion, then the smallest
+    such size, so the least is scaled. Without one that keeps up, the mode
+    with the best frame rate and size wins.
+    """
+    usable = [mode for mode in modes if mode.pixel_format in PIXEL_FORMAT_COST]
+    if not usable:
+        return None
+    sufficient = [mode for mode in usable if mode.height >= height and mode.fps >= fps]
+    if sufficient:
+        return min(sufficient, key=lambda m: (PIXEL_FORMAT_COST[m.pixel_format], m.height, m.width))
+    return max(usable, key=lambda m: (min(m.fps, fps), min(m.height, height), -PIXEL_FORMAT_COST[m.pixel_format]))
+
+
+def video_identity(device: str) -> str:
+    """Changes whenever udev recreates the device node, e.g. when a camera is replugged"""
+    info = os.stat(device)
+    name = ""
+    sysfs_name = f"/sys/class/video4linux/{os.path.basename(os.path.realpath(device))}/name"
+    if os.path.exists(sysfs_name):
+        with open(sysfs_name) as f:
+            name = f.read().strip()
+    return f"{info.st_rdev}:{info.st_ctime_ns}:{name}"
+
+
+def audio_identity() -> str:
+    """Changes when sound cards are added or removed"""
+    cards = ""
+    if os.path.exists("/proc/asound/cards"):
+        with open("/proc/asound/cards") as f:
+            cards = f.read()
+    snd_mtime = os.stat("/dev/snd").st_mtime_ns if os.path.exists("/dev/snd") else 0
+    return f"{snd_mtime}:{hashlib.sha1(cards.encode()).hexdigest()}"
+
+
+def probe_video(device: str) -> List[dict]:
+    result = subprocess.run(
+        ["v4l2-ctl", "-d", device, "--list-formats-ext"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=PROBE_TIMEOUT,
+        check=True
+    )
+    return [asdict(mode) for mode in parse_v4l2_formats(result.stdout.decode(errors="replace"))]
+
+
+def probe_audio(device: str, channels: int, rate: int) -> dict:
+    """Open the device for a single sample, dumping what its hardware supports.
+
+    The dump comes before the sample format is set, so it is there even when
+    the device rejects the configured channels or rate; only a device that
+    cannot be opened at all fails.
+    """
+    result = subprocess.run(
+        [
+            "arecord", "-D", device, "--dump-hw-params",
+            "-f", "S16_LE", "-c", str(channels), "-r", str(rate), "-s", "1", "/dev/null"
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=PROBE_TIMEOUT
+    )
+    output = result.stderr.decode(errors="replace")
+    params = dict(HW_PARAM_PATTERN.findall(output))
+    if "CHANNELS" not in params or "RATE" not in params:
+        raise ValueError(output.strip() or f"arecord exited with {result.returncode}")
+    return {"channels": parse_hw_range(params["CHANNELS"]), "rates": parse_hw_range(params["RATE"])}
+
+
+class DeviceCapabilities:
+    """What the capture devices support, probed once per device.
+
+    Both devices are probed at the same time. Results are cached on disk
+    with each device's identity, so restarts skip probing until a device
+    is replugged or replaced.
+    """
+
+    def __init__(self, cache_file: str = DEVICE_CACHE_FILE):
+        self.cache_file = cache_file
+        self.cache: Dict[str, dict] = self._load()
+        self.video_modes: List[CaptureMode] = []
+        self.audio: Optional[dict] = None
+
+    def probe(self, video_device: str, video_input_format: str, audio_device: str, channels: int, rate: int):
+        """Raises ValueError when the audio device cannot be opened"""
+        video_key = f"v4l2:{video_device}"
+        audio_key = f"alsa:{audio_device}"
+        video_id = video_identity(video_device) if video_input_format == "v4l2" else None
+        audio_id = audio_identity()
+
+        video = self._cached(video_key, video_id) if video_id else []
+        audio = self._cached(audio_key, audio_id)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            video_probe = executor.submit(probe_video, video_device) if video is None else None
+            audio_probe = executor.submit(probe_audio, audio_device, channels, rate) if audio is None else None
+
+            if video_probe:
+                try:
+                    video = video_probe.result()
+                    self._store(video_key, video_id, video)
+                except Exception as e:
+                    # Capture still works with the driver's default mode
+                    logger.warning(f"Could not probe video device {video_device}: {str(e)}")
+                    video = []
+            if audio_probe:
+                try:
+                    audio = audio_probe.result()
+                except FileNotFoundError:
+                    raise ValueError("ALSA audio subsystem not available")
+                except Exception as e:
+                    logger.error(f"Audio device test failed: {str(e)}")
+                    raise ValueError(f"Audio device {audio_device} not working properly")
+                self._store(audio_key, audio_id, audio)
+
+        self.video_modes = [CaptureMode(**mode) for mode in video]
+        self.audio = {name: tuple(value) for name, value in audio.items()}
+        if video_probe or audio_probe:
+            self._save()
+
+    def capture_mode(self, height: int) -> Optional[CaptureMode]:
+        return choose_capture_mode(self.video_modes, height)
+
+    def audio_rate(self, rate: int) -> int:
+        """rate if the device takes it natively, else the closest rate it does"""
+        return self._clamp("rates", rate)
+
+    def audio_channels(self, channels: int) -> int:
+        return self._clamp("channels", channels)
+
+    def _clamp(self, param: str, value: int) -> int:
+        if not self.audio:
+            return value
+        low, high = self.audio[param]
+        return min(max(value, low), high)
+
+    def _cached(self, key: str, identity: str):
+        entry = self.cache.get(key)
+        if entry and entry["identity"] == identity:
+            return entry["capabilities"]
+        return None
+
+    def _store(self, key: str, identity: Optional[str], capabilities):
+        if identity is not None:
+            self.cache[key] = {"identity": identity, "capabilities": capabilities}
+
+    def _load(self) -> Dict[str, dict]:
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable device cache: {str(e)}")
+            return {}
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            temp_path = self.cache_file + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(self.cache, f)
+            os.replace(temp_path, self.cache_file)
+        except OSError as e:
+            logger.warning(f"Could not write device cache: {str(e)}")
@@ -0,0 +1,137 @@
+import os
+import time
+import queue
+import logging
+import selectors
+import subprocess
+import threading
+from collections import deque
+from dataclasses import replace
+from typing import Dict, Optional
+
+from src.workers.supervisor import StreamStats, apply_progress
+
+logger = logging.getLogger(__name__)
+
+# Monitoring configuration
+PROGRESS_PERIOD = float(os.getenv("PROGRESS_PERIOD", 0.5))  # Seconds between ffmpeg progress reports
+STATS_WINDOW = float(os.getenv("STATS_WINDOW", 5))  # Seconds of progress the rolling stats cover
+EVENT_QUEUE_SIZE = 1000  # Log lines beyond this are dropped while the agent is busy
+READ_SIZE = 65536
+
+
+def progress_options() -> list:
+    """ffmpeg options sending machine-readable progress to stdout instead of a status line"""
+    return ["-nostats", "-progress", "pipe:1", "-stats_period", str(PROGRESS_PERIOD)]
+
+
+class RollingStats:
+    """Speed, bitrate and dropped frames over the last STATS_WINDOW seconds"""
+
+    def __init__(self, window: float = STATS_WINDOW):
+        self.window = window
+        self.samples: deque = deque()  # (time, stats)
+
+    def add(self, stats: StreamStats, now: Optional[float] = None):
+        now = now or time.monotonic()
+        if self.samples and stats.drop_frames < self.samples[-1][1].drop_frames:
+            self.samples.clear()  # ffmpeg was restarted
+        self.samples.append((now, stats))
+        while now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+    def reset(self):
+        self.samples.clear()
+
+    @property
+    def speed(self) -> Optional[float]:
+        if not self.samples:
+            return None
+        return sum(stats.speed for _, stats in self.samples) / len(self.samples)
+
+    @property
+    def bitrate_kbps(self) -> Optional[float]:
+        if not self.samples:
+            return None
+        return sum(stats.bitrate_kbps for _, stats in self.samples) / len(self.samples)
+
+    @property
+    def dropped(self) -> int:
+        """Frames dropped within the window"""
+        if not self.samples:
+            return 0
+        return self.samples[-1][1].drop_frames - self.samples[0][1].drop_frames
+
+
+class ProgressReader:
+    """Reads an ffmpeg child's progress and log output on a thread of its own.
+
+    Both pipes are drained as soon as they are readable, so ffmpeg never
+    blocks on a full pipe, and the thread sleeps in select() in between.
+    Each completed progress block and each log line is queued as a
+    (process, kind, payload) event for the agent's main loop. The thread
+    ends when ffmpeg closes its pipes.
+    """
+
+    def __init__(self, process: subprocess.Popen, events: queue.Queue):
+        self.process = process
+        self.events = events
+        self.stats = StreamStats()
+        self._fields: Dict[str, str] = {}
+        self._buffers: Dict[str, bytes] = {}
+
+    def start(self):
+        threading.Thread(target=self.run, name="progress", daemon=True).start()
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        for pipe, kind in ((self.process.stdout, "progress"), (self.process.stderr, "log")):
+            os.set_blocking(pipe.fileno(), False)
+            selector.register(pipe, selectors.EVENT_READ, kind)
+        try:
+            while selector.get_map():
+                for key, _ in selector.select():
+                    if not self._read(key.fileobj, key.data):
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+        except Exception as e:
+            logger.error(f"Error reading ffmpeg output: {str(e)}")
+        finally:
+            selector.close()
+
+    def _read(self, pipe, kind: str) -> bool:
+        try:
+            data = os.read(pipe.fileno(), READ_SIZE)
+        except BlockingIOError:
+            return True
+        if not data:
+            return False
+
+        lines = (self._buffers.pop(kind, b"") + data).split(b"\n")
+        if lines[-1]:
+            self._buffers[kind] = lines[-1]  # Keep the partial line for the next read
+        for line in lines[:-1]:
+            text = line.decode(errors="replace").strip()
+            if not text:
+                continue
+            if kind == "progress":
+                self._handle_progress(text)
+            else:
+                self._put("log", text)
+        return True
+
+    def _handle_progress(self, line: str):
+        key, _, value = line.partition("=")
+        if key != "progress":
+            self._fields[key] = value
+            return
+        # "progress=continue|end" terminates a block
+        apply_progress(self.stats, self._fields)
+        self._fields = {}
+        self._put("progress", replace(self.stats))
+
+    def _put(self, kind: str, payload):
+        try:
+            self.events.put_nowait((self.process, kind, payload))
+        except queue.Full:
+            pass  # The agent catches up with the next progress report
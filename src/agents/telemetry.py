@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import logging
+import threading
+import urllib.request
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+
+from src.workers.supervisor import StreamStats
+
+logger = logging.getLogger(__name__)
+
+# Telemetry configuration
+TELEMETRY_URL = os.getenv("TELEMETRY_URL", "")  # The API's /telemetry endpoint; empty disables telemetry
+TELEMETRY_SAMPLE_INTERVAL = float(os.getenv("TELEMETRY_SAMPLE_INTERVAL", 5))  # Seconds between samples
+TELEMETRY_SEND_INTERVAL = float(os.getenv("TELEMETRY_SEND_INTERVAL", 30))  # Seconds between uploads
+TELEMETRY_BUFFER_SIZE = 5000  # Samples kept while the server is unreachable
+TELEMETRY_BATCH_SIZE = 1000  # Samples per request, the API's limit
+REQUEST_TIMEOUT = 10
+
+
+class TelemetryShipper:
+    """Samples the encoder's stats and uploads them to the server in batches.
+
+    Uploads happen on a background thread. Samples that could not be sent
+    stay buffered for the next upload, and resent samples are ignored by
+    the server, so an outage only costs the oldest samples once the buffer
+    is full.
+    """
+
+    def __init__(self, stream_key: str, url: str = TELEMETRY_URL):
+        self.stream_key = stream_key
+        self.url = url
+        self.buffer: deque = deque(maxlen=TELEMETRY_BUFFER_SIZE)
+        self.lock = threading.Lock()
+        self.last_sample = 0.0
+        self.frame_counts = (0, 0)  # Cumulative (dropped, duplicated) at the last sample
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.url)
+
+    def start(self):
+        if self.enabled:
+            self._thread = threading.Thread(target=self.run, name="telemetry", daemon=True)
+            self._thread.start()
+
+    def record(self, stats: StreamStats):
+        """Take a sample of the encoder's stats, at most once per sample interval"""
+        now = time.time()
+        if not self.enabled or now - self.last_sample < TELEMETRY_SAMPLE_INTERVAL:
+            return
+        self.last_sample = now
+
+        dropped, duplicated = stats.drop_frames, stats.dup_frames
+        previous = self.frame_counts
+        if dropped < previous[0] or duplicated < previous[1]:
+            previous = (0, 0)  # ffmpeg was restarted
+        self.frame_counts = (dropped, duplicated)
+
+        with self.lock:
+            self.buffer.append({
+                "sampled_at": datetime.fromtimestamp(now, timezone.utc).isoformat(),
+                "bitrate_kbps": stats.bitrate_kbps,
+                "fps": stats.fps,
+                "speed": stats.speed,
+                "dropped_frames": dropped - previous[0],
+                "duplicated_frames": duplicated - previous[1],
+            })
+
+    def send(self) -> bool:
+        with self.lock:
+            batch = list(self.buffer)[:TELEMETRY_BATCH_SIZE]
+        if not batch:
+            return True
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps({"samples": batch}).encode(),
+            headers={"Content-Type": "application/json", "X-Stream-Key": self.stream_key},
+            method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT):
+                pass
+        except Exception as e:
+            logger.warning(f"Could not upload telemetry, keeping {len(self.buffer)} samples: {str(e)}")
+            return False
+        with self.lock:
+            # Samples may have been evicted meanwhile; only drop the ones that were sent
+            sent = {sample["sampled_at"] for sample in batch}
+            while self.buffer and self.buffer[0]["sampled_at"] in sent:
+                self.buffer.popleft()
+        return True
+
+    def run(self):
+        while True:
+            time.sleep(TELEMETRY_SEND_INTERVAL)
+            # Catch up on a backlog one batch at a time
+            while self.send() and len(self.buffer) >= TELEMETRY_BATCH_SIZE:
+                pass
@@ -0,0 +1,134 @@
+import os
+import json
+import secrets
+import logging
+from typing import Dict, List, Optional
+
+from redis.asyncio import Redis
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.models import Classroom, StreamMetadata
+
+logger = logging.getLogger(__name__)
+
+# Ingest configuration
+RTMP_KEY_BYTES = 16  # Random bytes per stream key, 22 URL-safe characters
+RTMP_CALLBACK_SECRET = os.getenv("RTMP_CALLBACK_SECRET", "")  # Expected in the callback URLs; empty refuses every call
+KEY_ATTEMPTS = 3  # Rounds of fresh keys for rows whose key was taken
+
+RTMP_KEYS_KEY = "rtmp_keys"  # Stream key -> JSON of what a publish on it starts
+# Consumed by src/workers/ffmpeg_worker.py
+STREAM_REQUEST_QUEUE = "stream_requests"
+STREAM_STOP_QUEUE = "stream_stop_requests"
+
+CLASSROOM_COLUMNS = (Classroom.id, Classroom.rtmp_key, Classroom.hls_ladder, Classroom.hls_mode)
+
+
+def publishing_key(rtmp_key: str) -> str:
+    # Id of the stream a publish on this key started
+    return f"rtmp_publishing:{rtmp_key}"
+
+
+def generate_rtmp_key() -> str:
+    return secrets.token_urlsafe(RTMP_KEY_BYTES)
+
+
+def index_entry(classroom) -> str:
+    return json.dumps({
+        "classroom_id": classroom.id,
+        "ladder": classroom.hls_ladder,
+        "hls_mode": classroom.hls_mode,
+    })
+
+
+async def index_classrooms(redis_client: Redis, classrooms: list):
+    """Add classrooms to the stream key index, in one round trip"""
+    if classrooms:
+        await redis_client.hset(
+            RTMP_KEYS_KEY, mapping={classroom.rtmp_key: index_entry(classroom) for classroom in classrooms}
+        )
+
+
+async def insert_classrooms(db: AsyncSession, teacher_id: int, classrooms: List[dict]) -> list:
+    """Insert classrooms with random stream keys as multi-row INSERTs.
+
+    A key that is already taken only skips its row; those rows get fresh
+    keys and are inserted again. Returns the rows in the order given. The
+    caller commits, so the whole batch is one transaction.
+    """
+    pending = {generate_rtmp_key(): index for index in range(len(classrooms))}
+    inserted: Dict[int, object] = {}
+    for _ in range(KEY_ATTEMPTS):
+        rows = (await db.execute(
+            insert(Classroom)
+            .values([
+                {"teacher_id": teacher_id, "rtmp_key": key, **classrooms[index]}
+                for key, index in pending.items()
+            ])
+            .on_conflict_do_nothing(index_elements=[Classroom.rtmp_key])
+            .returning(*Classroom.__table__.c)
+        )).all()
+        for row in rows:
+            inserted[pending.pop(row.rtmp_key)] = row
+        if not pending:
+            return [inserted[index] for index in range(len(classrooms))]
+        logger.warning(f"{len(pending)} stream keys were taken, generating new ones")
+        pending = {generate_rtmp_key(): index for index in pending.values()}
+    raise RuntimeError("Could not generate unique stream keys")
+
+
+async def lookup_key(redis_client: Redis, db: AsyncSession, rtmp_key: str) -> Optional[dict]:
+    """What a publish on rtmp_key starts, or None for an unknown key.
+
+    Served from the index; classrooms it does not have yet, e.g. ones
+    created before it existed, are looked up once and added.
+    """
+    raw = await redis_client.hget(RTMP_KEYS_KEY, rtmp_key)
+    if raw:
+        return json.loads(raw)
+    classroom = (await db.execute(select(*CLASSROOM_COLUMNS).where(Classroom.rtmp_key == rtmp_key))).first()
+    if classroom is None:
+        return None
+    await index_classrooms(redis_client, [classroom])
+    return json.loads(index_entry(classroom))
+
+
+async def start_publish(redis_client: Redis, db: AsyncSession, rtmp_key: str, classroom: dict) -> int:
+    """Create the stream of a new publish and queue it for the workers"""
+    stream_id = await db.scalar(
+        insert(StreamMetadata)
+        .values(
+            classroom_id=classroom["classroom_id"],
+            teacher_id=select(Classroom.teacher_id).where(Classroom.id == classroom["classroom_id"]).scalar_subquery(),
+            stream_status="starting"
+        )
+        .returning(StreamMetadata.id)
+    )
+    await db.commit()
+
+    job = json.dumps({"stream_id": str(stream_id), "rtmp_key": rtmp_key, **classroom})
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.set(publishing_key(rtmp_key), stream_id, get=True)
+    pipe.lpush(STREAM_REQUEST_QUEUE, job)
+    previous = (await pipe.execute())[0]
+    if previous:
+        # The encoder reconnected before the server noticed it was gone
+        await redis_client.lpush(STREAM_STOP_QUEUE, json.dumps({"stream_id": previous}))
+    return stream_id
+
+
+async def end_publish(redis_client: Redis, rtmp_key: str) -> Optional[str]:
+    stream_id = await redis_client.getdel(publishing_key(rtmp_key))
+    if stream_id:
+        await redis_client.lpush(STREAM_STOP_QUEUE, json.dumps({"stream_id": stream_id}))
+    return stream_id
+
+
+def callback_allowed(secret: Optional[str]) -> bool:
+    # Anyone who could call these knowing a stream key could start or stop its stream
+    if not RTMP_CALLBACK_SECRET:
+        logger.error("RTMP_CALLBACK_SECRET is not set, refusing nginx-rtmp callback")
+        return False
+    return secrets.compare_digest(secret or "", RTMP_CALLBACK_SECRET)
@@ -1,111 +1,433 @@
-from fastapi import FastAPI, WebSocket, Depends, HTTPException, status
+from fastapi import FastAPI, WebSocket, Depends, Form, Header, HTTPException, Query, Request, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from datetime import timedelta
-from typing import List
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
 import json
+import asyncio
 
-from src.database.connection import get_db, get_redis
+from src.database.connection import (
+    AsyncSessionLocal,
+    async_engine,
+    async_redis_binary_client,
+    async_redis_client,
+    get_db,
+    redis_client
+)
 from src.database.models import User, Classroom, StreamMetadata
 from src.api.auth import (
     get_current_user,
+    principal_cache,
+    revoke_token,
     create_access_token,
-    get_password_hash,
-    verify_password,
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
+from src.api.passwords import PasswordHasher
+from src.workers.hls import HLS_MODES, RENDITION_PRESETS
+from src.api.principals import Principal
+from src.api.schemas import ClassroomBatch, ClassroomOut, LiveStreamOut, StreamOut, TelemetryBatch
+from src.api.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, keyset_page, page_response, select_fields
+from src.api.metrics import MetricsMiddleware, instrument_engine, instrument_redis, metrics_endpoint
+from src.api.status_hub import StatusHub, serve_status
+from src.api.viewers import ViewerFlusher, check_beacon, record_view, viewer_fingerprint
+from src.api.quality import MAX_POINTS, quality_series
+from src.api.sprites import (
+    MAX_SPRITE_TILES,
+    SPRITE_FORMATS,
+    SpriteCache,
+    latest_tiles,
+    sprite_etag,
+    sprite_layout
+)
+from src.api.ingest import (
+    callback_allowed,
+    end_publish,
+    generate_rtmp_key,
+    index_classrooms,
+    insert_classrooms,
+    lookup_key,
+    start_publish
+)
+from src.workers.lifecycle import LIVE_STREAMS_KEY
+from src.workers.quality import INSERT_SAMPLES, sample_window
+from src.workers.segment_store import SEGMENT_BACKFILL_QUEUE, store_backfill_segment
 
 app = FastAPI()
 
+# Instrumentation
+app.add_middleware(MetricsMiddleware)
+instrument_engine(async_engine.sync_engine)
+instrument_redis(redis_client)
+instrument_redis(async_redis_client)
+instrument_redis(async_redis_binary_client)
+app.add_api_route("/metrics", metrics_endpoint, methods=["GET"], include_in_schema=False)
+
+# One Redis subscription per process, shared by every status WebSocket
+status_hub = StatusHub(async_redis_client)
+# bcrypt runs off the event loop
+password_hasher = PasswordHasher()
+# Viewer counts are kept in Redis and written to stream_metadata in batches
+viewer_flusher = ViewerFlusher(async_redis_client, AsyncSessionLocal)
+# Composed sprite sheets, shared by dashboards showing the same grid
+sprite_cache = SpriteCache()
+
+@app.on_event("startup")
+async def startup():
+    viewer_flusher.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await viewer_flusher.stop()
+    await status_hub.stop()
+    await async_engine.dispose()
+    password_hasher.shutdown()
+
+def _client_ip(request: Request) -> Optional[str]:
+    return request.client.host if request.client else None
+
+MAX_BACKFILL_SEGMENT_BYTES = 16 * 2**20  # A 2s agent segment is well under 1 MiB
+
+# Fields listed when a request doesn't choose; stream_quality blobs only on request
+CLASSROOM_FIELDS = list(ClassroomOut.model_fields)
+STREAM_FIELDS = [field for field in StreamOut.model_fields if field != "stream_quality"]
+
 # Authentication endpoints
 @app.post("/login")
 async def login(
+    request: Request,
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.password_hash):
+    user = await db.scalar(select(User).where(User.username == form_data.username))
+    valid, new_hash = False, None
+    if user:
+        valid, new_hash = await password_hasher.verify(
+            form_data.password, user.password_hash, _client_ip(request), user.username
+        )
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    
+    if new_hash:
+        # BCRYPT_ROUNDS changed since this password was stored
+        user.password_hash = new_hash
+        await db.commit()
+        await principal_cache.invalidate_user(user.username)
+
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
+@app.post("/logout", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(revoke_token)])
+async def logout():
+    return None
+
 @app.post("/register", response_model=dict)
 async def register(
+    request: Request,
     username: str,
     email: str,
     password: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    if db.query(User).filter(User.username == username).first():
+    if await db.scalar(select(User.id).where(User.username == username)):
         raise HTTPException(status_code=400, detail="Username already registered")
-    if db.query(User).filter(User.email == email).first():
+    if await db.scalar(select(User.id).where(User.email == email)):
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    hashed_password = get_password_hash(password)
+    hashed_password = await password_hasher.hash(password, _client_ip(request))
     user = User(username=username, email=email, password_hash=hashed_password)
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    # Drops anything cached under the name, e.g. of a user deleted since
+    await principal_cache.invalidate_user(username)
     return {"message": "User created successfully"}
 
 # Classroom endpoints
+def _validate_hls(hls_ladder: Optional[List[str]], hls_mode: str, prefix: str = ""):
+    unknown = [rendition for rendition in hls_ladder or [] if rendition not in RENDITION_PRESETS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"{prefix}Unknown renditions: {', '.join(unknown)}")
+    if hls_mode not in HLS_MODES:
+        raise HTTPException(status_code=400, detail=f"{prefix}Unknown HLS mode: {hls_mode}")
+
 @app.post("/classrooms")
 async def create_classroom(
     name: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    hls_ladder: Optional[List[str]] = Query(None),
+    hls_mode: str = "hls",
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
+    _validate_hls(hls_ladder, hls_mode)
+
     classroom = Classroom(
         name=name,
         teacher_id=current_user.id,
-        rtmp_key=f"{current_user.username}_{name.lower().replace(' ', '_')}"
+        # Random, so keys cannot be guessed from the teacher and classroom names
+        rtmp_key=generate_rtmp_key(),
+        hls_ladder=hls_ladder,
+        hls_mode=hls_mode
     )
     db.add(classroom)
-    db.commit()
-    db.refresh(classroom)
+    await db.commit()
+    await db.refresh(classroom)
+    await index_classrooms(async_redis_client, [classroom])
     return classroom
 
-@app.get("/classrooms")
+# Provisions a whole term's classrooms at once, in one transaction
+@app.post("/classrooms/bulk", response_model=List[ClassroomOut], status_code=status.HTTP_201_CREATED)
+async def create_classrooms(
+    batch: ClassroomBatch,
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    for index, classroom in enumerate(batch.classrooms):
+        _validate_hls(classroom.hls_ladder, classroom.hls_mode, f"Classroom {index}: ")
+    classrooms = await insert_classrooms(db, current_user.id, [classroom.model_dump() for classroom in batch.classrooms])
+    await db.commit()
+    await index_classrooms(async_redis_client, classrooms)
+    return [ClassroomOut.model_construct(**classroom._mapping) for classroom in classrooms]
+
+@app.get("/classrooms", response_model=List[ClassroomOut])
 async def get_classrooms(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    status_filter: Optional[str] = Query(None, alias="status"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    fields: Optional[str] = Query(None, description="Comma separated fields to return"),
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
-    return db.query(Classroom).filter(Classroom.teacher_id == current_user.id).all()
+    selected = select_fields(fields, ClassroomOut, CLASSROOM_FIELDS)
+    query = select(
+        *(getattr(Classroom, field) for field in selected), Classroom.created_at, Classroom.id
+    ).where(Classroom.teacher_id == current_user.id)
+    if status_filter:
+        query = query.where(Classroom.status == status_filter)
+    if since:
+        query = query.where(Classroom.created_at >= since)
+    if until:
+        query = query.where(Classroom.created_at < until)
+    query = keyset_page(query, Classroom.created_at, Classroom.id, cursor, limit)
+    return page_response(await db.execute(query), ClassroomOut, selected, limit)
 
 # Stream endpoints
-@app.get("/streams")
+@app.get("/streams", response_model=List[StreamOut])
 async def get_streams(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    status_filter: Optional[str] = Query(None, alias="status"),
+    classroom_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    fields: Optional[str] = Query(None, description="Comma separated fields to return"),
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    selected = select_fields(fields, StreamOut, STREAM_FIELDS)
+    query = select(
+        *(getattr(StreamMetadata, field) for field in selected), StreamMetadata.created_at, StreamMetadata.id
+    ).where(StreamMetadata.teacher_id == current_user.id)
+    if classroom_id is not None:
+        query = query.where(StreamMetadata.classroom_id == classroom_id)
+    if status_filter:
+        query = query.where(StreamMetadata.stream_status == status_filter)
+    if since:
+        query = query.where(StreamMetadata.created_at >= since)
+    if until:
+        query = query.where(StreamMetadata.created_at < until)
+    query = keyset_page(query, StreamMetadata.created_at, StreamMetadata.id, cursor, limit)
+    return page_response(await db.execute(query), StreamOut, selected, limit)
+
+# What is live now, as the workers report it; Postgres only lags behind
+async def _live_streams(db: AsyncSession, teacher_id: int, classroom_ids: Optional[List[int]]) -> List[dict]:
+    entries = await async_redis_client.hvals(LIVE_STREAMS_KEY)
+    if not entries:
+        return []
+    query = select(Classroom.id).where(Classroom.teacher_id == teacher_id)
+    if classroom_ids:
+        query = query.where(Classroom.id.in_(classroom_ids))
+    owned = set((await db.scalars(query)).all())
+    return [stream for stream in map(json.loads, entries) if stream.get("classroom_id") in owned]
+
+@app.get("/streams/live", response_model=List[LiveStreamOut])
+async def get_live_streams(
+    classroom_id: Optional[List[int]] = Query(None),
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
-    return db.query(StreamMetadata).join(Classroom).filter(
-        Classroom.teacher_id == current_user.id
-    ).all()
+    streams = await _live_streams(db, current_user.id, classroom_id)
+    return sorted(streams, key=lambda stream: stream["started_at"])
+
+# Latest thumbnails of the caller's live streams as one image, ordered by
+# classroom; the X-Sprite-Layout header says which tile is which
+@app.get("/thumbnails/sprite")
+async def get_thumbnail_sprite(
+    request: Request,
+    classroom_id: Optional[List[int]] = Query(None),
+    columns: int = Query(10, ge=1, le=MAX_SPRITE_TILES),
+    image_format: str = Query("jpeg", alias="format", description="jpeg or webp"),
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    if image_format not in SPRITE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {image_format}")
+    streams = await _live_streams(db, current_user.id, classroom_id)
+    streams.sort(key=lambda stream: (stream["classroom_id"], stream["started_at"]))
+    tiles = await latest_tiles(async_redis_binary_client, streams[:MAX_SPRITE_TILES])
+    if not tiles:
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+    columns = min(columns, len(tiles))
+    headers = {"X-Sprite-Layout": sprite_layout(tiles, columns), "Cache-Control": "private, no-cache"}
+    # Nothing new since the dashboard's last refresh costs no image
+    if request.headers.get("if-none-match") == sprite_etag(tiles, columns, image_format):
+        headers["ETag"] = request.headers["if-none-match"]
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    headers["ETag"], sheet = await sprite_cache.get(async_redis_binary_client, tiles, columns, image_format)
+    return Response(sheet, media_type=SPRITE_FORMATS[image_format], headers=headers)
+
+# Quality history, downsampled to fit the requested range
+@app.get("/streams/{stream_id}/quality")
+async def get_stream_quality(
+    stream_id: int,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    resolution: str = Query("auto", description="auto, raw, 1m or 1h"),
+    source: Optional[str] = Query(None, description="worker or agent"),
+    max_points: int = Query(MAX_POINTS, ge=1, le=MAX_POINTS),
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    stream = (await db.execute(
+        select(StreamMetadata.created_at, StreamMetadata.stream_start, StreamMetadata.stream_end)
+        .where(StreamMetadata.id == stream_id, StreamMetadata.teacher_id == current_user.id)
+    )).first()
+    if stream is None:
+        raise HTTPException(status_code=404, detail="Stream not found")
+    # Defaults to the whole stream
+    since = since or stream.stream_start or stream.created_at
+    until = until or stream.stream_end or datetime.now(timezone.utc)
+    return await quality_series(db, stream_id, since, until, resolution, source, max_points)
+
+# Agent telemetry, authenticated by the classroom's stream key
+@app.post("/telemetry", status_code=status.HTTP_204_NO_CONTENT)
+async def ingest_telemetry(
+    batch: TelemetryBatch,
+    stream_key: str = Header(..., alias="X-Stream-Key"),
+    db: AsyncSession = Depends(get_db)
+):
+    # Samples belong to the classroom's latest stream
+    stream_id = await db.scalar(
+        select(StreamMetadata.id)
+        .join(Classroom)
+        .where(Classroom.rtmp_key == stream_key)
+        .order_by(StreamMetadata.created_at.desc(), StreamMetadata.id.desc())
+        .limit(1)
+    )
+    if stream_id is None:
+        raise HTTPException(status_code=404, detail="No stream for this key")
+    # Samples no partition takes, e.g. from an agent whose clock is off, are
+    # dropped rather than rejected; the agent would only resend them
+    oldest, newest = sample_window()
+    samples = [sample for sample in batch.samples if oldest <= sample.sampled_at <= newest]
+    if samples:
+        await db.execute(INSERT_SAMPLES, [
+            {"stream_id": stream_id, "source": "agent", **sample.model_dump()} for sample in samples
+        ])
+        await db.commit()
+
+async def _read_body(request: Request, limit: int) -> bytes:
+    # Content-Length may be missing (chunked uploads) or wrong; count what arrives
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Segment too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+# Segments an agent recorded locally while its RTMP uplink was down
+@app.put("/ingest/segments", status_code=status.HTTP_204_NO_CONTENT)
+async def ingest_segment(
+    request: Request,
+    stream_key: str = Header(..., alias="X-Stream-Key"),
+    started_at: float = Header(..., alias="X-Segment-Start", description="Capture time, Unix seconds"),
+    duration: float = Header(..., alias="X-Segment-Duration", gt=0, le=60),
+    db: AsyncSession = Depends(get_db)
+):
+    if int(request.headers.get("content-length", 0)) > MAX_BACKFILL_SEGMENT_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Segment too large")
+    # The stream that was live when the segment was captured
+    stream_id = await db.scalar(
+        select(StreamMetadata.id)
+        .join(Classroom)
+        .where(
+            Classroom.rtmp_key == stream_key,
+            StreamMetadata.created_at <= datetime.fromtimestamp(started_at, timezone.utc)
+        )
+        .order_by(StreamMetadata.created_at.desc(), StreamMetadata.id.desc())
+        .limit(1)
+    )
+    if stream_id is None:
+        raise HTTPException(status_code=404, detail="No stream for this key")
+    data = await _read_body(request, MAX_BACKFILL_SEGMENT_BYTES)
+    path = await asyncio.to_thread(store_backfill_segment, stream_id, started_at, duration, data)
+    # Resent segments were stitched or queued already
+    if path:
+        await async_redis_client.lpush(SEGMENT_BACKFILL_QUEUE, json.dumps({"stream_id": str(stream_id)}))
+
+# nginx-rtmp callbacks: a publish on a classroom's key starts a stream,
+# any other status than 2xx makes nginx-rtmp drop the publisher
+@app.post("/rtmp/publish", status_code=status.HTTP_204_NO_CONTENT)
+async def rtmp_publish(
+    name: str = Form(..., description="Stream key"),
+    secret: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_db)
+):
+    if not callback_allowed(secret):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+    classroom = await lookup_key(async_redis_client, db, name)
+    if classroom is None:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Unknown stream key")
+    await start_publish(async_redis_client, db, name, classroom)
+
+@app.post("/rtmp/publish_done", status_code=status.HTTP_204_NO_CONTENT)
+async def rtmp_publish_done(
+    name: str = Form(..., description="Stream key"),
+    secret: Optional[str] = Query(None)
+):
+    if not callback_allowed(secret):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
+    await end_publish(async_redis_client, name)
+
+# Player heartbeat, sent while a stream is being watched
+@app.post("/streams/{stream_id}/views", status_code=status.HTTP_204_NO_CONTENT)
+async def record_stream_view(
+    stream_id: int,
+    request: Request,
+    viewer_id: Optional[str] = Query(None, max_length=64)
+):
+    live, allowed = await check_beacon(async_redis_client, str(stream_id), _client_ip(request))
+    if not live:
+        raise HTTPException(status_code=404, detail="Stream is not live")
+    if not allowed:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many heartbeats")
+    viewer_id = viewer_id or viewer_fingerprint(_client_ip(request), request.headers.get("user-agent"))
+    await record_view(async_redis_client, str(stream_id), viewer_id)
 
 # WebSocket endpoint for stream status updates
 @app.websocket("/ws/stream-status")
 async def stream_status_websocket(
     websocket: WebSocket,
-    redis = Depends(get_redis)
+    classroom_id: Optional[List[int]] = Query(None)
 ):
     await websocket.accept()
-    pubsub = redis.pubsub()
-    await pubsub.subscribe("stream_status_updates")
-    
-    try:
-        while True:
-            message = await pubsub.get_message(ignore_subscribe_messages=True)
-            if message and message["type"] == "message":
-                await websocket.send_text(message["data"])
-    except Exception:
-        await websocket.close()
-    finally:
-        await pubsub.unsubscribe("stream_status_updates")
+    await serve_status(status_hub, websocket, classroom_id)
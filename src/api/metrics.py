@@ -0,0 +1,203 @@
+import time
+import inspect
+from contextvars import ContextVar
+from typing import Optional, Union
+
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being served")
+REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries",
+    "Database queries issued per request",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50)
+)
+REQUEST_REDIS_COMMANDS = Histogram(
+    "http_request_redis_commands",
+    "Redis round trips per request",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 25)
+)
+DB_QUERIES = Counter("db_queries_total", "Database queries issued")
+DB_CHECKOUT_SECONDS = Histogram(
+    "db_connection_checkout_seconds",
+    "Time a connection stays checked out of the pool",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+DB_CONNECTIONS_CHECKED_OUT = Gauge("db_connections_checked_out", "Connections currently checked out of the pool")
+REDIS_COMMANDS = Counter("redis_commands_total", "Redis round trips issued by the API")
+PASSWORD_HASH_QUEUE_DEPTH = Gauge("password_hash_queue_depth", "bcrypt calls waiting for a pool worker")
+PASSWORD_HASH_WAIT_SECONDS = Histogram(
+    "password_hash_wait_seconds",
+    "Time a bcrypt call waited for a pool worker",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+PASSWORD_HASH_SECONDS = Histogram(
+    "password_hash_seconds",
+    "CPU time of one bcrypt hash or verify",
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 2)
+)
+PASSWORD_HASH_REJECTED = Counter(
+    "password_hash_rejected", "Login or registration hashes turned away", ["reason"]
+)
+PRINCIPAL_CACHE_REQUESTS = Counter(
+    "principal_cache_requests", "Authenticated user lookups by cache layer and result", ["layer", "result"]
+)
+WEBSOCKET_CONNECTIONS = Gauge("websocket_connections", "Open WebSocket connections", ["path"])
+WEBSOCKET_SUBSCRIBERS = Gauge("websocket_status_subscribers", "WebSockets fed by the shared status subscription")
+WEBSOCKET_MESSAGES_COALESCED = Counter(
+    "websocket_status_messages_coalesced", "Status updates replaced by a newer one before a slow client got them"
+)
+WEBSOCKET_CLIENTS_DROPPED = Counter(
+    "websocket_status_clients_dropped", "Status WebSockets closed for falling too far behind"
+)
+
+
+class RequestCounters:
+    __slots__ = ("db_queries", "redis_commands")
+
+    def __init__(self):
+        self.db_queries = 0
+        self.redis_commands = 0
+
+
+# Counters of the request being served in the current task
+_request_counters: ContextVar[Optional[RequestCounters]] = ContextVar("request_counters", default=None)
+
+
+def _route_name(scope) -> str:
+    # Template paths keep the label set bounded, e.g. /streams/{stream_id}
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, so instrumentation adds no extra task or body copy"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "websocket":
+            gauge = WEBSOCKET_CONNECTIONS.labels(scope["path"])
+            gauge.inc()
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                gauge.dec()
+            return
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        counters = RequestCounters()
+        token = _request_counters.set(counters)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec()
+            _request_counters.reset(token)
+            route = _route_name(scope)
+            REQUEST_LATENCY.labels(scope["method"], route, str(status_code)).observe(elapsed)
+            REQUEST_DB_QUERIES.labels(route).observe(counters.db_queries)
+            REQUEST_REDIS_COMMANDS.labels(route).observe(counters.redis_commands)
+
+
+def instrument_engine(engine: Engine):
+    """Count queries and time pool checkouts through SQLAlchemy events"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERIES.inc()
+        counters = _request_counters.get()
+        if counters is not None:
+            counters.db_queries += 1
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.perf_counter()
+        DB_CONNECTIONS_CHECKED_OUT.inc()
+
+    @event.listens_for(engine, "checkin")
+    def _checkin(dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        if checked_out_at is not None:
+            DB_CHECKOUT_SECONDS.observe(time.perf_counter() - checked_out_at)
+            DB_CONNECTIONS_CHECKED_OUT.dec()
+
+
+def _count_redis_round_trip():
+    REDIS_COMMANDS.inc()
+    counters = _request_counters.get()
+    if counters is not None:
+        counters.redis_commands += 1
+
+
+def instrument_redis(client: Union[Redis, AsyncRedis]):
+    """Count Redis round trips made through a client, sync or asyncio.
+
+    Single commands, scripts included, go through execute_command; a
+    pipeline is one round trip when it is executed.
+    """
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    if inspect.iscoroutinefunction(execute_command):
+        async def counted_execute_command(*args, **options):
+            _count_redis_round_trip()
+            return await execute_command(*args, **options)
+
+        def counted_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            async def counted_execute(*args, **kwargs):
+                _count_redis_round_trip()
+                return await execute(*args, **kwargs)
+
+            pipe.execute = counted_execute
+            return pipe
+    else:
+        def counted_execute_command(*args, **options):
+            _count_redis_round_trip()
+            return execute_command(*args, **options)
+
+        def counted_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            def counted_execute(*args, **kwargs):
+                _count_redis_round_trip()
+                return execute(*args, **kwargs)
+
+            pipe.execute = counted_execute
+            return pipe
+
+    client.execute_command = counted_execute_command
+    client.pipeline = counted_pipeline
+
+
+def metrics_endpoint() -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
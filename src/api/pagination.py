@@ -0,0 +1,75 @@
+import json
+import base64
+import binascii
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, Response, status
+from pydantic import TypeAdapter
+from sqlalchemy import Select, tuple_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    payload = json.dumps([created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def select_fields(requested: Optional[str], model, default: Sequence[str]) -> List[str]:
+    """Columns to return: the requested subset, or the default set"""
+    if not requested:
+        return list(default)
+    fields = [field.strip() for field in requested.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def keyset_page(query: Select, created_at_column, id_column, cursor: Optional[str], limit: int) -> Select:
+    """Newest first, continuing after the cursor's (created_at, id)"""
+    if cursor:
+        query = query.where(tuple_(created_at_column, id_column) < decode_cursor(cursor))
+    # One extra row tells whether there is a next page
+    return query.order_by(created_at_column.desc(), id_column.desc()).limit(limit + 1)
+
+
+def page_response(rows, model, fields: List[str], limit: int) -> Response:
+    """Serialize row tuples straight to JSON, with the next page's cursor in X-Next-Cursor.
+
+    Rows carry the selected fields followed by the created_at and id the
+    cursor is built from. Models are built without validation and dumped by
+    pydantic-core, so FastAPI's own response validation is skipped.
+    """
+    rows = list(rows)
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        created_at, row_id = rows[-1][-2:]
+        headers["X-Next-Cursor"] = encode_cursor(created_at, row_id)
+    items = [model.model_construct(**dict(zip(fields, row))) for row in rows]
+    return Response(
+        content=_list_adapter(model).dump_json(items, exclude_unset=True),
+        media_type="application/json",
+        headers=headers
+    )
+
+
+_adapters = {}
+
+
+def _list_adapter(model) -> TypeAdapter:
+    if model not in _adapters:
+        _adapters[model] = TypeAdapter(List[model])
+    return _adapters[model]
@@ -0,0 +1,114 @@
+import os
+import time
+import asyncio
+from collections import Counter as Tally
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from src.api.auth import pwd_context
+from src.api.metrics import (
+    PASSWORD_HASH_QUEUE_DEPTH,
+    PASSWORD_HASH_REJECTED,
+    PASSWORD_HASH_SECONDS,
+    PASSWORD_HASH_WAIT_SECONDS
+)
+
+# Hashing pool configuration
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", os.cpu_count() or 1))  # bcrypt calls running at once
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", 64))  # Calls allowed to wait for a worker
+HASH_LIMIT_PER_IP = int(os.getenv("HASH_LIMIT_PER_IP", 4))  # Concurrent hashes per client address
+HASH_LIMIT_PER_USER = int(os.getenv("HASH_LIMIT_PER_USER", 1))  # Concurrent logins per username
+RETRY_AFTER_SECONDS = "1"
+
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded thread pool so logins never stall the event loop.
+
+    bcrypt releases the GIL, so HASH_WORKERS threads use that many cores.
+    Calls beyond the queue limit, or beyond a client's or user's share of
+    concurrent hashes, are turned away instead of queueing behind a burst.
+    """
+
+    def __init__(
+        self,
+        workers: int = HASH_WORKERS,
+        queue_limit: int = HASH_QUEUE_LIMIT,
+        per_ip: int = HASH_LIMIT_PER_IP,
+        per_user: int = HASH_LIMIT_PER_USER
+    ):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.capacity = workers + queue_limit
+        self.per_ip = per_ip
+        self.per_user = per_user
+        self.in_flight = 0
+        self.by_ip: Tally = Tally()
+        self.by_user: Tally = Tally()
+
+    @asynccontextmanager
+    async def _admit(self, ip: Optional[str], username: Optional[str]):
+        # Only the event loop thread touches the counters, so no lock is needed
+        if self.in_flight >= self.capacity:
+            self._reject("queue_full", status.HTTP_503_SERVICE_UNAVAILABLE)
+        if ip and self.by_ip[ip] >= self.per_ip:
+            self._reject("per_ip", status.HTTP_429_TOO_MANY_REQUESTS)
+        if username and self.by_user[username] >= self.per_user:
+            self._reject("per_user", status.HTTP_429_TOO_MANY_REQUESTS)
+
+        holders = [(tally, key) for tally, key in ((self.by_ip, ip), (self.by_user, username)) if key]
+        self.in_flight += 1
+        for tally, key in holders:
+            tally[key] += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            for tally, key in holders:
+                tally[key] -= 1
+                if tally[key] <= 0:
+                    del tally[key]
+
+    @staticmethod
+    def _reject(reason: str, status_code: int):
+        PASSWORD_HASH_REJECTED.labels(reason).inc()
+        raise HTTPException(
+            status_code=status_code,
+            detail="Too many login attempts in progress, retry shortly",
+            headers={"Retry-After": RETRY_AFTER_SECONDS},
+        )
+
+    async def _run(self, function, *args):
+        queued_at = time.perf_counter()
+        PASSWORD_HASH_QUEUE_DEPTH.inc()
+
+        def timed():
+            started = time.perf_counter()
+            PASSWORD_HASH_QUEUE_DEPTH.dec()
+            PASSWORD_HASH_WAIT_SECONDS.observe(started - queued_at)
+            try:
+                return function(*args)
+            finally:
+                PASSWORD_HASH_SECONDS.observe(time.perf_counter() - started)
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, timed)
+
+    async def hash(self, password: str, ip: Optional[str] = None) -> str:
+        async with self._admit(ip, None):
+            return await self._run(pwd_context.hash, password)
+
+    async def verify(
+        self,
+        password: str,
+        hashed_password: str,
+        ip: Optional[str] = None,
+        username: Optional[str] = None
+    ) -> Tuple[bool, Optional[str]]:
+        """Return (valid, new hash when the stored one uses an outdated cost)"""
+        async with self._admit(ip, username):
+            # Verifies and, if BCRYPT_ROUNDS changed, rehashes in the same worker call
+            return await self._run(pwd_context.verify_and_update, password, hashed_password)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
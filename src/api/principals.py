@@ -0,0 +1,134 @@
+import os
+import time
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from src.api.metrics import PRINCIPAL_CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# Principal cache configuration
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))  # Tokens kept per API process
+PRINCIPAL_LOCAL_TTL = float(os.getenv("PRINCIPAL_LOCAL_TTL", 5))  # Seconds a process trusts its own copy
+PRINCIPAL_REDIS_TTL = int(os.getenv("PRINCIPAL_REDIS_TTL", 300))  # Seconds a principal is shared in Redis
+
+
+class Principal(NamedTuple):
+    """What an authenticated request needs to know about its user"""
+    id: int
+    username: str
+    email: str
+
+    @classmethod
+    def from_user(cls, user) -> "Principal":
+        return cls(user.id, user.username, user.email)
+
+
+def principal_key(username: str) -> str:
+    return f"principal:{username}"
+
+
+def revoked_key(token_id: str) -> str:
+    return f"revoked_token:{token_id}"
+
+
+def token_id(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+class PrincipalCache:
+    """Two levels: a TTL-bounded LRU of verified tokens per process, then
+    principals by username shared through Redis.
+
+    A local hit skips JWT verification and every round trip. Revocations
+    and user changes reach other processes within PRINCIPAL_LOCAL_TTL.
+    """
+
+    def __init__(
+        self,
+        redis_client: Redis,
+        max_size: int = PRINCIPAL_CACHE_SIZE,
+        local_ttl: float = PRINCIPAL_LOCAL_TTL,
+        redis_ttl: int = PRINCIPAL_REDIS_TTL
+    ):
+        self.redis_client = redis_client
+        self.max_size = max_size
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        # Token id -> (expires at, principal), least recently used first
+        self.local: "OrderedDict[str, Tuple[float, Principal]]" = OrderedDict()
+
+    def get_local(self, token: str) -> Optional[Principal]:
+        key = token_id(token)
+        entry = self.local.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self.local[key]
+            PRINCIPAL_CACHE_REQUESTS.labels("local", "miss").inc()
+            return None
+        self.local.move_to_end(key)
+        PRINCIPAL_CACHE_REQUESTS.labels("local", "hit").inc()
+        return entry[1]
+
+    def put_local(self, token: str, principal: Principal, token_expires_at: float):
+        key = token_id(token)
+        self.local[key] = (min(time.time() + self.local_ttl, token_expires_at), principal)
+        self.local.move_to_end(key)
+        while len(self.local) > self.max_size:
+            self.local.popitem(last=False)
+
+    async def lookup(self, username: str, token: str) -> Tuple[Optional[Principal], bool]:
+        """Return (shared principal or None, token revoked) in one round trip"""
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.get(principal_key(username))
+            pipe.exists(revoked_key(token_id(token)))
+            cached, revoked = await pipe.execute()
+        except Exception as e:
+            # The database still answers, only revocations go unchecked meanwhile
+            logger.warning(f"Principal cache unavailable: {str(e)}")
+            return None, False
+        if cached is None:
+            PRINCIPAL_CACHE_REQUESTS.labels("redis", "miss").inc()
+            return None, bool(revoked)
+        PRINCIPAL_CACHE_REQUESTS.labels("redis", "hit").inc()
+        return Principal(*json.loads(cached)), bool(revoked)
+
+    async def store(self, principal: Principal):
+        try:
+            await self.redis_client.set(
+                principal_key(principal.username), json.dumps(list(principal)), ex=self.redis_ttl
+            )
+        except Exception as e:
+            logger.warning(f"Could not cache principal {principal.username}: {str(e)}")
+
+    async def invalidate_user(self, username: str):
+        """Call after writing a user row so that no process serves the old principal.
+
+        Other processes drop their local copies within PRINCIPAL_LOCAL_TTL.
+        """
+        for key, (_, principal) in list(self.local.items()):
+            if principal.username == username:
+                del self.local[key]
+        try:
+            await self.redis_client.delete(principal_key(username))
+        except Exception as e:
+            # The shared copy expires within PRINCIPAL_REDIS_TTL anyway
+            logger.warning(f"Could not invalidate principal {username}: {str(e)}")
+
+    async def revoke(self, token: str, token_expires_at: float):
+        self.local.pop(token_id(token), None)
+        # Kept only as long as the token itself would have been accepted
+        ttl = int(token_expires_at - time.time()) + 1
+        if ttl > 0:
+            try:
+                await self.redis_client.set(revoked_key(token_id(token)), 1, ex=ttl)
+            except RedisError as e:
+                # Other processes accept the token until it expires; ours no longer does
+                logger.warning(f"Could not revoke token: {str(e)}")
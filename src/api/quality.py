@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.models import QualityHour, QualityMinute, QualitySample
+from src.workers.quality import (
+    QUALITY_MINUTE_RETENTION_DAYS,
+    QUALITY_RAW_RETENTION_DAYS,
+    QUALITY_SAMPLE_INTERVAL
+)
+
+MAX_POINTS = 2000  # Upper bound on points per series
+RESOLUTIONS = {"raw": QUALITY_SAMPLE_INTERVAL, "1m": 60, "1h": 3600}  # Seconds per point
+
+
+def choose_resolution(since: datetime, until: datetime, max_points: int, now: Optional[datetime] = None) -> str:
+    """Finest resolution that both still exists for the range and fits max_points"""
+    now = now or datetime.now(timezone.utc)
+    span = (until - since).total_seconds()
+    age = now - since
+    if span / RESOLUTIONS["raw"] <= max_points and age <= timedelta(days=QUALITY_RAW_RETENTION_DAYS):
+        return "raw"
+    if span / RESOLUTIONS["1m"] <= max_points and age <= timedelta(days=QUALITY_MINUTE_RETENTION_DAYS):
+        return "1m"
+    return "1h"
+
+
+def series_query(stream_id: int, since: datetime, until: datetime, resolution: str, source: Optional[str]):
+    """Points as (t, source, bitrate, bitrate_min, bitrate_max, fps, fps_min, speed, dropped, duplicated)"""
+    if resolution == "raw":
+        table = QualitySample
+        columns = (
+            table.sampled_at, table.source,
+            table.bitrate_kbps, table.bitrate_kbps, table.bitrate_kbps,
+            table.fps, table.fps, table.speed,
+            table.dropped_frames, table.duplicated_frames
+        )
+        time_column = table.sampled_at
+    else:
+        table = QualityMinute if resolution == "1m" else QualityHour
+        columns = (
+            table.bucket, table.source,
+            table.bitrate_avg, table.bitrate_min, table.bitrate_max,
+            table.fps_avg, table.fps_min, table.speed_avg,
+            table.dropped_frames, table.duplicated_frames
+        )
+        time_column = table.bucket
+
+    # Served by each table's (stream_id, time, source) primary key; raw
+    # samples only touch the partitions of the days in range
+    query = select(*columns).where(
+        table.stream_id == stream_id, time_column >= since, time_column < until
+    )
+    if source:
+        query = query.where(table.source == source)
+    return query.order_by(time_column)
+
+
+async def quality_series(
+    db: AsyncSession,
+    stream_id: int,
+    since: datetime,
+    until: datetime,
+    resolution: str = "auto",
+    source: Optional[str] = None,
+    max_points: int = MAX_POINTS
+) -> dict:
+    if until <= since:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="until must be after since")
+    if resolution == "auto":
+        resolution = choose_resolution(since, until, max_points)
+    elif resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown resolution: {resolution}")
+
+    result = await db.execute(series_query(stream_id, since, until, resolution, source))
+    points: List[dict] = [
+        {
+            "t": t,
+            "source": point_source,
+            "bitrate_kbps": bitrate,
+            "bitrate_min": bitrate_min,
+            "bitrate_max": bitrate_max,
+            "fps": fps,
+            "fps_min": fps_min,
+            "speed": speed,
+            "dropped_frames": dropped,
+            "duplicated_frames": duplicated,
+        }
+        for t, point_source, bitrate, bitrate_min, bitrate_max, fps, fps_min, speed, dropped, duplicated
+        in result
+    ]
+    return {"stream_id": stream_id, "resolution": resolution, "points": points}
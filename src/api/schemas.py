@@ -0,0 +1,77 @@
+from datetime import datetime
+from typing import Any, List, Optional
+
+from pydantic import AwareDatetime, BaseModel, Field
+
+# Lean response models. Every field is optional so that sparse field
+# selection can leave columns out; rows are turned into models with
+# model_construct, skipping validation of data that came from our own tables.
+
+
+class ClassroomOut(BaseModel):
+    id: Optional[int] = None
+    name: Optional[str] = None
+    teacher_id: Optional[int] = None
+    rtmp_key: Optional[str] = None
+    status: Optional[str] = None
+    created_at: Optional[datetime] = None
+    last_active: Optional[datetime] = None
+    hls_ladder: Optional[List[str]] = None
+    hls_mode: Optional[str] = None
+
+
+class StreamOut(BaseModel):
+    id: Optional[int] = None
+    classroom_id: Optional[int] = None
+    stream_start: Optional[datetime] = None
+    stream_end: Optional[datetime] = None
+    stream_quality: Optional[Any] = None
+    viewer_count: Optional[int] = None
+    peak_viewers: Optional[int] = None
+    unique_viewers: Optional[int] = None
+    stream_status: Optional[str] = None
+    hls_url: Optional[str] = None
+    created_at: Optional[datetime] = None
+
+
+class LiveStreamOut(BaseModel):
+    """A stream as its worker runs it now, from the live_streams hash"""
+    stream_id: str
+    classroom_id: Optional[int] = None
+    worker: str
+    status: str
+    hls_url: Optional[str] = None
+    started_at: datetime
+
+
+# Agent telemetry. Unlike the models above it is external input, so it is validated.
+
+MAX_TELEMETRY_BATCH = 1000
+
+
+class QualitySampleIn(BaseModel):
+    sampled_at: AwareDatetime
+    bitrate_kbps: Optional[float] = Field(None, ge=0)
+    fps: Optional[float] = Field(None, ge=0)
+    speed: Optional[float] = Field(None, ge=0)
+    dropped_frames: Optional[int] = Field(None, ge=0)
+    duplicated_frames: Optional[int] = Field(None, ge=0)
+
+
+class TelemetryBatch(BaseModel):
+    samples: List[QualitySampleIn] = Field(max_length=MAX_TELEMETRY_BATCH)
+
+
+# Bulk classroom provisioning, validated like telemetry
+
+MAX_BULK_CLASSROOMS = 1000
+
+
+class ClassroomIn(BaseModel):
+    name: str = Field(min_length=1, max_length=100)  # classrooms.name is VARCHAR(100)
+    hls_ladder: Optional[List[str]] = None
+    hls_mode: str = "hls"
+
+
+class ClassroomBatch(BaseModel):
+    classrooms: List[ClassroomIn] = Field(min_length=1, max_length=MAX_BULK_CLASSROOMS)
@@ -0,0 +1,96 @@
+import io
+import json
+import hashlib
+import asyncio
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+from redis.asyncio import Redis
+
+from src.workers.hls import THUMBNAIL_HEIGHT, THUMBNAIL_WIDTH
+from src.workers.thumbnails import thumbnail_key
+
+# Sprite sheet configuration
+MAX_SPRITE_TILES = 100
+SPRITE_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp"}
+SPRITE_QUALITY = 70
+SPRITE_CACHE_SIZE = 64  # Sheets kept per API process; teachers refreshing the same grid share one
+
+
+class Tile(NamedTuple):
+    classroom_id: Optional[int]
+    stream_id: str
+    captured_at: int
+
+
+def sprite_etag(tiles: List[Tile], columns: int, image_format: str) -> str:
+    """Changes whenever any tile gets a newer thumbnail"""
+    key = f"{columns}|{image_format}|" + ",".join(f"{tile.stream_id}:{tile.captured_at}" for tile in tiles)
+    return f'"{hashlib.sha1(key.encode()).hexdigest()[:20]}"'
+
+
+def sprite_layout(tiles: List[Tile], columns: int) -> str:
+    """Where each tile is: tile i is at column i % columns, row i // columns"""
+    return json.dumps({
+        "columns": columns,
+        "tile_width": THUMBNAIL_WIDTH,
+        "tile_height": THUMBNAIL_HEIGHT,
+        "tiles": [tile._asdict() for tile in tiles],
+    }, separators=(",", ":"))
+
+
+async def latest_tiles(redis_client: Redis, streams: List[dict]) -> List[Tile]:
+    """Tiles of the streams that have a thumbnail, in the given order, in one round trip"""
+    pipe = redis_client.pipeline(transaction=False)
+    for stream in streams:
+        pipe.hget(thumbnail_key(stream["stream_id"]), "captured_at")
+    return [
+        Tile(stream.get("classroom_id"), stream["stream_id"], int(captured_at))
+        for stream, captured_at in zip(streams, await pipe.execute())
+        if captured_at is not None
+    ]
+
+
+def compose_sprite(images: List[Optional[bytes]], columns: int, image_format: str) -> bytes:
+    """Tile thumbnails row by row into one image; missing ones stay black"""
+    rows = (len(images) + columns - 1) // columns
+    sheet = Image.new("RGB", (min(columns, len(images)) * THUMBNAIL_WIDTH, rows * THUMBNAIL_HEIGHT))
+    for index, data in enumerate(images):
+        if not data:
+            continue  # Expired since the tiles were listed
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft("RGB", (THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT))
+            tile = image.convert("RGB")
+            if tile.size != (THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT):
+                # Taken by a worker configured differently
+                tile = tile.resize((THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT))
+            sheet.paste(tile, ((index % columns) * THUMBNAIL_WIDTH, (index // columns) * THUMBNAIL_HEIGHT))
+    output = io.BytesIO()
+    sheet.save(output, format=image_format.upper(), quality=SPRITE_QUALITY)
+    return output.getvalue()
+
+
+class SpriteCache:
+    """Recently composed sprite sheets by ETag"""
+
+    def __init__(self, size: int = SPRITE_CACHE_SIZE):
+        self.size = size
+        self.sheets: "OrderedDict[str, bytes]" = OrderedDict()
+
+    async def get(self, redis_client: Redis, tiles: List[Tile], columns: int, image_format: str) -> Tuple[str, bytes]:
+        etag = sprite_etag(tiles, columns, image_format)
+        sheet = self.sheets.get(etag)
+        if sheet is not None:
+            self.sheets.move_to_end(etag)
+            return etag, sheet
+        pipe = redis_client.pipeline(transaction=False)
+        for tile in tiles:
+            pipe.hget(thumbnail_key(tile.stream_id), "image")
+        images = await pipe.execute()
+        # Decoding and encoding take a few ms per tile, off the event loop
+        sheet = await asyncio.to_thread(compose_sprite, images, columns, image_format)
+        self.sheets[etag] = sheet
+        while len(self.sheets) > self.size:
+            self.sheets.popitem(last=False)
+        return etag, sheet
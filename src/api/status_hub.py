@@ -0,0 +1,143 @@
+import os
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Iterable, Optional, Set
+
+from fastapi import WebSocket, WebSocketDisconnect, status
+from redis.asyncio import Redis
+
+from src.api.metrics import WEBSOCKET_CLIENTS_DROPPED, WEBSOCKET_MESSAGES_COALESCED, WEBSOCKET_SUBSCRIBERS
+
+logger = logging.getLogger(__name__)
+
+STATUS_CHANNEL = "stream_status_updates"
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", 64))  # Distinct streams a client may lag behind on
+RECONNECT_DELAY = 1  # Seconds before resubscribing after a Redis error
+
+
+class Subscriber:
+    """One WebSocket's bounded backlog of status updates.
+
+    Updates are state, so a newer update for a stream replaces one the
+    client has not been sent yet. A client that falls behind on more than
+    WS_QUEUE_SIZE streams is disconnected.
+    """
+
+    def __init__(self, classroom_ids: Optional[Iterable[int]], max_pending: int = WS_QUEUE_SIZE):
+        self.classroom_ids: Optional[Set[int]] = set(classroom_ids) if classroom_ids else None
+        self.max_pending = max_pending
+        self.pending: "OrderedDict[str, str]" = OrderedDict()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+
+    def wants(self, update: dict) -> bool:
+        return self.classroom_ids is None or update.get("classroom_id") in self.classroom_ids
+
+    def offer(self, key: str, text: str):
+        if key in self.pending:
+            WEBSOCKET_MESSAGES_COALESCED.inc()
+            self.pending[key] = text
+        elif len(self.pending) >= self.max_pending:
+            self.overflowed = True
+        else:
+            self.pending[key] = text
+        self.ready.set()
+
+    async def forward(self, websocket: WebSocket):
+        """Send updates until the client disconnects or falls too far behind"""
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            if self.overflowed:
+                WEBSOCKET_CLIENTS_DROPPED.inc()
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                return
+            while self.pending:
+                _, text = self.pending.popitem(last=False)
+                await websocket.send_text(text)
+
+
+class StatusHub:
+    """Shares one Redis subscription among every status WebSocket of the process"""
+
+    def __init__(self, redis_client: Redis, channel: str = STATUS_CHANNEL):
+        self.redis_client = redis_client
+        self.channel = channel
+        self.subscribers: Set[Subscriber] = set()
+        self.task: Optional[asyncio.Task] = None
+
+    def subscribe(self, classroom_ids: Optional[Iterable[int]] = None) -> Subscriber:
+        # Started on first use so that the subscription lives on the serving loop
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._listen())
+        subscriber = Subscriber(classroom_ids)
+        self.subscribers.add(subscriber)
+        WEBSOCKET_SUBSCRIBERS.set(len(self.subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+        WEBSOCKET_SUBSCRIBERS.set(len(self.subscribers))
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def publish(self, text: str):
+        try:
+            update = json.loads(text)
+        except ValueError:
+            logger.warning(f"Ignoring malformed status update: {text[:200]}")
+            return
+        # Status changes and viewer counts of a stream coalesce separately
+        key = f"{update.get('stream_id')}:{update.get('type', 'status')}"
+        for subscriber in self.subscribers:
+            if subscriber.wants(update):
+                subscriber.offer(key, text)
+
+    async def _listen(self):
+        while True:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                # Blocks on the socket, so idle dashboards cost no CPU
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.publish(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Status subscription failed, resubscribing: {str(e)}")
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                await pubsub.aclose()
+
+
+async def serve_status(hub: StatusHub, websocket: WebSocket, classroom_ids: Optional[Iterable[int]] = None):
+    """Relay status updates to an accepted WebSocket until either side is done"""
+    subscriber = hub.subscribe(classroom_ids)
+    sender = asyncio.create_task(subscriber.forward(websocket))
+    # Reading is what notices a client that went away while nothing was sent
+    receiver = asyncio.create_task(_drain(websocket))
+    try:
+        await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        hub.unsubscribe(subscriber)
+        for task in (sender, receiver):
+            task.cancel()
+        await asyncio.gather(sender, receiver, return_exceptions=True)
+
+
+async def _drain(websocket: WebSocket):
+    try:
+        while True:
+            await websocket.receive_text()
+    except (WebSocketDisconnect, RuntimeError):
+        pass
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import hashlib
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from redis.asyncio import Redis
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from src.database.models import StreamMetadata
+from src.workers.lifecycle import LIVE_STREAMS_KEY
+
+logger = logging.getLogger(__name__)
+
+# Viewer counting configuration
+VIEWER_TIMEOUT = int(os.getenv("VIEWER_TIMEOUT", 30))  # Seconds without a request before a viewer has left
+VIEWER_FLUSH_INTERVAL = float(os.getenv("VIEWER_FLUSH_INTERVAL", 10))  # Seconds between database flushes
+VIEWER_BEACON_LIMIT = int(os.getenv("VIEWER_BEACON_LIMIT", 120))  # Heartbeats one address may send per VIEWER_TIMEOUT
+
+ACTIVE_STREAMS_KEY = "viewers:streams"  # Streams that had viewers since the last flush
+PEAKS_KEY = "viewers:peaks"  # Stream id -> peak concurrent viewers of the live session
+FLUSH_LOCK_KEY = "viewers:flush_lock"
+VIEWER_KEY_TTL = 24 * 3600  # Counters of a stream nobody watches expire after a day
+
+
+def active_key(stream_id: str) -> str:
+    # Sorted set of viewer ids scored by when they were last seen
+    return f"viewers:{stream_id}:active"
+
+
+def unique_key(stream_id: str) -> str:
+    # HyperLogLog of every viewer id of the stream
+    return f"viewers:{stream_id}:unique"
+
+
+def beacon_key(client_host: Optional[str]) -> str:
+    # Heartbeats sent from an address in the current VIEWER_TIMEOUT window
+    return f"viewers:beacons:{client_host}"
+
+
+def viewer_fingerprint(client_host: Optional[str], user_agent: Optional[str]) -> str:
+    """Viewer id for players that don't send one"""
+    return hashlib.sha1(f"{client_host}|{user_agent}".encode()).hexdigest()[:16]
+
+
+async def record_view(redis_client: Redis, stream_id: str, viewer_id: str, now: Optional[float] = None):
+    """Mark a viewer as watching, in one round trip"""
+    now = now or time.time()
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zadd(active_key(stream_id), {viewer_id: now})
+    pipe.pfadd(unique_key(stream_id), viewer_id)
+    pipe.expire(active_key(stream_id), VIEWER_KEY_TTL)
+    pipe.expire(unique_key(stream_id), VIEWER_KEY_TTL)
+    pipe.sadd(ACTIVE_STREAMS_KEY, stream_id)
+    await pipe.execute()
+
+
+async def check_beacon(redis_client: Redis, stream_id: str, client_host: Optional[str]) -> Tuple[bool, bool]:
+    """Return (stream is live, address is under its limit) for a player heartbeat, in one round trip.
+
+    Heartbeats are unauthenticated, so only live streams take them, and an
+    address, a whole classroom behind NAT included, may only send so many.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hexists(LIVE_STREAMS_KEY, stream_id)
+    pipe.set(beacon_key(client_host), 0, ex=VIEWER_TIMEOUT, nx=True)  # Starts the window
+    pipe.incr(beacon_key(client_host))
+    live, _, sent = await pipe.execute()
+    return bool(live), sent <= VIEWER_BEACON_LIMIT
+
+
+class ViewerThrottle:
+    """Skips recording a viewer again until a third of the timeout has passed.
+
+    Players reload playlists every second or faster; one Redis write per
+    viewer every few seconds is enough to keep them counted.
+    """
+
+    def __init__(self, interval: float = VIEWER_TIMEOUT / 3, max_size: int = 100000):
+        self.interval = interval
+        self.max_size = max_size
+        self.last_seen: Dict[tuple, float] = {}
+
+    def due(self, stream_id: str, viewer_id: str) -> bool:
+        now = time.monotonic()
+        key = (stream_id, viewer_id)
+        if now - self.last_seen.get(key, -self.interval) < self.interval:
+            return False
+        if len(self.last_seen) >= self.max_size:
+            cutoff = now - self.interval
+            self.last_seen = {k: seen for k, seen in self.last_seen.items() if seen >= cutoff}
+        self.last_seen[key] = now
+        return True
+
+
+class ViewerFlusher:
+    """Moves live viewer counts from Redis into stream_metadata in batches.
+
+    Every API process runs one, but a Redis lock lets only one of them
+    flush per interval. Each flush is a single executemany UPDATE, so a
+    popular lecture costs one row write per interval however many viewers
+    come and go.
+    """
+
+    def __init__(
+        self,
+        redis_client: Redis,
+        session_factory: async_sessionmaker,
+        interval: float = VIEWER_FLUSH_INTERVAL
+    ):
+        self.redis_client = redis_client
+        self.session_factory = session_factory
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # Expires a little early so the next interval's flusher can take over
+                if await self.redis_client.set(FLUSH_LOCK_KEY, 1, nx=True, px=int(self.interval * 900)):
+                    await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing viewer counts: {str(e)}")
+
+    async def flush(self):
+        stream_ids = sorted(await self.redis_client.smembers(ACTIVE_STREAMS_KEY))
+        if not stream_ids:
+            return
+        now = time.time()
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for stream_id in stream_ids:
+            pipe.zremrangebyscore(active_key(stream_id), "-inf", now - VIEWER_TIMEOUT)
+            pipe.zcard(active_key(stream_id))
+            pipe.pfcount(unique_key(stream_id))
+        pipe.hmget(PEAKS_KEY, stream_ids)
+        results = await pipe.execute()
+        peaks = results[-1]
+
+        counts = []
+        pipe = self.redis_client.pipeline(transaction=False)
+        for index, stream_id in enumerate(stream_ids):
+            _, current, unique = results[3 * index:3 * index + 3]
+            peak = max(current, int(peaks[index] or 0))
+            counts.append({"stream_id": stream_id, "current": current, "peak": peak, "unique": unique})
+            if current:
+                pipe.hset(PEAKS_KEY, stream_id, peak)
+            else:
+                # Everyone left; the database keeps the totals from this flush
+                pipe.srem(ACTIVE_STREAMS_KEY, stream_id)
+                pipe.hdel(PEAKS_KEY, stream_id)
+
+        classrooms = await self._write(counts)
+        for count in counts:
+            pipe.publish("stream_status_updates", json.dumps({
+                "stream_id": count["stream_id"],
+                "classroom_id": classrooms.get(count["stream_id"]),
+                "type": "viewers",
+                "viewer_count": count["current"],
+                "peak_viewers": count["peak"],
+                "unique_viewers": count["unique"],
+                "timestamp": datetime.utcnow().isoformat()
+            }))
+        await pipe.execute()
+
+    async def _write(self, counts) -> Dict[str, int]:
+        """Update every stream's row in one executemany; returns their classroom ids"""
+        # Stream ids are stream_metadata ids; anything else has no row to update
+        rows = [
+            {"row_id": int(count["stream_id"]), **count}
+            for count in counts if count["stream_id"].isdigit()
+        ]
+        if not rows:
+            return {}
+        # A Core statement, so that the parameter list runs as one executemany
+        table = StreamMetadata.__table__
+        statement = (
+            update(table)
+            .where(table.c.id == bindparam("row_id"))
+            .values(
+                viewer_count=bindparam("current"),
+                # Never lower a peak recorded before Redis was reset
+                peak_viewers=func.greatest(func.coalesce(table.c.peak_viewers, 0), bindparam("peak")),
+                unique_viewers=bindparam("unique")
+            )
+        )
+        async with self.session_factory() as db:
+            await db.execute(statement, rows)
+            await db.commit()
+            # Lets dashboards filtering by classroom receive the counts
+            result = await db.execute(
+                select(table.c.id, table.c.classroom_id).where(table.c.id.in_([row["row_id"] for row in rows]))
+            )
+            return {str(row_id): classroom_id for row_id, classroom_id in result}
@@ -1,6 +1,8 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 import os
 from dotenv import load_dotenv
 
@@ -12,10 +14,41 @@ POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "")
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
 POSTGRES_DB = os.getenv("POSTGRES_DB", "streaming_platform")
 
+# Connection pool configuration, per process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))  # Connections kept open
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))  # Extra connections allowed under bursts
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # Seconds before a connection is replaced
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"  # Check connections on checkout
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 500))  # Prepared statements per connection
+
 DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}"
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}/{POSTGRES_DB}"
+
+pool_options = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+}
+
+# Async engine used by the API
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    # asyncpg prepares every statement; set to 0 behind pgbouncer in transaction mode
+    connect_args={"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE},
+    **pool_options
+)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False  # Returned objects must not lazy load after commit
+)
 
-# Create PostgreSQL engine
-engine = create_engine(DATABASE_URL)
+# Synchronous engine for scripts and the workers
+engine = create_engine(DATABASE_URL, **pool_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Redis configuration
@@ -31,8 +64,28 @@ redis_client = Redis(
     decode_responses=True
 )
 
+# Asyncio Redis client for long-lived subscriptions in the API
+async_redis_client = AsyncRedis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB,
+    decode_responses=True
+)
+
+# Asyncio Redis client returning bytes, for binary values such as thumbnails
+async_redis_binary_client = AsyncRedis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB
+)
+
 # Database dependency
-def get_db():
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Synchronous session for scripts
+def get_sync_db():
     db = SessionLocal()
     try:
         yield db
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, JSON, REAL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -27,21 +27,83 @@ class Classroom(Base):
     status = Column(String, default="inactive")
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
     last_active = Column(DateTime(timezone=True))
+    hls_ladder = Column(JSON)  # Rendition names for adaptive HLS, null for a single rendition
+    hls_mode = Column(String, default="hls")  # "hls", or "llhls" for Low-Latency HLS
 
     teacher = relationship("User", back_populates="classrooms")
     stream_metadata = relationship("StreamMetadata", back_populates="classroom")
 
+    # Keyset pagination, see schema.sql
+    __table_args__ = (
+        Index("idx_classrooms_teacher_created", "teacher_id", created_at.desc(), id.desc()),
+        Index("idx_classrooms_teacher_status_created", "teacher_id", "status", created_at.desc(), id.desc()),
+    )
+
 class StreamMetadata(Base):
     __tablename__ = "stream_metadata"
 
     id = Column(Integer, primary_key=True, index=True)
     classroom_id = Column(Integer, ForeignKey("classrooms.id"))
+    teacher_id = Column(Integer, ForeignKey("users.id"))  # The classroom's, so a teacher's streams page on one index
     stream_start = Column(DateTime(timezone=True))
     stream_end = Column(DateTime(timezone=True))
     stream_quality = Column(JSON)
-    viewer_count = Column(Integer, default=0)
+    viewer_count = Column(Integer, default=0)  # Concurrent viewers, flushed from Redis
+    peak_viewers = Column(Integer, default=0)
+    unique_viewers = Column(Integer, default=0)
     stream_status = Column(String)
     hls_url = Column(String)
+    status_updated_at = Column(DateTime(timezone=True))  # Time of the last lifecycle transition written
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
 
     classroom = relationship("Classroom", back_populates="stream_metadata")
+
+    # Keyset pagination, see schema.sql
+    __table_args__ = (
+        Index("idx_stream_metadata_classroom_created", "classroom_id", created_at.desc(), id.desc()),
+        Index(
+            "idx_stream_metadata_classroom_status_created",
+            "classroom_id", "stream_status", created_at.desc(), id.desc()
+        ),
+        Index("idx_stream_metadata_teacher_created", "teacher_id", created_at.desc(), id.desc()),
+        Index(
+            "idx_stream_metadata_teacher_status_created",
+            "teacher_id", "stream_status", created_at.desc(), id.desc()
+        ),
+    )
+
+class QualitySample(Base):
+    """Append-only telemetry, partitioned by day; see schema.sql for retention"""
+    __tablename__ = "stream_quality_samples"
+
+    stream_id = Column(Integer, primary_key=True)
+    sampled_at = Column(DateTime(timezone=True), primary_key=True)
+    source = Column(String(8), primary_key=True)  # "worker" or "agent"
+    bitrate_kbps = Column(REAL)
+    fps = Column(REAL)
+    speed = Column(REAL)
+    dropped_frames = Column(Integer)  # Since the previous sample
+    duplicated_frames = Column(Integer)
+
+    __table_args__ = {"postgresql_partition_by": "RANGE (sampled_at)"}
+
+class QualityRollup:
+    stream_id = Column(Integer, primary_key=True)
+    bucket = Column(DateTime(timezone=True), primary_key=True)
+    source = Column(String(8), primary_key=True)
+    samples = Column(Integer)
+    bitrate_avg = Column(REAL)
+    bitrate_min = Column(REAL)
+    bitrate_max = Column(REAL)
+    fps_avg = Column(REAL)
+    fps_min = Column(REAL)
+    speed_avg = Column(REAL)
+    speed_min = Column(REAL)
+    dropped_frames = Column(Integer)
+    duplicated_frames = Column(Integer)
+
+class QualityMinute(QualityRollup, Base):
+    __tablename__ = "stream_quality_1m"
+
+class QualityHour(QualityRollup, Base):
+    __tablename__ = "stream_quality_1h"
@@ -16,24 +16,162 @@ CREATE TABLE classrooms (
     rtmp_key VARCHAR(100) UNIQUE NOT NULL,
     status VARCHAR(20) DEFAULT 'inactive',
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-    last_active TIMESTAMP WITH TIME ZONE
+    last_active TIMESTAMP WITH TIME ZONE,
+    hls_ladder JSON,
+    hls_mode VARCHAR(10) DEFAULT 'hls'
 );
 
 -- Create stream_metadata table
 CREATE TABLE stream_metadata (
     id SERIAL PRIMARY KEY,
     classroom_id INTEGER REFERENCES classrooms(id),
+    teacher_id INTEGER REFERENCES users(id),  -- The classroom's; classrooms never change teacher
     stream_start TIMESTAMP WITH TIME ZONE,
     stream_end TIMESTAMP WITH TIME ZONE,
     stream_quality JSON,
     viewer_count INTEGER DEFAULT 0,
+    peak_viewers INTEGER DEFAULT 0,
+    unique_viewers INTEGER DEFAULT 0,
     stream_status VARCHAR(20),
     hls_url VARCHAR(255),
+    status_updated_at TIMESTAMP WITH TIME ZONE,  -- Orders the worker's lifecycle writes
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Create indices for better query performance
 CREATE INDEX idx_users_username ON users(username);
-CREATE INDEX idx_classrooms_teacher ON classrooms(teacher_id);
-CREATE INDEX idx_stream_metadata_classroom ON stream_metadata(classroom_id);
 CREATE INDEX idx_classrooms_status ON classrooms(status);
+
+-- Keyset pagination, newest first; the leading columns also serve plain lookups
+CREATE INDEX idx_classrooms_teacher_created ON classrooms(teacher_id, created_at DESC, id DESC);
+CREATE INDEX idx_classrooms_teacher_status_created ON classrooms(teacher_id, status, created_at DESC, id DESC);
+CREATE INDEX idx_stream_metadata_classroom_created ON stream_metadata(classroom_id, created_at DESC, id DESC);
+CREATE INDEX idx_stream_metadata_classroom_status_created
+    ON stream_metadata(classroom_id, stream_status, created_at DESC, id DESC);
+-- A teacher's streams across all classrooms, without merging per-classroom index scans
+CREATE INDEX idx_stream_metadata_teacher_created ON stream_metadata(teacher_id, created_at DESC, id DESC);
+CREATE INDEX idx_stream_metadata_teacher_status_created
+    ON stream_metadata(teacher_id, stream_status, created_at DESC, id DESC);
+
+-- Stream quality samples: append-only, one partition per UTC day so that
+-- retention drops whole partitions instead of deleting rows
+CREATE TABLE stream_quality_samples (
+    stream_id INTEGER NOT NULL,
+    sampled_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    source VARCHAR(8) NOT NULL,  -- 'worker' or 'agent'
+    bitrate_kbps REAL,
+    fps REAL,
+    speed REAL,
+    dropped_frames INTEGER,  -- Since the previous sample
+    duplicated_frames INTEGER,
+    -- Also makes resent samples no-ops
+    PRIMARY KEY (stream_id, sampled_at, source)
+) PARTITION BY RANGE (sampled_at);
+
+-- Roll-ups, kept long after the raw samples are gone
+CREATE TABLE stream_quality_1m (
+    stream_id INTEGER NOT NULL,
+    bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+    source VARCHAR(8) NOT NULL,
+    samples INTEGER NOT NULL,
+    bitrate_avg REAL,
+    bitrate_min REAL,
+    bitrate_max REAL,
+    fps_avg REAL,
+    fps_min REAL,
+    speed_avg REAL,
+    speed_min REAL,
+    dropped_frames INTEGER,
+    duplicated_frames INTEGER,
+    PRIMARY KEY (stream_id, bucket, source)
+);
+CREATE TABLE stream_quality_1h (LIKE stream_quality_1m INCLUDING ALL);
+
+-- Creates the daily partitions from today up to days_ahead
+CREATE FUNCTION create_quality_partitions(days_ahead INTEGER) RETURNS VOID AS $$
+DECLARE
+    day DATE;
+BEGIN
+    FOR day IN
+        SELECT (now() AT TIME ZONE 'UTC')::date + generate_series(0, days_ahead)
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF stream_quality_samples FOR VALUES FROM (%L) TO (%L)',
+            'stream_quality_samples_' || to_char(day, 'YYYYMMDD'),
+            day::timestamp AT TIME ZONE 'UTC',
+            (day + 1)::timestamp AT TIME ZONE 'UTC'
+        );
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Drops the partitions of days older than keep_days; returns how many
+CREATE FUNCTION drop_quality_partitions(keep_days INTEGER) RETURNS INTEGER AS $$
+DECLARE
+    partition_name TEXT;
+    dropped INTEGER := 0;
+BEGIN
+    FOR partition_name IN
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = 'stream_quality_samples'::regclass
+        -- Names end in YYYYMMDD, so they sort by day
+        AND child.relname < 'stream_quality_samples_' || to_char((now() AT TIME ZONE 'UTC')::date - keep_days, 'YYYYMMDD')
+    LOOP
+        EXECUTE format('DROP TABLE %I', partition_name);
+        dropped := dropped + 1;
+    END LOOP;
+    RETURN dropped;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Recomputes the roll-up buckets from since onwards; safe to rerun
+CREATE FUNCTION rollup_stream_quality(since TIMESTAMP WITH TIME ZONE) RETURNS VOID AS $$
+BEGIN
+    INSERT INTO stream_quality_1m
+    SELECT
+        stream_id, date_trunc('minute', sampled_at, 'UTC'), source, count(*),
+        avg(bitrate_kbps), min(bitrate_kbps), max(bitrate_kbps),
+        avg(fps), min(fps), avg(speed), min(speed),
+        sum(dropped_frames), sum(duplicated_frames)
+    FROM stream_quality_samples
+    WHERE sampled_at >= date_trunc('minute', since, 'UTC')
+    GROUP BY 1, 2, 3
+    ON CONFLICT (stream_id, bucket, source) DO UPDATE SET
+        samples = EXCLUDED.samples,
+        bitrate_avg = EXCLUDED.bitrate_avg,
+        bitrate_min = EXCLUDED.bitrate_min,
+        bitrate_max = EXCLUDED.bitrate_max,
+        fps_avg = EXCLUDED.fps_avg,
+        fps_min = EXCLUDED.fps_min,
+        speed_avg = EXCLUDED.speed_avg,
+        speed_min = EXCLUDED.speed_min,
+        dropped_frames = EXCLUDED.dropped_frames,
+        duplicated_frames = EXCLUDED.duplicated_frames;
+
+    -- Averages weighted by the samples behind each minute
+    INSERT INTO stream_quality_1h
+    SELECT
+        stream_id, date_trunc('hour', bucket, 'UTC'), source, sum(samples),
+        sum(bitrate_avg * samples) / sum(samples), min(bitrate_min), max(bitrate_max),
+        sum(fps_avg * samples) / sum(samples), min(fps_min),
+        sum(speed_avg * samples) / sum(samples), min(speed_min),
+        sum(dropped_frames), sum(duplicated_frames)
+    FROM stream_quality_1m
+    WHERE bucket >= date_trunc('hour', since, 'UTC')
+    GROUP BY 1, 2, 3
+    ON CONFLICT (stream_id, bucket, source) DO UPDATE SET
+        samples = EXCLUDED.samples,
+        bitrate_avg = EXCLUDED.bitrate_avg,
+        bitrate_min = EXCLUDED.bitrate_min,
+        bitrate_max = EXCLUDED.bitrate_max,
+        fps_avg = EXCLUDED.fps_avg,
+        fps_min = EXCLUDED.fps_min,
+        speed_avg = EXCLUDED.speed_avg,
+        speed_min = EXCLUDED.speed_min,
+        dropped_frames = EXCLUDED.dropped_frames,
+        duplicated_frames = EXCLUDED.duplicated_frames;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_quality_partitions(7);
@@ -0,0 +1,16 @@
+-- Upgrades a database created from an older schema.sql; safe to run more than once.
+-- Each statement commits on its own, so run it with psql outside a transaction.
+
+-- A teacher's streams page on teacher_id; see schema.sql
+ALTER TABLE stream_metadata ADD COLUMN IF NOT EXISTS teacher_id INTEGER REFERENCES users(id);
+
+-- Streams created before the column existed; classrooms never change teacher
+UPDATE stream_metadata s
+SET teacher_id = c.teacher_id
+FROM classrooms c
+WHERE c.id = s.classroom_id AND s.teacher_id IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stream_metadata_teacher_created
+    ON stream_metadata(teacher_id, created_at DESC, id DESC);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stream_metadata_teacher_status_created
+    ON stream_metadata(teacher_id, stream_status, created_at DESC, id DESC);
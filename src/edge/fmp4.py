@@ -0,0 +1,153 @@
+import struct
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Tuple
+
+# Containers we descend into while looking for timing boxes
+CONTAINER_BOXES = {"moov", "trak", "mdia", "moof", "traf", "mvex"}
+
+
+class Part(NamedTuple):
+    offset: int
+    length: int
+    duration: float
+    independent: bool
+
+
+def iter_boxes(data: bytes, offset: int = 0, end: Optional[int] = None) -> Iterator[Tuple[str, int, int, int]]:
+    """Yield (type, offset, size, header size) for the boxes in data[offset:end]"""
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield box_type.decode("latin-1"), offset, size, header
+        offset += size
+
+
+def find_box(data: bytes, path: List[str], offset: int = 0, end: Optional[int] = None) -> Optional[Tuple[int, int, int]]:
+    """Return (offset, size, header size) of the first box at the given path"""
+    for box_type, box_offset, size, header in iter_boxes(data, offset, end):
+        if box_type != path[0]:
+            continue
+        if len(path) == 1:
+            return box_offset, size, header
+        if box_type in CONTAINER_BOXES:
+            found = find_box(data, path[1:], box_offset + header, box_offset + size)
+            if found:
+                return found
+    return None
+
+
+def read_timescale(init_segment: bytes) -> int:
+    """Media timescale from the mdhd box of an init segment"""
+    found = find_box(init_segment, ["moov", "trak", "mdia", "mdhd"])
+    if not found:
+        raise ValueError("init segment has no mdhd box")
+    offset, _, header = found
+    version = init_segment[offset + header]
+    # version/flags, then creation and modification times of 4 or 8 bytes each
+    timescale_offset = offset + header + 4 + (16 if version == 1 else 8)
+    return struct.unpack_from(">I", init_segment, timescale_offset)[0]
+
+
+def fragment_info(moof: bytes) -> Tuple[int, bool]:
+    """Return (duration in timescale units, starts with a sync sample) of a moof"""
+    traf = find_box(moof, ["moof", "traf"])
+    if not traf:
+        return 0, False
+    traf_offset, traf_size, traf_header = traf
+    traf_end = traf_offset + traf_size
+
+    default_duration = 0
+    default_flags = 0
+    tfhd = find_box(moof, ["tfhd"], traf_offset + traf_header, traf_end)
+    if tfhd:
+        offset, _, header = tfhd
+        flags = struct.unpack_from(">I", moof, offset + header)[0] & 0xFFFFFF
+        cursor = offset + header + 8  # version/flags and track_ID
+        if flags & 0x01:
+            cursor += 8  # base_data_offset
+        if flags & 0x02:
+            cursor += 4  # sample_description_index
+        if flags & 0x08:
+            default_duration = struct.unpack_from(">I", moof, cursor)[0]
+            cursor += 4
+        if flags & 0x10:
+            cursor += 4  # default_sample_size
+        if flags & 0x20:
+            default_flags = struct.unpack_from(">I", moof, cursor)[0]
+
+    trun = find_box(moof, ["trun"], traf_offset + traf_header, traf_end)
+    if not trun:
+        return 0, False
+    offset, _, header = trun
+    flags = struct.unpack_from(">I", moof, offset + header)[0] & 0xFFFFFF
+    sample_count = struct.unpack_from(">I", moof, offset + header + 4)[0]
+    cursor = offset + header + 8
+    if flags & 0x01:
+        cursor += 4  # data_offset
+    first_flags = default_flags
+    if flags & 0x04:
+        first_flags = struct.unpack_from(">I", moof, cursor)[0]
+        cursor += 4
+
+    duration = 0
+    for index in range(sample_count):
+        if flags & 0x100:
+            duration += struct.unpack_from(">I", moof, cursor)[0]
+            cursor += 4
+        else:
+            duration += default_duration
+        if flags & 0x200:
+            cursor += 4  # sample_size
+        if flags & 0x400:
+            if index == 0 and not flags & 0x04:
+                first_flags = struct.unpack_from(">I", moof, cursor)[0]
+            cursor += 4
+        if flags & 0x800:
+            cursor += 4  # composition time offset
+
+    # sample_is_non_sync_sample is bit 16 of the sample flags
+    return duration, not first_flags & 0x10000
+
+
+class FragmentScanner:
+    """Incrementally finds complete moof+mdat fragments in a growing segment file"""
+
+    def __init__(self, timescale: int):
+        self.timescale = timescale
+        self.parts: List[Part] = []
+        self.scanned = 0  # Offset just past the last complete fragment
+
+    def scan(self, f: BinaryIO, file_size: int) -> List[Part]:
+        offset = self.scanned
+        moof = None
+        part_start = self.scanned
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            size, box_type = struct.unpack_from(">I4s", header)
+            if size == 1:
+                size = struct.unpack_from(">Q", header, 8)[0]
+            if size < 8 or offset + size > file_size:
+                break  # Box still being written
+
+            box_type = box_type.decode("latin-1")
+            if box_type == "moof":
+                f.seek(offset)
+                moof = f.read(size)
+            elif box_type == "mdat" and moof is not None:
+                duration, independent = fragment_info(moof)
+                end = offset + size
+                self.parts.append(Part(
+                    part_start, end - part_start, duration / self.timescale, independent
+                ))
+                self.scanned = part_start = end
+                moof = None
+            offset += size
+        return self.parts
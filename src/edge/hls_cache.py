@@ -0,0 +1,273 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Set, Tuple
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from redis.asyncio import Redis
+
+from src.api.viewers import ViewerThrottle, record_view, viewer_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Edge cache configuration
+HLS_ROOT = os.getenv("HLS_OUTPUT_DIR", "/var/www/streaming/hls")
+HLS_CACHE_BYTES = int(os.getenv("HLS_CACHE_MB", 1024)) * 2**20  # Segment bytes held in memory
+PLAYLIST_CHECK_INTERVAL = float(os.getenv("PLAYLIST_CHECK_INTERVAL", 0.2))  # Seconds a playlist is served unchecked
+PLAYLIST_MAX_AGE = 1  # Seconds players and CDNs may reuse a live playlist, half a segment
+MEDIA_PLAYLIST = "playlist.m3u8"  # Written by ffmpeg in every stream or rendition directory
+
+# Redis configuration, for viewer counting
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+
+SAFE_NAME = re.compile(r"^[\w.-]+$")
+RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+MEDIA_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+    ".m4s": "video/iso.segment",
+    ".mp4": "video/mp4",
+    # Stream previews, see src/workers/thumbnails.py
+    ".jpg": "image/jpeg",
+    ".webp": "image/webp",
+    ".json": "application/json",
+}
+
+# Built once; every response of a kind carries the same headers
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Expose-Headers": "Content-Length,Content-Range",
+}
+PLAYLIST_HEADERS = {**CORS_HEADERS, "Cache-Control": f"max-age={PLAYLIST_MAX_AGE}"}
+# Segment names are never reused: ffmpeg numbers them from its start time
+# (hls_start_number_source epoch), so a restart in the same directory
+# continues with new names
+SEGMENT_HEADERS = {**CORS_HEADERS, "Cache-Control": "public, max-age=86400, immutable", "Accept-Ranges": "bytes"}
+UNLISTED_HEADERS = {**CORS_HEADERS, "Cache-Control": "no-cache", "Accept-Ranges": "bytes"}
+
+
+class CachedFile(NamedTuple):
+    data: bytes
+    etag: str
+
+
+class CachedPlaylist(NamedTuple):
+    file: CachedFile
+    version: Tuple[int, int]  # (mtime ns, size) it was read at
+    media_sequence: int
+    segments: Set[str]  # Segment URIs in the window
+    checked_at: float
+
+
+def _etag(stat: os.stat_result) -> str:
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def _read(path: str) -> Tuple[bytes, os.stat_result]:
+    with open(path, "rb") as f:
+        return f.read(), os.fstat(f.fileno())
+
+
+def parse_window(body: bytes) -> Tuple[int, Set[str]]:
+    """Return (media sequence, segment URIs) of a media playlist"""
+    media_sequence = 0
+    segments = set()
+    for line in body.decode(errors="replace").splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            media_sequence = int(line.split(":", 1)[1])
+        elif line and not line.startswith("#"):
+            segments.add(line)
+    return media_sequence, segments
+
+
+def byte_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive (start, end) of a single Range header; None serves the whole file"""
+    match = RANGE_HEADER.match(header.strip()) if header else None
+    if not match or match.groups() == ("", ""):
+        return None  # Absent, or a form we do not support, e.g. multiple ranges
+    first, last = match.groups()
+    if not first:
+        start, end = max(0, size - int(last)), size - 1  # The last n bytes
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, headers={**CORS_HEADERS, "Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+class HLSCache:
+    """The live window of every stream, served from memory.
+
+    Playlists are checked at most every PLAYLIST_CHECK_INTERVAL and only read
+    again when ffmpeg has rewritten them. Segments are read once, on the
+    first request, and stay until they leave their playlist's window or the
+    cache runs out of room. Concurrent misses for the same file share one
+    read, so however many viewers watch, each segment costs one disk read.
+    """
+
+    def __init__(self, root: str = HLS_ROOT, max_bytes: int = HLS_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.playlists: Dict[str, CachedPlaylist] = {}
+        self.segments: "OrderedDict[str, CachedFile]" = OrderedDict()  # Least recently used first
+        self.size = 0
+        self.disk_reads = 0
+        self._loading: Dict[str, asyncio.Future] = {}
+
+    async def _once(self, key: str, load: Callable[[], Awaitable]):
+        """Run load for key unless it is already running, and share its result"""
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.ensure_future(load())
+            task.add_done_callback(lambda _: self._loading.pop(key, None))
+        # A client going away must not cancel the read other clients wait for
+        return await asyncio.shield(task)
+
+    async def playlist(self, path: str) -> CachedPlaylist:
+        cached = self.playlists.get(path)
+        if cached and time.monotonic() - cached.checked_at < PLAYLIST_CHECK_INTERVAL:
+            return cached
+        return await self._once(path, lambda: self._refresh_playlist(path))
+
+    async def _refresh_playlist(self, path: str) -> CachedPlaylist:
+        cached = self.playlists.get(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._forget_playlist(path)
+            raise
+        if cached and (stat.st_mtime_ns, stat.st_size) == cached.version:
+            cached = self.playlists[path] = cached._replace(checked_at=time.monotonic())
+            return cached
+
+        data, stat = await asyncio.to_thread(_read, path)
+        self.disk_reads += 1
+        media_sequence, segments = parse_window(data)
+        playlist = CachedPlaylist(
+            CachedFile(data, _etag(stat)), (stat.st_mtime_ns, stat.st_size),
+            media_sequence, segments, time.monotonic()
+        )
+        directory = os.path.dirname(path)
+        if cached and media_sequence < cached.media_sequence:
+            # Numbering went backwards, e.g. a stream restarted by an older
+            # worker that numbered segments from 0; nothing cached is current
+            self._evict(directory, set())
+        else:
+            self._evict(directory, segments)
+        self.playlists[path] = playlist
+        return playlist
+
+    def _forget_playlist(self, path: str):
+        if self.playlists.pop(path, None):
+            self._evict(os.path.dirname(path), set())
+
+    def _evict(self, directory: str, keep: Set[str]):
+        """Drop a directory's cached segments that are not in keep"""
+        prefix = directory + os.sep
+        for path in [path for path in self.segments if path.startswith(prefix)]:
+            if path[len(prefix):] not in keep:
+                self.size -= len(self.segments.pop(path).data)
+
+    async def segment(self, path: str) -> Optional[CachedFile]:
+        """A segment of a live window, or None if its playlist does not list it"""
+        cached = self.segments.get(path)
+        if cached:
+            self.segments.move_to_end(path)
+            return cached
+        directory, name = os.path.split(path)
+        try:
+            playlist = await self.playlist(os.path.join(directory, MEDIA_PLAYLIST))
+        except FileNotFoundError:
+            return None
+        if name not in playlist.segments:
+            # Still being written, or already gone; never cache a partial file
+            return None
+        return await self._once(path, lambda: self._load_segment(path))
+
+    async def _load_segment(self, path: str) -> CachedFile:
+        data, stat = await asyncio.to_thread(_read, path)
+        self.disk_reads += 1
+        cached = CachedFile(data, _etag(stat))
+        if len(data) <= self.max_bytes:
+            self.segments[path] = cached
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.segments.popitem(last=False)
+                self.size -= len(evicted.data)
+        return cached
+
+
+router = APIRouter()
+cache = HLSCache()
+# Shared with the LL-HLS routes, so a viewer is counted the same on both
+redis_client = Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+view_throttle = ViewerThrottle()
+
+
+async def count_viewer(stream_id: str, request: Request):
+    viewer_id = viewer_fingerprint(request.client.host if request.client else None, request.headers.get("user-agent"))
+    if not view_throttle.due(stream_id, viewer_id):
+        return
+    try:
+        await record_view(redis_client, stream_id, viewer_id)
+    except Exception as e:
+        # Counting viewers must never get in the way of serving them
+        logger.warning(f"Could not record viewer of {stream_id}: {str(e)}")
+
+
+def _respond(request: Request, cached: CachedFile, media_type: str, headers: Dict[str, str]) -> Response:
+    headers = {**headers, "ETag": cached.etag}
+    if request.headers.get("if-none-match") == cached.etag:
+        return Response(status_code=304, headers=headers)
+    size = len(cached.data)
+    requested = byte_range(request.headers.get("range"), size)
+    if requested is None:
+        return Response(cached.data, media_type=media_type, headers=headers)
+    start, end = requested
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return Response(cached.data[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+
+
+async def serve_file(request: Request, *names: str) -> Response:
+    if not all(SAFE_NAME.match(name) and name not in (".", "..") for name in names):
+        raise HTTPException(status_code=404)
+    path = os.path.join(cache.root, *names)
+    extension = os.path.splitext(path)[1]
+    media_type = MEDIA_TYPES.get(extension, "application/octet-stream")
+
+    if extension == ".m3u8":
+        try:
+            playlist = await cache.playlist(path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404)
+        # Players reload their media playlist every few seconds, which keeps
+        # them counted; the throttle makes that one write per viewer
+        await count_viewer(names[0], request)
+        return _respond(request, playlist.file, media_type, PLAYLIST_HEADERS)
+
+    cached = await cache.segment(path)
+    if cached:
+        return _respond(request, cached, media_type, SEGMENT_HEADERS)
+    try:
+        data, stat = await asyncio.to_thread(_read, path)
+    except (FileNotFoundError, IsADirectoryError):
+        raise HTTPException(status_code=404)
+    return _respond(request, CachedFile(data, _etag(stat)), media_type, UNLISTED_HEADERS)
+
+
+@router.get("/hls/{stream_id}/{name}")
+async def serve_stream_file(stream_id: str, name: str, request: Request):
+    return await serve_file(request, stream_id, name)
+
+
+@router.get("/hls/{stream_id}/{rendition}/{name}")
+async def serve_rendition_file(stream_id: str, rendition: str, name: str, request: Request):
+    """ABR renditions live in a directory each"""
+    return await serve_file(request, stream_id, rendition, name)
@@ -0,0 +1,393 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+
+from src.api.metrics import MetricsMiddleware, instrument_redis, metrics_endpoint
+from src.edge.fmp4 import FragmentScanner, Part, read_timescale
+from src.edge.hls_cache import count_viewer, redis_client, router as hls_router
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# LL-HLS configuration
+HLS_ROOT = os.getenv("HLS_OUTPUT_DIR", "/var/www/streaming/hls")
+LLHLS_PART_TARGET = float(os.getenv("LLHLS_PART_TARGET", 0.5))  # Must match the worker's fragment duration
+PARTS_WINDOW_SEGMENTS = 3  # Segments at the live edge that keep listing their parts
+POLL_INTERVAL = 0.05  # Seconds between checks while requests are blocked
+LLHLS_VIDEO_PLAYLIST = "media_0.m3u8"  # Every player loads it, so it is where viewers are counted
+
+SAFE_NAME = re.compile(r"^[\w.-]+$")
+SEGMENT_NUMBER = re.compile(r"(\d+)(\.\w+)$")
+RANGE_HEADER = re.compile(r"^bytes=(\d+)-(\d*)$")
+CORS_HEADERS = {"Access-Control-Allow-Origin": "*"}
+
+
+class Segment:
+    def __init__(self, uri: str, duration: float, program_date_time: Optional[str]):
+        self.uri = uri
+        self.duration = duration
+        self.program_date_time = program_date_time
+        self.parts: List[Part] = []
+
+
+def next_segment_uri(uri: str) -> Optional[str]:
+    match = SEGMENT_NUMBER.search(uri)
+    if not match:
+        return None
+    number = match.group(1)
+    return f"{uri[:match.start()]}{int(number) + 1:0{len(number)}d}{match.group(2)}"
+
+
+class PlaylistWatcher:
+    """Tracks one ffmpeg media playlist and the parts of its segments.
+
+    ffmpeg's dash muxer writes each segment to `<uri>.tmp` as a series of
+    moof/mdat fragments and renames it once complete. Every complete fragment
+    is exposed as an LL-HLS part addressed by byte range into the final
+    segment URI, and the segment being written is advertised as a preload
+    hint. All blocked requests for a playlist share one poller.
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.directory = directory
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self.media_sequence = 0
+        self.target_duration = 2
+        self.map_uri: Optional[str] = None
+        self.timescale: Optional[int] = None
+        self.segments: List[Segment] = []
+        self.pending_uri: Optional[str] = None
+        self.pending_parts: List[Part] = []
+        self.last_used = time.monotonic()
+        self._scanners: Dict[str, FragmentScanner] = {}
+        self._playlist_mtime = 0.0
+        self._timescale_uri: Optional[str] = None
+        self._pending_size = -1
+        self._condition = asyncio.Condition()
+        self._waiters = 0
+        self._poller: Optional[asyncio.Task] = None
+
+    @property
+    def last_msn(self) -> int:
+        return self.media_sequence + len(self.segments) - 1
+
+    def _scan(self, uri: str, path: str, size: int) -> List[Part]:
+        if self.timescale is None:
+            return []
+        scanner = self._scanners.get(uri)
+        if scanner is None:
+            scanner = self._scanners[uri] = FragmentScanner(self.timescale)
+        with open(path, "rb") as f:
+            return list(scanner.scan(f, size))
+
+    def _parse_playlist(self):
+        segments = []
+        duration = None
+        program_date_time = None
+        with open(self.path) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("#EXT-X-TARGETDURATION:"):
+                    self.target_duration = int(line.split(":", 1)[1])
+                elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+                    self.media_sequence = int(line.split(":", 1)[1])
+                elif line.startswith("#EXT-X-MAP:"):
+                    self.map_uri = line.split('URI="', 1)[1].split('"', 1)[0]
+                elif line.startswith("#EXTINF:"):
+                    duration = float(line[8:].split(",", 1)[0])
+                elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+                    program_date_time = line.split(":", 1)[1]
+                elif line and not line.startswith("#") and duration is not None:
+                    segments.append(Segment(line, duration, program_date_time))
+                    duration = program_date_time = None
+
+        # A restarted ffmpeg writes a new init segment, which may differ
+        if self.map_uri and self.map_uri != self._timescale_uri:
+            with open(os.path.join(self.directory, self.map_uri), "rb") as f:
+                self.timescale = read_timescale(f.read())
+            self._timescale_uri = self.map_uri
+
+        # Parts are only listed near the live edge, so only those are scanned
+        for segment in segments[-PARTS_WINDOW_SEGMENTS:]:
+            path = os.path.join(self.directory, segment.uri)
+            try:
+                segment.parts = self._scan(segment.uri, path, os.path.getsize(path))
+            except FileNotFoundError:
+                pass
+        self.segments = segments
+        pending_uri = next_segment_uri(segments[-1].uri) if segments else None
+        live = {segment.uri for segment in segments[-PARTS_WINDOW_SEGMENTS:]} | {pending_uri}
+        self._scanners = {uri: s for uri, s in self._scanners.items() if uri in live}
+
+        if pending_uri != self.pending_uri:
+            self.pending_uri = pending_uri
+            self.pending_parts = []
+            self._pending_size = -1
+
+    def refresh(self) -> bool:
+        """Re-read whatever changed on disk; returns True if anything did"""
+        changed = False
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return False
+        if mtime != self._playlist_mtime:
+            self._playlist_mtime = mtime
+            self._parse_playlist()
+            changed = True
+
+        if self.pending_uri:
+            # The segment being written lives in a .tmp file until it is renamed
+            for path in (os.path.join(self.directory, self.pending_uri + ".tmp"),
+                         os.path.join(self.directory, self.pending_uri)):
+                try:
+                    size = os.path.getsize(path)
+                except FileNotFoundError:
+                    continue
+                if size != self._pending_size:
+                    self._pending_size = size
+                    parts = self._scan(self.pending_uri, path, size)
+                    if len(parts) != len(self.pending_parts):
+                        self.pending_parts = parts
+                        changed = True
+                break
+
+        return changed
+
+    def parts_for(self, uri: str) -> List[Part]:
+        if uri == self.pending_uri:
+            return self.pending_parts
+        for segment in self.segments[-PARTS_WINDOW_SEGMENTS:]:
+            if segment.uri == uri:
+                return segment.parts
+        return []
+
+    def has(self, msn: int, part: Optional[int]) -> bool:
+        """Whether the playlist already contains segment msn (and its part)"""
+        if not self.segments:
+            return False
+        if msn <= self.last_msn:
+            return True
+        return part is not None and msn == self.last_msn + 1 and len(self.pending_parts) > part
+
+    async def wait_for(self, predicate: Callable[[], bool], timeout: float) -> bool:
+        self.last_used = time.monotonic()
+        self.refresh()
+        if predicate():
+            return True
+        self._waiters += 1
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll())
+        try:
+            async with self._condition:
+                await asyncio.wait_for(self._condition.wait_for(predicate), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters -= 1
+
+    async def _poll(self):
+        # One poller per playlist however many requests are blocked on it
+        while self._waiters:
+            await asyncio.sleep(POLL_INTERVAL)
+            try:
+                changed = self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing {self.path}: {str(e)}")
+                continue
+            if changed:
+                async with self._condition:
+                    self._condition.notify_all()
+
+    def part_target(self) -> float:
+        observed = [
+            part.duration
+            for segment in self.segments[-PARTS_WINDOW_SEGMENTS:]
+            for part in segment.parts
+        ] + [part.duration for part in self.pending_parts]
+        return max([LLHLS_PART_TARGET, *observed])
+
+    def render(self) -> str:
+        part_target = self.part_target()
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:9",
+            f"#EXT-X-TARGETDURATION:{self.target_duration}",
+            f"#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={3 * part_target:.3f}",
+            f"#EXT-X-PART-INF:PART-TARGET={part_target:.3f}",
+            f"#EXT-X-MEDIA-SEQUENCE:{self.media_sequence}",
+        ]
+        if self.map_uri:
+            lines.append(f'#EXT-X-MAP:URI="{self.map_uri}"')
+
+        with_parts = len(self.segments) - PARTS_WINDOW_SEGMENTS
+        for index, segment in enumerate(self.segments):
+            if index >= with_parts:
+                lines.extend(self._part_lines(segment.uri, segment.parts))
+            if segment.program_date_time:
+                lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{segment.program_date_time}")
+            lines.append(f"#EXTINF:{segment.duration:.5f},")
+            lines.append(segment.uri)
+
+        if self.pending_uri:
+            lines.extend(self._part_lines(self.pending_uri, self.pending_parts))
+            next_offset = self.pending_parts[-1].offset + self.pending_parts[-1].length if self.pending_parts else 0
+            lines.append(
+                f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="{self.pending_uri}",BYTERANGE-START={next_offset}'
+            )
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _part_lines(uri: str, parts: List[Part]) -> List[str]:
+        return [
+            f'#EXT-X-PART:DURATION={part.duration:.5f},URI="{uri}",'
+            f'BYTERANGE="{part.length}@{part.offset}"' + (",INDEPENDENT=YES" if part.independent else "")
+            for part in parts
+        ]
+
+
+app = FastAPI()
+app.add_middleware(MetricsMiddleware)
+app.add_api_route("/metrics", metrics_endpoint, methods=["GET"], include_in_schema=False)
+# Classic HLS, served from memory
+app.include_router(hls_router)
+watchers: Dict[Tuple[str, str], PlaylistWatcher] = {}
+instrument_redis(redis_client)
+
+
+def _stream_directory(stream_id: str) -> str:
+    if not SAFE_NAME.match(stream_id):
+        raise HTTPException(status_code=404)
+    return os.path.join(HLS_ROOT, stream_id)
+
+
+def get_watcher(stream_id: str, name: str) -> PlaylistWatcher:
+    key = (stream_id, name)
+    watcher = watchers.get(key)
+    if watcher is None:
+        # Drop watchers of streams nobody has asked about for a while
+        cutoff = time.monotonic() - 60
+        for stale in [k for k, w in watchers.items() if w.last_used < cutoff and not w._waiters]:
+            del watchers[stale]
+        watcher = watchers[key] = PlaylistWatcher(_stream_directory(stream_id), name)
+    return watcher
+
+
+def _read_range(path: str, start: int, end: Optional[int]) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(None if end is None else end - start + 1)
+
+
+@app.get("/llhls/{stream_id}/{name}")
+async def serve(
+    stream_id: str,
+    name: str,
+    request: Request,
+    msn: Optional[int] = Query(None, alias="_HLS_msn"),
+    part: Optional[int] = Query(None, alias="_HLS_part")
+):
+    directory = _stream_directory(stream_id)
+    if not SAFE_NAME.match(name):
+        raise HTTPException(status_code=404)
+
+    if name.endswith(".m3u8") and name.startswith("media_"):
+        if name == LLHLS_VIDEO_PLAYLIST:
+            await count_viewer(stream_id, request)
+        return await serve_media_playlist(stream_id, name, msn, part)
+
+    if name.endswith(".m3u8"):
+        # Master playlist, as written by ffmpeg
+        try:
+            with open(os.path.join(directory, name)) as f:
+                body = f.read()
+        except FileNotFoundError:
+            raise HTTPException(status_code=404)
+        return Response(body, media_type="application/vnd.apple.mpegurl",
+                        headers={**CORS_HEADERS, "Cache-Control": "no-cache"})
+
+    return await serve_segment(stream_id, name, request.headers.get("range"))
+
+
+async def serve_media_playlist(stream_id: str, name: str, msn: Optional[int], part: Optional[int]):
+    watcher = get_watcher(stream_id, name)
+    headers = {**CORS_HEADERS, "Cache-Control": "no-cache"}
+
+    if msn is not None:
+        watcher.refresh()
+        if watcher.segments and msn > watcher.last_msn + 2:
+            raise HTTPException(status_code=400, detail="_HLS_msn is too far in the future")
+        # Blocking playlist reload: hold the request until the segment or part exists
+        ready = await watcher.wait_for(lambda: watcher.has(msn, part), 3 * watcher.target_duration)
+        if not ready:
+            raise HTTPException(status_code=503, detail="Timed out waiting for the requested part")
+        # The URL names a specific playlist version, so it can be cached briefly
+        headers["Cache-Control"] = f"max-age={6 * watcher.target_duration}"
+    else:
+        watcher.refresh()
+        if not watcher.segments and not watcher.pending_parts:
+            raise HTTPException(status_code=404)
+
+    return Response(watcher.render(), media_type="application/vnd.apple.mpegurl", headers=headers)
+
+
+async def serve_segment(stream_id: str, name: str, range_header: Optional[str]):
+    directory = _stream_directory(stream_id)
+    path = os.path.join(directory, name)
+    media_type = "video/mp4" if name.endswith((".m4s", ".mp4")) else "application/octet-stream"
+    # Names carry the run's start time, so they are never reused (see build_llhls_command)
+    headers = {**CORS_HEADERS, "Cache-Control": "max-age=86400, immutable"}
+
+    start, end = 0, None
+    if range_header:
+        match = RANGE_HEADER.match(range_header)
+        if not match:
+            raise HTTPException(status_code=416)
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else None
+
+    if not os.path.exists(path):
+        # Preload hint for a part still being written: wait until it is complete
+        watcher = next(
+            (w for (s, _), w in watchers.items() if s == stream_id and w.pending_uri == name), None
+        )
+        if watcher is None or not range_header:
+            raise HTTPException(status_code=404)
+
+        def part_ready():
+            return os.path.exists(path) or any(
+                p.offset == start for p in watcher.parts_for(name)
+            )
+
+        if not await watcher.wait_for(part_ready, 3 * watcher.target_duration):
+            raise HTTPException(status_code=503)
+        if end is None and not os.path.exists(path):
+            # An open-ended request for a preload hint gets exactly that part
+            part_info = next(p for p in watcher.parts_for(name) if p.offset == start)
+            end = part_info.offset + part_info.length - 1
+
+    # Fall back to the in-progress file until ffmpeg renames it
+    total = "*"
+    for candidate in (path, path + ".tmp"):
+        try:
+            data = _read_range(candidate, start, end)
+            if candidate == path:
+                total = str(os.path.getsize(path))
+            break
+        except FileNotFoundError:
+            continue
+    else:
+        raise HTTPException(status_code=404)
+
+    if not range_header:
+        return Response(data, media_type=media_type, headers=headers)
+    headers["Content-Range"] = f"bytes {start}-{start + len(data) - 1}/{total}"
+    return Response(data, status_code=206, media_type=media_type, headers=headers)
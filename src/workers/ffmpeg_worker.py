@@ -1,11 +1,38 @@
 import json
-import subprocess
 import time
 import os
+import socket
+import threading
 from redis import Redis
 from datetime import datetime
+from functools import partial
+from typing import Dict, Optional
 import logging
 
+from src.workers.hls import (
+    DEFAULT_HLS_MODE,
+    DEFAULT_LADDER,
+    LLHLS_PLAYLIST,
+    LLHLS_PLAYLISTS,
+    THUMBNAIL_DIR,
+    CpuSlots,
+    build_abr_command,
+    build_llhls_command,
+    build_single_command,
+    pin_command,
+    probe_audio,
+    resolve_ladder
+)
+from src.workers.intake import JobIntake
+from src.workers.leases import HEARTBEAT_INTERVAL, WorkerRegistry, worker_stop_queue
+from src.workers.lifecycle import LifecycleRecorder, hls_url
+from src.workers.metrics import WorkerExporter
+from src.workers.quality import QualityRecorder
+from src.workers.segment_store import SEGMENT_BACKFILL_QUEUE, SegmentArchiver, check_store
+from src.workers.supervisor import FFmpegSupervisor
+from src.workers.thumbnails import ThumbnailPublisher
+from src.database.connection import SessionLocal
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,7 +44,14 @@ REDIS_DB = int(os.getenv("REDIS_DB", 0))
 
 # Stream configuration
 HLS_OUTPUT_DIR = os.getenv("HLS_OUTPUT_DIR", "/var/www/streaming/hls")
-DVR_WINDOW_SIZE = 120  # 2 minutes in seconds
+RTMP_INPUT_URL = os.getenv("RTMP_INPUT_URL", "rtmp://localhost/live")
+
+# Job queues
+WORKER_ID = os.getenv("WORKER_ID", socket.gethostname())
+STREAM_REQUEST_QUEUE = "stream_requests"
+STREAM_STOP_QUEUE = "stream_stop_requests"
+WORKER_STOP_QUEUE = worker_stop_queue(STREAM_STOP_QUEUE, WORKER_ID)  # Stops routed to us by other workers
+MAX_STREAMS_PER_WORKER = int(os.getenv("MAX_STREAMS_PER_WORKER", 50))
 
 class FFmpegWorker:
     def __init__(self):
@@ -27,95 +61,265 @@ class FFmpegWorker:
             db=REDIS_DB,
             decode_responses=True
         )
-        self.processes = {}
+        self.cpu_slots = CpuSlots()
+        self.supervisor = FFmpegSupervisor(on_exit=self.on_stream_exit, on_restart=self.on_stream_restart)
+        self.exporter = WorkerExporter(self, [STREAM_REQUEST_QUEUE, STREAM_STOP_QUEUE])
+        self.archiver = SegmentArchiver()
+        self.quality = QualityRecorder(self.supervisor, self.redis_client, SessionLocal)
+        # Thumbnails are binary, so they get a client that leaves responses as bytes
+        self.thumbnails = ThumbnailPublisher(Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB))
+        self.classrooms: Dict[str, Optional[int]] = {}  # Stream id -> classroom id from its job
+        self.registry = WorkerRegistry(self.redis_client, WORKER_ID, MAX_STREAMS_PER_WORKER)
+        self.lifecycle = LifecycleRecorder(self.redis_client, SessionLocal, WORKER_ID)
+        # Stop requests are listed first so they win within a batch
+        self.intake = JobIntake(
+            self.redis_client,
+            [WORKER_STOP_QUEUE, STREAM_STOP_QUEUE, STREAM_REQUEST_QUEUE, SEGMENT_BACKFILL_QUEUE],
+            WORKER_ID,
+            claim_limits={STREAM_REQUEST_QUEUE: self.claim_limit}
+        )
+
+    def load(self) -> int:
+        return len(self.supervisor) + self.intake.pending()
 
-    def process_stream(self, rtmp_key: str, stream_id: str):
-        input_url = f"rtmp://localhost/live/{rtmp_key}"
+    def claim_limit(self) -> int:
+        # Called by the intake thread before it blocks on stream_requests
+        load = self.load()
+        limit = self.registry.claim_share(load, self.intake.batch_size)
+        if limit > 0:
+            # Less loaded workers get to block on the queue ahead of us
+            time.sleep(self.registry.claim_delay(load))
+        return limit
+
+    def process_stream(
+        self,
+        rtmp_key: str,
+        stream_id: str,
+        dequeued_at: Optional[float] = None,
+        ladder: Optional[list] = None,
+        hls_mode: Optional[str] = None
+    ):
+        # Redelivered jobs must not spawn a second ffmpeg for the same stream
+        if self.supervisor.is_running(stream_id):
+            logger.info(f"Stream {stream_id} is already running")
+            return True
+
+        input_url = f"{RTMP_INPUT_URL}/{rtmp_key}"
         output_path = f"{HLS_OUTPUT_DIR}/{stream_id}"
         
         # Create output directory if it doesn't exist
-        os.makedirs(output_path, exist_ok=True)
-
-        # FFmpeg command for HLS output with DVR window
-        command = [
-            "ffmpeg",
-            "-i", input_url,
-            "-c:v", "copy",              # Copy video codec
-            "-c:a", "aac",              # Convert audio to AAC
-            "-b:a", "128k",             # Audio bitrate
-            "-f", "hls",                # HLS output format
-            "-hls_time", "2",           # Segment duration
-            "-hls_list_size", str(DVR_WINDOW_SIZE // 2),  # Number of segments to keep
-            "-hls_flags", "delete_segments",  # Delete old segments
-            "-hls_segment_filename", f"{output_path}/%03d.ts",  # Segment filename pattern
-            f"{output_path}/playlist.m3u8"  # Playlist file
-        ]
+        os.makedirs(os.path.join(output_path, THUMBNAIL_DIR), exist_ok=True)
 
         try:
-            # Start FFmpeg process
-            process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            self.processes[stream_id] = process
-            
-            # Update stream status in Redis
-            self.redis_client.publish(
-                "stream_status_updates",
-                json.dumps({
-                    "stream_id": stream_id,
-                    "status": "active",
-                    "timestamp": datetime.utcnow().isoformat()
-                })
-            )
+            # FFmpeg command for HLS output with DVR window
+            renditions = resolve_ladder(ladder if ladder is not None else DEFAULT_LADDER)
+            playlist_name = "playlist.m3u8"
+            playlists = [playlist_name]
+            if (hls_mode or DEFAULT_HLS_MODE) == "llhls":
+                if renditions:
+                    logger.warning(f"Stream {stream_id} uses LL-HLS, ignoring its ABR ladder")
+                command = partial(build_llhls_command, input_url, output_path)
+                tracked_path = output_path
+                playlist_name = LLHLS_PLAYLIST
+                playlists = LLHLS_PLAYLISTS
+                url = hls_url(stream_id, "master.m3u8", llhls=True)
+            elif renditions:
+                # One decode feeding every rendition, pinned to its own CPUs
+                # var_stream_map must know up front whether there is audio
+                command = pin_command(
+                    build_abr_command(input_url, output_path, renditions, audio=probe_audio(input_url)),
+                    self.cpu_slots.acquire(stream_id)
+                )
+                for rendition in renditions:
+                    os.makedirs(os.path.join(output_path, rendition["name"]), exist_ok=True)
+                tracked_path = os.path.join(output_path, renditions[0]["name"])
+                playlists = [f"{rendition['name']}/playlist.m3u8" for rendition in renditions]
+                url = hls_url(stream_id, "master.m3u8")
+            else:
+                command = build_single_command(input_url, output_path)
+                tracked_path = output_path
+                url = hls_url(stream_id, playlist_name)
+
+            # Start FFmpeg process under supervision
+            self.supervisor.spawn(stream_id, command)
+            self.exporter.track(stream_id, tracked_path, dequeued_at or time.time(), playlist_name)
+            self.archiver.track(stream_id, output_path, playlists)
+            self.thumbnails.track(stream_id, output_path)
             
+            # Update stream status in Redis, and in Postgres soon after
+            self.lifecycle.started(stream_id, self.classrooms.get(stream_id), url)
+            self.publish_status(stream_id, "active")
+
             return True
         except Exception as e:
             logger.error(f"Error starting stream {stream_id}: {str(e)}")
+            self.cpu_slots.release(stream_id)
             return False
 
-    def stop_stream(self, stream_id: str):
-        if stream_id in self.processes:
-            process = self.processes[stream_id]
-            process.terminate()
-            process.wait()
-            del self.processes[stream_id]
-            
-            # Update stream status in Redis
-            self.redis_client.publish(
-                "stream_status_updates",
-                json.dumps({
-                    "stream_id": stream_id,
-                    "status": "stopped",
-                    "timestamp": datetime.utcnow().isoformat()
-                })
+    def stop_stream(self, stream_id: str, exited: bool = False, lease_lost: bool = False):
+        # Children that exited on their own were already reaped by the supervisor
+        self.exporter.untrack(stream_id)
+        self.thumbnails.untrack(stream_id)
+        self.cpu_slots.release(stream_id)
+        stopped = self.supervisor.stop(stream_id)
+        # After ffmpeg is gone, so that the recording gets the final segment
+        self.archiver.untrack(stream_id)
+        if lease_lost:
+            # The stream lives on with the worker that took its lease
+            self.lifecycle.released(stream_id)
+        elif stopped or exited:
+            # Update stream status in Redis, and in Postgres soon after
+            self.lifecycle.stopped(stream_id)
+            self.publish_status(stream_id, "stopped")
+        self.classrooms.pop(stream_id, None)
+
+    def publish_status(self, stream_id: str, status: str):
+        self.redis_client.publish(
+            "stream_status_updates",
+            json.dumps({
+                "stream_id": stream_id,
+                # Lets dashboards subscribe to their own classrooms only
+                "classroom_id": self.classrooms.get(stream_id),
+                "status": status,
+                "timestamp": datetime.utcnow().isoformat()
+            })
+        )
+
+    def start_job(self, request_data: dict, payload: str, dequeued_at: float):
+        stream_id = request_data["stream_id"]
+        if not self.registry.acquire_lease(stream_id):
+            logger.info(f"Stream {stream_id} is owned by {self.registry.lease_owner(stream_id)}")
+            return
+
+        # Recorded so that another worker can take over if we die
+        self.registry.record_job(stream_id, payload)
+        self.classrooms[stream_id] = request_data.get("classroom_id")
+        if not self.process_stream(
+            request_data["rtmp_key"],
+            stream_id,
+            dequeued_at,
+            request_data.get("ladder"),
+            request_data.get("hls_mode")
+        ):
+            self.registry.forget_job(stream_id)
+            # We hold the lease, so whichever worker is listed as running it is not
+            self.lifecycle.stopped(stream_id, owner="")
+            self.registry.release_lease(stream_id)
+
+    def route_stop(self, stream_id: str, payload: str):
+        # Forget the job first so nobody adopts the stream while it is stopping
+        self.registry.forget_job(stream_id)
+        owner = self.registry.lease_owner(stream_id)
+        if owner and owner != WORKER_ID:
+            self.redis_client.lpush(worker_stop_queue(STREAM_STOP_QUEUE, owner), payload)
+            return
+        self.stop_stream(stream_id)
+        self.registry.release_lease(stream_id)
+
+    def handle_job(self, queue_name: str, payload: str):
+        dequeued_at = time.time()
+        request_data = json.loads(payload)
+        stream_id = request_data.get("stream_id")
+        if not stream_id:
+            return
+
+        if queue_name == STREAM_REQUEST_QUEUE:
+            if request_data.get("rtmp_key"):
+                self.start_job(request_data, payload, dequeued_at)
+        elif queue_name == STREAM_STOP_QUEUE:
+            self.route_stop(stream_id, payload)
+        elif queue_name == SEGMENT_BACKFILL_QUEUE:
+            # Any worker can stitch; recordings are on the shared volume
+            self.archiver.backfill(stream_id)
+        elif queue_name == WORKER_STOP_QUEUE:
+            reason = request_data.get("reason")
+            if reason != "lease_lost":
+                self.registry.forget_job(stream_id)
+            self.stop_stream(stream_id, exited=reason == "exited", lease_lost=reason == "lease_lost")
+            self.registry.release_lease(stream_id)
+
+    def on_stream_exit(self, stream_id: str, returncode: int):
+        # Called from the supervisor thread, so let the main loop clean up
+        self.redis_client.lpush(
+            WORKER_STOP_QUEUE,
+            json.dumps({"stream_id": stream_id, "reason": "exited", "returncode": returncode})
+        )
+
+    def on_stream_restart(self, stream_id: str):
+        # The new ffmpeg continues the recording after a discontinuity
+        self.archiver.restarted(stream_id)
+
+    def reap_dead_workers(self):
+        for worker_id in self.registry.dead_workers():
+            if not self.registry.claim_reap(worker_id):
+                continue
+            # Hand the dead worker's in-flight jobs back to the shared queues
+            requeued = 0
+            for queue_name in (STREAM_STOP_QUEUE, STREAM_REQUEST_QUEUE, SEGMENT_BACKFILL_QUEUE):
+                requeued += self.registry.requeue(
+                    JobIntake.processing_list(queue_name, worker_id), queue_name
+                )
+            stop_queue = worker_stop_queue(STREAM_STOP_QUEUE, worker_id)
+            requeued += self.registry.requeue(
+                JobIntake.processing_list(stop_queue, worker_id), STREAM_STOP_QUEUE
             )
+            requeued += self.registry.requeue(stop_queue, STREAM_STOP_QUEUE)
+            # Its streams are stopped unless they are about to be adopted
+            self.lifecycle.rebuild([], self.registry.job_stream_ids(), worker_id)
+            self.registry.remove_worker(worker_id)
+            logger.warning(f"Worker {worker_id} is dead, requeued {requeued} jobs")
+
+    def adopt_orphans(self):
+        for stream_id, payload in self.registry.orphaned_jobs().items():
+            if stream_id in self.supervisor:
+                # Our own lease lapsed, e.g. during a Redis hiccup
+                self.registry.acquire_lease(stream_id)
+            elif self.registry.mark_orphan(stream_id):
+                # Back onto the consuming end so the least loaded worker picks it up next
+                self.redis_client.rpush(STREAM_REQUEST_QUEUE, payload)
+                logger.warning(f"Requeued orphaned stream {stream_id}")
+
+    def maintain(self):
+        while True:
+            try:
+                self.registry.heartbeat(self.load())
+                for stream_id in self.registry.renew_leases(self.supervisor.stream_ids()):
+                    logger.warning(f"Lost lease on stream {stream_id}, stopping it")
+                    self.redis_client.lpush(
+                        WORKER_STOP_QUEUE,
+                        json.dumps({"stream_id": stream_id, "reason": "lease_lost"})
+                    )
+                self.reap_dead_workers()
+                self.adopt_orphans()
+            except Exception as e:
+                logger.error(f"Error in worker maintenance: {str(e)}")
+            time.sleep(HEARTBEAT_INTERVAL)
 
     def run(self):
-        logger.info("FFmpeg worker started")
+        logger.info(f"FFmpeg worker {WORKER_ID} started")
+        self.registry.heartbeat(self.load())
+        check_store(HLS_OUTPUT_DIR, MAX_STREAMS_PER_WORKER)
+        self.supervisor.start()
+        self.exporter.start()
+        self.archiver.start()
+        self.quality.start()
+        self.thumbnails.start()
+        self.lifecycle.start()
+        # Live entries left by our previous run; its ffmpeg processes died with it
+        self.lifecycle.rebuild(self.supervisor.stream_ids(), self.registry.job_stream_ids())
+        threading.Thread(target=self.maintain, name="maintenance", daemon=True).start()
+        self.intake.start()
         while True:
             try:
-                # Check for new stream requests in Redis queue
-                stream_request = self.redis_client.rpop("stream_requests")
-                if stream_request:
-                    request_data = json.loads(stream_request)
-                    rtmp_key = request_data.get("rtmp_key")
-                    stream_id = request_data.get("stream_id")
-                    
-                    if rtmp_key and stream_id:
-                        self.process_stream(rtmp_key, stream_id)
-                
-                # Check for stop requests
-                stop_request = self.redis_client.rpop("stream_stop_requests")
-                if stop_request:
-                    request_data = json.loads(stop_request)
-                    stream_id = request_data.get("stream_id")
-                    if stream_id:
-                        self.stop_stream(stream_id)
-                
-                time.sleep(1)  # Prevent tight loop
-                
+                # Blocks until jobs arrive, then hands over the whole burst
+                for queue_name, payload in self.intake.get_batch(timeout=1):
+                    try:
+                        self.handle_job(queue_name, payload)
+                    except Exception as e:
+                        logger.error(f"Error handling job from {queue_name}: {str(e)}")
+                    # Acknowledge only after the job was handled
+                    self.intake.ack(queue_name, payload)
+
             except Exception as e:
                 logger.error(f"Error in worker loop: {str(e)}")
                 time.sleep(5)  # Wait before retrying
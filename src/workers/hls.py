@@ -0,0 +1,296 @@
+import os
+import time
+import threading
+import logging
+import subprocess
+from typing import Dict, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# HLS configuration
+HLS_SEGMENT_SECONDS = 2
+DVR_WINDOW_SIZE = 120  # 2 minutes in seconds
+ABR_THREADS = int(os.getenv("ABR_THREADS", 2))  # CPU threads pinned to each ABR stream
+DEFAULT_LADDER = [name for name in os.getenv("HLS_LADDER", "").split(",") if name]
+DEFAULT_HLS_MODE = os.getenv("HLS_MODE", "hls")  # "hls" or "llhls"
+LLHLS_PART_SECONDS = float(os.getenv("LLHLS_PART_TARGET", 0.5))  # Fragment, and so part, duration
+LLHLS_PLAYLIST = "media_0.m3u8"  # Video media playlist written by the dash muxer
+LLHLS_PLAYLISTS = [LLHLS_PLAYLIST, "media_1.m3u8"]  # Video, then audio
+HLS_MODES = ("hls", "llhls")
+THUMBNAIL_INTERVAL = max(1, int(os.getenv("THUMBNAIL_INTERVAL", 5)))  # Seconds between preview thumbnails
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", 256))  # Thumbnails are letterboxed to 16:9 tiles
+THUMBNAIL_HEIGHT = THUMBNAIL_WIDTH * 9 // 16 // 2 * 2
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "jpg")  # "jpg" or "webp"
+THUMBNAIL_DIR = "thumbs"  # Next to the playlists, one file per thumbnailed keyframe
+AUDIO_PROBE_TIMEOUT = 5  # Seconds ffprobe may take to find out whether a publish has audio
+
+# Rendition presets a ladder can refer to by name
+RENDITION_PRESETS: Dict[str, dict] = {
+    "1080p": {"height": 1080, "video_bitrate": 5000, "audio_bitrate": 128},
+    "720p": {"height": 720, "video_bitrate": 2500, "audio_bitrate": 128},
+    "480p": {"height": 480, "video_bitrate": 1000, "audio_bitrate": 96},
+    "360p": {"height": 360, "video_bitrate": 600, "audio_bitrate": 96},
+    "240p": {"height": 240, "video_bitrate": 300, "audio_bitrate": 64},
+    # Passes the incoming video through without decoding it
+    "source": {"height": None, "video_bitrate": None, "audio_bitrate": 128},
+}
+
+
+def resolve_ladder(ladder: Optional[List[Union[str, dict]]]) -> List[dict]:
+    """Turn preset names or explicit rendition dicts into rendition dicts"""
+    renditions = []
+    for entry in ladder or []:
+        if isinstance(entry, str):
+            if entry not in RENDITION_PRESETS:
+                raise ValueError(f"Unknown rendition {entry}")
+            renditions.append({"name": entry, **RENDITION_PRESETS[entry]})
+        else:
+            preset = RENDITION_PRESETS.get(entry.get("name"), {})
+            renditions.append({**preset, **entry})
+    return renditions
+
+
+def progress_options() -> List[str]:
+    return [
+        "-nostats",                 # Progress is reported on stdout instead
+        "-loglevel", "warning",     # Keep stderr to what is worth reading
+        "-progress", "pipe:1",      # Machine readable progress for the supervisor
+    ]
+
+
+def hls_options() -> List[str]:
+    return [
+        "-f", "hls",                # HLS output format
+        "-hls_time", str(HLS_SEGMENT_SECONDS),  # Segment duration
+        "-hls_list_size", str(DVR_WINDOW_SIZE // HLS_SEGMENT_SECONDS),  # Number of segments to keep
+        "-hls_flags", "delete_segments+program_date_time",  # Delete old segments, stamp wall clock times
+        # Number segments from the start time, so a restarted ffmpeg never
+        # reuses the name of a segment players or CDNs may have cached
+        "-hls_start_number_source", "epoch",
+    ]
+
+
+def thumbnail_filter(source: str) -> str:
+    """Filter chain turning a decoded video into thumbnails, labelled [thumb].
+
+    Takes a keyframe at most every THUMBNAIL_INTERVAL, so every thumbnail
+    is a point a player can seek to, and scales it to a grid tile.
+    """
+    w, h = THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT
+    return (
+        f"{source}select='eq(pict_type,I)*(isnan(prev_selected_t)+gte(t-prev_selected_t,{THUMBNAIL_INTERVAL}))',"
+        f"scale={w}:{h}:force_original_aspect_ratio=decrease,pad={w}:{h}:(ow-iw)/2:(oh-ih)/2,setsar=1[thumb]"
+    )
+
+
+def thumbnail_output(output_path: str) -> List[str]:
+    """Second output writing [thumb] to thumbs/<capture time>.<format>"""
+    codec = ["-c:v", "libwebp", "-quality", "60"] if THUMBNAIL_FORMAT == "webp" else ["-c:v", "mjpeg", "-q:v", "6"]
+    return [
+        "-map", "[thumb]",
+        *codec,
+        "-fps_mode", "passthrough",  # One file per selected frame, never duplicated
+        "-f", "image2",
+        "-strftime", "1",            # Named by wall clock time, as program_date_time
+        "-atomic_writing", "1",      # Readers never see a partial file
+        f"{output_path}/{THUMBNAIL_DIR}/%s.{THUMBNAIL_FORMAT}"
+    ]
+
+
+def keyframe_decode_options() -> List[str]:
+    # Input option for copied video: only keyframes are decoded, for thumbnails
+    return ["-skip_frame:v", "nokey"]
+
+
+def build_single_command(input_url: str, output_path: str) -> List[str]:
+    """Remux the incoming video into a single rendition"""
+    return [
+        "ffmpeg",
+        *progress_options(),
+        *keyframe_decode_options(),
+        "-i", input_url,
+        "-filter_complex", thumbnail_filter("[0:v]"),
+        "-map", "0:v:0",
+        "-map", "0:a:0?",            # Publishes may be video only
+        "-c:v", "copy",              # Copy video codec
+        "-c:a", "aac",              # Convert audio to AAC
+        "-b:a", "128k",             # Audio bitrate
+        *hls_options(),
+        "-hls_segment_filename", f"{output_path}/%03d.ts",  # Segment filename pattern
+        f"{output_path}/playlist.m3u8",  # Playlist file
+        *thumbnail_output(output_path)
+    ]
+
+
+def probe_audio(input_url: str, timeout: float = AUDIO_PROBE_TIMEOUT) -> bool:
+    """Whether the input has an audio stream; assumed so when probing fails"""
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe", "-v", "error",
+                "-rw_timeout", str(int(timeout * 1000000)),
+                "-select_streams", "a",
+                "-show_entries", "stream=index",
+                "-of", "csv=p=0",
+                input_url
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=timeout
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"Could not probe {input_url} for audio: {str(e)}")
+        return True
+    if result.returncode != 0:
+        logger.warning(f"Could not probe {input_url} for audio: {result.stderr.decode(errors='replace').strip()}")
+        return True
+    return bool(result.stdout.strip())
+
+
+def build_abr_command(
+    input_url: str,
+    output_path: str,
+    renditions: List[dict],
+    threads: int = ABR_THREADS,
+    audio: bool = True
+) -> List[str]:
+    """Decode once and encode every rendition from a split filter graph.
+
+    var_stream_map has to name every stream it groups, so a video-only
+    publish needs audio=False.
+    """
+    encoded = [index for index, rendition in enumerate(renditions) if rendition.get("height")]
+
+    # One decode, split into a scaler per encoded rendition and the thumbnails
+    filters = []
+    if encoded:
+        filters.append(f"[0:v]split={len(encoded) + 1}" + "".join(f"[s{index}]" for index in encoded) + "[t]")
+        for index in encoded:
+            filters.append(f"[s{index}]scale=-2:{renditions[index]['height']}[v{index}]")
+        filters.append(thumbnail_filter("[t]"))
+    else:
+        filters.append(thumbnail_filter("[0:v]"))
+
+    command = [
+        "ffmpeg",
+        *progress_options(),
+        "-threads", str(threads),
+        "-filter_threads", str(threads),
+        # Nothing is encoded, so only the thumbnails need decoded frames
+        *([] if encoded else keyframe_decode_options()),
+        "-i", input_url,
+        "-filter_complex", ";".join(filters),
+    ]
+
+    stream_map = []
+    for index, rendition in enumerate(renditions):
+        command += ["-map", f"[v{index}]" if index in encoded else "0:v:0"]
+        if audio:
+            command += ["-map", "0:a:0"]
+        stream_map.append(f"v:{index},{f'a:{index},' if audio else ''}name:{rendition['name']}")
+
+    for index, rendition in enumerate(renditions):
+        if index in encoded:
+            bitrate = rendition["video_bitrate"]
+            command += [
+                f"-c:v:{index}", "libx264",
+                f"-b:v:{index}", f"{bitrate}k",
+                f"-maxrate:v:{index}", f"{int(bitrate * 1.07)}k",
+                f"-bufsize:v:{index}", f"{int(bitrate * 1.5)}k",
+                f"-preset:v:{index}", "veryfast",
+                f"-tune:v:{index}", "zerolatency",
+                f"-pix_fmt:v:{index}", "yuv420p",
+                f"-sc_threshold:v:{index}", "0",  # Keyframes only where forced
+                # Aligned keyframes on segment boundaries keep renditions switchable
+                f"-force_key_frames:v:{index}", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+            ]
+        else:
+            command += [f"-c:v:{index}", "copy"]
+        if audio:
+            command += [f"-c:a:{index}", "aac", f"-b:a:{index}", f"{rendition['audio_bitrate']}k"]
+
+    command += [
+        *hls_options(),
+        "-master_pl_name", "master.m3u8",
+        "-var_stream_map", " ".join(stream_map),
+        "-hls_segment_filename", f"{output_path}/%v/%03d.ts",
+        f"{output_path}/%v/playlist.m3u8",
+        *thumbnail_output(output_path)
+    ]
+    return command
+
+
+def build_llhls_command(input_url: str, output_path: str) -> List[str]:
+    """CMAF output for Low-Latency HLS.
+
+    The dash muxer writes fMP4 segments as a series of short fragments and
+    flushes each one as soon as it is complete. The LL-HLS edge
+    (src/edge/llhls.py) exposes those fragments as partial segments.
+
+    The muxer numbers segments from 1 on every start, so file names carry
+    the start time as well; build the command anew for every launch, and a
+    restarted ffmpeg never reuses the name of a chunk players or CDNs may
+    have cached.
+    """
+    run = int(time.time())
+    return [
+        "ffmpeg",
+        *progress_options(),
+        *keyframe_decode_options(),
+        "-i", input_url,
+        "-filter_complex", thumbnail_filter("[0:v]"),
+        "-map", "0:v:0",
+        "-map", "0:a:0?",            # Publishes may be video only
+        "-c:v", "copy",              # Copy video codec
+        "-c:a", "aac",              # Convert audio to AAC
+        "-b:a", "128k",             # Audio bitrate
+        "-f", "dash",
+        "-ldash", "1",              # Low latency DASH/CMAF settings
+        "-streaming", "1",          # Flush every fragment as it is written
+        "-hls_playlist", "1",       # Write HLS playlists next to the MPD
+        "-seg_duration", str(HLS_SEGMENT_SECONDS),
+        "-frag_type", "duration",
+        "-frag_duration", str(LLHLS_PART_SECONDS),
+        "-window_size", str(DVR_WINDOW_SIZE // HLS_SEGMENT_SECONDS),  # Number of segments to keep
+        "-extra_window_size", "5",  # Keep a few expired segments for slow clients
+        "-use_timeline", "0",
+        "-use_template", "1",
+        "-init_seg_name", f"init-{run}-$RepresentationID$.m4s",
+        "-media_seg_name", f"chunk-{run}-$RepresentationID$-$Number%05d$.m4s",
+        "-adaptation_sets", "id=0,streams=v id=1,streams=a",
+        f"{output_path}/manifest.mpd",
+        *thumbnail_output(output_path)
+    ]
+
+
+class CpuSlots:
+    """Hands out disjoint CPU sets so concurrent ABR encodes don't contend"""
+
+    def __init__(self, threads: int = ABR_THREADS):
+        self.cpus = sorted(os.sched_getaffinity(0))
+        self.threads = min(threads, len(self.cpus))
+        self.slot_count = max(1, len(self.cpus) // self.threads)
+        self.usage = [0] * self.slot_count
+        self.assigned: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, stream_id: str) -> List[int]:
+        with self.lock:
+            slot = self.assigned.get(stream_id)
+            if slot is None:
+                # Least used slot; slots are shared once every CPU is taken
+                slot = self.usage.index(min(self.usage))
+                self.usage[slot] += 1
+                self.assigned[stream_id] = slot
+        start = slot * self.threads
+        return self.cpus[start:start + self.threads]
+
+    def release(self, stream_id: str):
+        with self.lock:
+            slot = self.assigned.pop(stream_id, None)
+            if slot is not None:
+                self.usage[slot] -= 1
+
+
+def pin_command(command: List[str], cpus: List[int]) -> List[str]:
+    return ["taskset", "--cpu-list", ",".join(str(cpu) for cpu in cpus), *command]
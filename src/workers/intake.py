@@ -0,0 +1,133 @@
+import os
+import queue
+import threading
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from redis import Redis
+
+logger = logging.getLogger(__name__)
+
+# Intake configuration
+INTAKE_BATCH_SIZE = int(os.getenv("INTAKE_BATCH_SIZE", 50))
+INTAKE_BLOCK_TIMEOUT = int(os.getenv("INTAKE_BLOCK_TIMEOUT", 5))  # Seconds per blocking pop
+
+
+class JobIntake:
+    """Blocking, batched job intake with at-least-once delivery.
+
+    Every watched queue gets a listener thread that blocks on BLMOVE, so a
+    job is atomically moved into this worker's processing list the moment it
+    is popped. Bursts are drained with a pipelined LMOVE batch. Jobs stay in
+    the processing list until the worker acknowledges them, so anything left
+    behind by a crash is replayed on the next start.
+    """
+
+    def __init__(
+        self,
+        redis_client: Redis,
+        queues: List[str],
+        worker_id: str,
+        batch_size: int = INTAKE_BATCH_SIZE,
+        block_timeout: int = INTAKE_BLOCK_TIMEOUT,
+        claim_limits: Optional[Dict[str, Callable[[], int]]] = None
+    ):
+        self.redis_client = redis_client
+        self.queues = queues  # Ordered by priority, highest first
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.block_timeout = block_timeout
+        # Optional per-queue callbacks capping how many jobs we may claim right now
+        self.claim_limits = claim_limits or {}
+        self.processing: Dict[str, str] = {
+            name: self.processing_list(name, worker_id) for name in queues
+        }
+        self._jobs: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def processing_list(queue_name: str, worker_id: str) -> str:
+        return f"{queue_name}:processing:{worker_id}"
+
+    def recover(self) -> int:
+        """Replay jobs left in our processing lists by a previous run"""
+        recovered = 0
+        for queue_name in self.queues:
+            # Oldest entries sit at the right end, replay them first
+            for payload in reversed(self.redis_client.lrange(self.processing[queue_name], 0, -1)):
+                self._jobs.put((queue_name, payload))
+                recovered += 1
+        if recovered:
+            logger.warning(f"Recovered {recovered} unacknowledged jobs for worker {self.worker_id}")
+        return recovered
+
+    def start(self):
+        self.recover()
+        for queue_name in self.queues:
+            thread = threading.Thread(
+                target=self._listen,
+                args=(queue_name,),
+                name=f"intake-{queue_name}",
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _listen(self, queue_name: str):
+        processing = self.processing[queue_name]
+        claim_limit = self.claim_limits.get(queue_name)
+        while not self._stopped.is_set():
+            try:
+                limit = self.batch_size
+                if claim_limit:
+                    limit = min(limit, claim_limit())
+                    if limit <= 0:
+                        self._stopped.wait(1)  # No capacity, let other workers claim
+                        continue
+
+                payload = self.redis_client.blmove(
+                    queue_name, processing, self.block_timeout, "RIGHT", "LEFT"
+                )
+                if payload is None:
+                    continue
+                batch = [payload]
+
+                # Drain the rest of a burst in a single round trip
+                if limit > 1:
+                    pipe = self.redis_client.pipeline(transaction=False)
+                    for _ in range(limit - 1):
+                        pipe.lmove(queue_name, processing, "RIGHT", "LEFT")
+                    batch.extend(item for item in pipe.execute() if item is not None)
+
+                for item in batch:
+                    self._jobs.put((queue_name, item))
+            except Exception as e:
+                logger.error(f"Error reading from {queue_name}: {str(e)}")
+                self._stopped.wait(1)
+
+    def get_batch(self, timeout: Optional[float] = None) -> List[Tuple[str, str]]:
+        """Wait for the next job and return it with whatever else is pending"""
+        try:
+            batch = [self._jobs.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._jobs.get_nowait())
+            except queue.Empty:
+                break
+
+        # Serve higher priority queues first within a batch
+        priority = {name: index for index, name in enumerate(self.queues)}
+        batch.sort(key=lambda job: priority[job[0]])
+        return batch
+
+    def pending(self) -> int:
+        return self._jobs.qsize()
+
+    def ack(self, queue_name: str, payload: str):
+        self.redis_client.lrem(self.processing[queue_name], 1, payload)
@@ -0,0 +1,199 @@
+import os
+import json
+import math
+import time
+import logging
+from typing import Dict, List, Optional
+
+from redis import Redis
+
+logger = logging.getLogger(__name__)
+
+# Pool configuration
+LEASE_TTL = float(os.getenv("LEASE_TTL", 5))  # Seconds a stream lease survives without renewal
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 1))
+WORKER_TTL = float(os.getenv("WORKER_TTL", 5))  # Seconds before a silent worker is considered dead
+CLAIM_DEFER_STEP = float(os.getenv("CLAIM_DEFER_STEP", 0.05))  # Seconds of claim delay per load rank
+
+# Redis keys
+WORKERS_KEY = "workers"
+STREAM_JOBS_KEY = "stream_jobs"
+
+# Extend our leases and report the ones we no longer own
+RENEW_LEASES_SCRIPT = """
+local lost = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('PEXPIRE', key, ARGV[2])
+    else
+        table.insert(lost, i)
+    end
+end
+return lost
+"""
+
+# Delete a lease only if we still hold it
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def lease_key(stream_id: str) -> str:
+    return f"stream_lease:{stream_id}"
+
+
+def worker_key(worker_id: str) -> str:
+    return f"worker:{worker_id}"
+
+
+def worker_stop_queue(queue_name: str, worker_id: str) -> str:
+    return f"{queue_name}:{worker_id}"
+
+
+class WorkerRegistry:
+    """Worker membership, load reporting and stream ownership leases in Redis"""
+
+    def __init__(self, redis_client: Redis, worker_id: str, capacity: int):
+        self.redis_client = redis_client
+        self.worker_id = worker_id
+        self.capacity = capacity
+        self.lease_ttl_ms = int(LEASE_TTL * 1000)
+        self._renew_leases = redis_client.register_script(RENEW_LEASES_SCRIPT)
+        self._release_lease = redis_client.register_script(RELEASE_LEASE_SCRIPT)
+        self._loads: Dict[str, dict] = {}
+
+    def heartbeat(self, load: int):
+        """Refresh our liveness key and publish our current load"""
+        status = {"load": load, "capacity": self.capacity, "heartbeat": time.time()}
+        pipe = self.redis_client.pipeline()
+        pipe.set(worker_key(self.worker_id), load, px=int(WORKER_TTL * 1000))
+        pipe.hset(WORKERS_KEY, self.worker_id, json.dumps(status))
+        pipe.hgetall(WORKERS_KEY)
+        self._loads = {
+            worker_id: json.loads(raw) for worker_id, raw in pipe.execute()[-1].items()
+        }
+
+    def deregister(self):
+        pipe = self.redis_client.pipeline()
+        pipe.delete(worker_key(self.worker_id))
+        pipe.hdel(WORKERS_KEY, self.worker_id)
+        pipe.execute()
+
+    # Leases
+
+    def acquire_lease(self, stream_id: str) -> bool:
+        key = lease_key(stream_id)
+        if self.redis_client.set(key, self.worker_id, nx=True, px=self.lease_ttl_ms):
+            return True
+        # A redelivered job for a stream we already own keeps its lease
+        return self.redis_client.get(key) == self.worker_id
+
+    def release_lease(self, stream_id: str):
+        self._release_lease(keys=[lease_key(stream_id)], args=[self.worker_id])
+
+    def renew_leases(self, stream_ids: List[str]) -> List[str]:
+        """Extend leases for our streams and return the ones we lost"""
+        if not stream_ids:
+            return []
+        lost = self._renew_leases(
+            keys=[lease_key(stream_id) for stream_id in stream_ids],
+            args=[self.worker_id, self.lease_ttl_ms]
+        )
+        return [stream_ids[index - 1] for index in lost]
+
+    def lease_owner(self, stream_id: str) -> Optional[str]:
+        return self.redis_client.get(lease_key(stream_id))
+
+    # Stream jobs, kept so that orphaned streams can be restarted elsewhere
+
+    def record_job(self, stream_id: str, payload: str):
+        self.redis_client.hset(STREAM_JOBS_KEY, stream_id, payload)
+
+    def forget_job(self, stream_id: str):
+        self.redis_client.hdel(STREAM_JOBS_KEY, stream_id)
+
+    def job_stream_ids(self) -> List[str]:
+        return self.redis_client.hkeys(STREAM_JOBS_KEY)
+
+    def orphaned_jobs(self) -> Dict[str, str]:
+        """Return recorded jobs whose lease has expired"""
+        jobs = self.redis_client.hgetall(STREAM_JOBS_KEY)
+        if not jobs:
+            return {}
+        stream_ids = list(jobs)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for stream_id in stream_ids:
+            pipe.exists(lease_key(stream_id))
+        return {
+            stream_id: jobs[stream_id]
+            for stream_id, leased in zip(stream_ids, pipe.execute())
+            if not leased
+        }
+
+    def mark_orphan(self, stream_id: str) -> bool:
+        """Make sure only one worker requeues a given orphan"""
+        return bool(self.redis_client.set(
+            f"stream_orphan:{stream_id}", self.worker_id, nx=True, px=self.lease_ttl_ms
+        ))
+
+    # Dead workers
+
+    def dead_workers(self) -> List[str]:
+        worker_ids = [worker_id for worker_id in self._loads if worker_id != self.worker_id]
+        if not worker_ids:
+            return []
+        pipe = self.redis_client.pipeline(transaction=False)
+        for worker_id in worker_ids:
+            pipe.exists(worker_key(worker_id))
+        return [
+            worker_id for worker_id, alive in zip(worker_ids, pipe.execute()) if not alive
+        ]
+
+    def claim_reap(self, worker_id: str) -> bool:
+        """Make sure only one survivor cleans up after a dead worker"""
+        return bool(self.redis_client.set(
+            f"worker_reap:{worker_id}", self.worker_id, nx=True, px=int(WORKER_TTL * 1000)
+        ))
+
+    def requeue(self, source: str, destination: str) -> int:
+        """Move every entry of source back to the consuming end of destination"""
+        moved = 0
+        while self.redis_client.lmove(source, destination, "LEFT", "RIGHT") is not None:
+            moved += 1
+        return moved
+
+    def remove_worker(self, worker_id: str):
+        self.redis_client.hdel(WORKERS_KEY, worker_id)
+        self._loads.pop(worker_id, None)
+
+    # Load-aware claiming
+
+    def _live_loads(self) -> Dict[str, dict]:
+        cutoff = time.time() - WORKER_TTL
+        return {
+            worker_id: status for worker_id, status in self._loads.items()
+            if status["heartbeat"] >= cutoff
+        }
+
+    def claim_share(self, load: int, batch_size: int) -> int:
+        """How many queued jobs we should take given the pool's spare capacity"""
+        free = max(0, self.capacity - load)
+        if free == 0:
+            return 0
+        loads = self._live_loads()
+        loads[self.worker_id] = {"load": load, "capacity": self.capacity}
+        total_free = sum(max(0, s["capacity"] - s["load"]) for s in loads.values())
+        return min(free, batch_size, math.ceil(batch_size * free / total_free))
+
+    def claim_delay(self, load: int) -> float:
+        """Delay before claiming, so less loaded workers get to the queue first"""
+        loads = self._live_loads()
+        utilisation = load / self.capacity
+        rank = sum(
+            1 for worker_id, s in loads.items()
+            if worker_id != self.worker_id and s["load"] / max(1, s["capacity"]) < utilisation
+        )
+        return rank * CLAIM_DEFER_STEP
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional
+
+from redis import Redis
+from sqlalchemy import and_, bindparam, case, exists, or_, select, update
+
+from src.database.models import Classroom, StreamMetadata
+
+logger = logging.getLogger(__name__)
+
+# Lifecycle configuration
+LIFECYCLE_FLUSH_INTERVAL = float(os.getenv("LIFECYCLE_FLUSH_INTERVAL", 1))  # Seconds between database writes
+HLS_BASE_URL = os.getenv("HLS_BASE_URL", "")  # Prefix of stored hls_url values, e.g. https://cdn.example.com
+
+LIVE_STREAMS_KEY = "live_streams"  # Stream id -> JSON of the stream as it runs now
+
+# Remove a live entry only if the given worker, or anyone for an empty one,
+# still owns it; another worker may have adopted the stream in the meantime
+REMOVE_LIVE_SCRIPT = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if raw and (ARGV[2] == '' or cjson.decode(raw)['worker'] == ARGV[2]) then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+_streams = StreamMetadata.__table__
+_classrooms = Classroom.__table__
+
+# Core statements, so that a batch runs as one executemany each. A row only
+# takes a transition newer than the one it has, so replayed or reordered
+# batches, e.g. from a worker that died and a worker that adopted its
+# streams, leave the latest state in place.
+UPDATE_STREAMS = (
+    update(_streams)
+    .where(
+        _streams.c.id == bindparam("row_id"),
+        or_(_streams.c.status_updated_at.is_(None), _streams.c.status_updated_at <= bindparam("at"))
+    )
+    .values(
+        # The first start of the stream, however often it was restarted or adopted
+        stream_start=case(
+            (_streams.c.stream_start.is_(None), bindparam("stream_start")), else_=_streams.c.stream_start
+        ),
+        stream_end=bindparam("stream_end"),
+        stream_status=bindparam("status"),
+        hls_url=case((bindparam("hls_url").is_(None), _streams.c.hls_url), else_=bindparam("hls_url")),
+        status_updated_at=bindparam("at")
+    )
+)
+# Active while any of its streams is
+UPDATE_CLASSROOMS = (
+    update(_classrooms)
+    .where(_classrooms.c.id == select(_streams.c.classroom_id).where(_streams.c.id == bindparam("row_id")).scalar_subquery())
+    .values(
+        status=case(
+            (
+                exists().where(and_(_streams.c.classroom_id == _classrooms.c.id, _streams.c.stream_status == "active")),
+                "active"
+            ),
+            else_="inactive"
+        ),
+        last_active=case(
+            (or_(_classrooms.c.last_active.is_(None), _classrooms.c.last_active < bindparam("at")), bindparam("at")),
+            else_=_classrooms.c.last_active
+        )
+    )
+)
+
+
+def hls_url(stream_id: str, playlist: str, llhls: bool = False) -> str:
+    return f"{HLS_BASE_URL}/{'llhls' if llhls else 'hls'}/{stream_id}/{playlist}"
+
+
+class LifecycleRecorder:
+    """Records stream starts and stops in Redis at once and in Postgres in batches.
+
+    The live_streams hash is updated as each transition happens and is what
+    the API reads for the streams that are live now. stream_metadata and
+    classrooms are written behind: transitions are merged per stream and
+    written every LIFECYCLE_FLUSH_INTERVAL, so a burst of streams starting
+    costs two statements. Batches that fail are merged back and retried.
+    """
+
+    def __init__(self, redis_client: Redis, session_factory, worker_id: str):
+        self.redis_client = redis_client
+        self.session_factory = session_factory
+        self.worker_id = worker_id
+        self.pending: Dict[str, dict] = {}  # Stream id -> merged transitions not written yet
+        self.lock = threading.Lock()
+        self.live: Dict[str, dict] = {}  # Stream id -> live entry of the streams we run
+        self._remove_live = redis_client.register_script(REMOVE_LIVE_SCRIPT)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="lifecycle", daemon=True)
+        self._thread.start()
+
+    def started(self, stream_id: str, classroom_id: Optional[int], url: str, at: Optional[datetime] = None):
+        at = at or datetime.now(timezone.utc)
+        entry = {
+            "stream_id": stream_id,
+            "classroom_id": classroom_id,
+            "worker": self.worker_id,
+            "status": "active",
+            "hls_url": url,
+            "started_at": at.isoformat(),
+        }
+        self.live[stream_id] = entry
+        self.redis_client.hset(LIVE_STREAMS_KEY, stream_id, json.dumps(entry))
+        self._queue(stream_id, {"status": "active", "stream_start": at, "stream_end": None, "hls_url": url, "at": at})
+
+    def stopped(self, stream_id: str, at: Optional[datetime] = None, owner: Optional[str] = None):
+        """Record a stop; the live entry goes only if owner, by default us, still has it.
+
+        An empty owner removes the entry whoever has it, for streams we hold
+        the lease of but failed to start.
+        """
+        at = at or datetime.now(timezone.utc)
+        self.live.pop(stream_id, None)
+        self._remove_live(keys=[LIVE_STREAMS_KEY], args=[stream_id, self.worker_id if owner is None else owner])
+        self._queue(stream_id, {"status": "stopped", "stream_start": None, "stream_end": at, "hls_url": None, "at": at})
+
+    def released(self, stream_id: str):
+        """Forget a stream another worker took over, leaving its state to that worker"""
+        self.live.pop(stream_id, None)
+        self._remove_live(keys=[LIVE_STREAMS_KEY], args=[stream_id, self.worker_id])
+
+    def rebuild(self, running: Iterable[str], adoptable: Iterable[str], worker_id: Optional[str] = None):
+        """Make a worker's live entries match the ffmpeg processes it runs.
+
+        Called with our own running streams when we start, and with none for
+        a worker that died. Entries of streams that are not running are
+        removed and recorded as stopped, except for streams in adoptable:
+        their jobs are still recorded, so they are about to be restarted and
+        whoever restarts them writes their entry anew. Our own running
+        streams get their entries back, e.g. after Redis lost them.
+        """
+        worker_id = worker_id or self.worker_id
+        running = set(running)
+        adoptable = set(adoptable)
+        now = datetime.now(timezone.utc)
+        for stream_id, raw in self.redis_client.hgetall(LIVE_STREAMS_KEY).items():
+            if json.loads(raw).get("worker") != worker_id or stream_id in running or stream_id in adoptable:
+                continue
+            logger.info(f"Stream {stream_id} of worker {worker_id} is no longer running")
+            self.stopped(stream_id, now, owner=worker_id)
+        if worker_id == self.worker_id:
+            entries = {stream_id: json.dumps(self.live[stream_id]) for stream_id in running if stream_id in self.live}
+            if entries:
+                self.redis_client.hset(LIVE_STREAMS_KEY, mapping=entries)
+
+    def _queue(self, stream_id: str, transition: dict):
+        # Only stream_metadata ids have a row to update
+        if not stream_id.isdigit():
+            return
+        with self.lock:
+            self.pending[stream_id] = self._merge(self.pending.get(stream_id), transition)
+
+    @staticmethod
+    def _merge(earlier: Optional[dict], later: dict) -> dict:
+        """One transition with the effect of both, in order"""
+        if earlier is None:
+            return later
+        return {
+            **later,
+            "stream_start": earlier["stream_start"] or later["stream_start"],
+            "hls_url": later["hls_url"] or earlier["hls_url"],
+        }
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        rows = [{"row_id": int(stream_id), **transition} for stream_id, transition in batch.items()]
+        try:
+            with self.session_factory() as db:
+                db.execute(UPDATE_STREAMS, rows)
+                db.execute(UPDATE_CLASSROOMS, [{"row_id": row["row_id"], "at": row["at"]} for row in rows])
+                db.commit()
+        except Exception:
+            with self.lock:
+                # Transitions that arrived meanwhile are newer than the failed batch
+                for stream_id, transition in batch.items():
+                    self.pending[stream_id] = self._merge(transition, self.pending[stream_id]) \
+                        if stream_id in self.pending else transition
+            raise
+
+    def run(self):
+        while True:
+            time.sleep(LIFECYCLE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error writing stream lifecycle: {str(e)}")
+
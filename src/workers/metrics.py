@@ -0,0 +1,196 @@
+import os
+import time
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+from prometheus_client import Histogram, start_http_server
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Exporter configuration
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+SEGMENT_POLL_INTERVAL = 0.5  # Seconds between playlist checks
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+SEGMENT_WRITE_LAG = Histogram(
+    "hls_segment_write_lag_seconds",
+    "How much later than its media duration a segment landed after the previous one",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+)
+TIME_TO_FIRST_SEGMENT = Histogram(
+    "stream_time_to_first_segment_seconds",
+    "Time from job dequeue until the first HLS segment is on disk",
+    buckets=(0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+)
+
+
+def read_proc_stat(pid: int) -> Optional[Tuple[float, int]]:
+    """Return (cpu seconds, rss bytes) for a process from /proc"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces, so split after its closing paren
+    fields = stat[stat.rindex(")") + 2:].split()
+    utime, stime, rss_pages = int(fields[11]), int(fields[12]), int(fields[21])
+    return (utime + stime) / CLOCK_TICKS, rss_pages * PAGE_SIZE
+
+
+def _parse_playlist(path: str):
+    """Return the (duration, uri) pairs of a media playlist"""
+    segments = []
+    duration = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[8:].split(",", 1)[0])
+            elif line and not line.startswith("#") and duration is not None:
+                segments.append((duration, line))
+                duration = None
+    return segments
+
+
+class SegmentTracker:
+    """Follows one stream's playlist to time segment arrivals"""
+
+    def __init__(self, output_path: str, dequeued_at: float, playlist_name: str = "playlist.m3u8"):
+        self.playlist = os.path.join(output_path, playlist_name)
+        self.output_path = output_path
+        self.dequeued_at = dequeued_at
+        self.playlist_mtime = 0.0
+        self.last_segment: Optional[str] = None
+        self.last_landed_at: Optional[float] = None
+        self.last_lag = 0.0
+
+    def poll(self):
+        try:
+            mtime = os.stat(self.playlist).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self.playlist_mtime:
+            return
+        self.playlist_mtime = mtime
+
+        segments = _parse_playlist(self.playlist)
+        uris = [uri for _, uri in segments]
+        start = uris.index(self.last_segment) + 1 if self.last_segment in uris else 0
+        for duration, uri in segments[start:]:
+            try:
+                landed_at = os.stat(os.path.join(self.output_path, uri)).st_mtime
+            except FileNotFoundError:
+                continue
+            if self.last_landed_at is None:
+                # Wall clock on both sides, as the dequeue time came from time.time()
+                TIME_TO_FIRST_SEGMENT.observe(max(0.0, landed_at - self.dequeued_at))
+            else:
+                self.last_lag = max(0.0, landed_at - self.last_landed_at - duration)
+                SEGMENT_WRITE_LAG.observe(self.last_lag)
+            self.last_landed_at = landed_at
+            self.last_segment = uri
+
+
+class WorkerCollector:
+    """Builds per-stream metrics from the worker's state at scrape time"""
+
+    def __init__(self, worker, exporter: "WorkerExporter"):
+        self.worker = worker
+        self.exporter = exporter
+
+    def collect(self):
+        active = GaugeMetricFamily("ffmpeg_active_processes", "Running ffmpeg processes")
+        fps = GaugeMetricFamily("ffmpeg_stream_fps", "Output frames per second", labels=["stream_id"])
+        speed = GaugeMetricFamily(
+            "ffmpeg_stream_speed_ratio", "Processing speed relative to real time", labels=["stream_id"]
+        )
+        bitrate = GaugeMetricFamily(
+            "ffmpeg_stream_bitrate_kbps", "Output bitrate in kbit/s", labels=["stream_id"]
+        )
+        dropped = CounterMetricFamily(
+            "ffmpeg_stream_dropped_frames", "Frames dropped by ffmpeg", labels=["stream_id"]
+        )
+        restarts = GaugeMetricFamily(
+            "ffmpeg_stream_restarts", "Consecutive restarts of the stream's ffmpeg", labels=["stream_id"]
+        )
+        lag = GaugeMetricFamily(
+            "hls_stream_segment_write_lag_seconds", "Write lag of the latest segment", labels=["stream_id"]
+        )
+        cpu = CounterMetricFamily(
+            "ffmpeg_process_cpu_seconds", "CPU time used by the stream's ffmpeg", labels=["stream_id"]
+        )
+        rss = GaugeMetricFamily(
+            "ffmpeg_process_resident_memory_bytes", "Resident memory of the stream's ffmpeg", labels=["stream_id"]
+        )
+
+        running = 0
+        for child in self.worker.supervisor.supervised():
+            stream_id = child.stream_id
+            restarts.add_metric([stream_id], child.restarts)
+            if child.process is None or child.process.poll() is not None:
+                continue
+            running += 1
+            fps.add_metric([stream_id], child.stats.fps)
+            speed.add_metric([stream_id], child.stats.speed)
+            bitrate.add_metric([stream_id], child.stats.bitrate_kbps)
+            dropped.add_metric([stream_id], child.stats.drop_frames)
+            usage = read_proc_stat(child.process.pid)
+            if usage:
+                cpu.add_metric([stream_id], usage[0])
+                rss.add_metric([stream_id], usage[1])
+            tracker = self.exporter.trackers.get(stream_id)
+            if tracker:
+                lag.add_metric([stream_id], tracker.last_lag)
+        active.add_metric([], running)
+
+        queue_depth = GaugeMetricFamily("stream_queue_depth", "Jobs waiting in a queue", labels=["queue"])
+        try:
+            pipe = self.worker.redis_client.pipeline(transaction=False)
+            for queue_name in self.exporter.queues:
+                pipe.llen(queue_name)
+            for queue_name, depth in zip(self.exporter.queues, pipe.execute()):
+                queue_depth.add_metric([queue_name], depth)
+        except Exception as e:
+            logger.error(f"Error reading queue depth: {str(e)}")
+
+        yield from (active, fps, speed, bitrate, dropped, restarts, lag, cpu, rss, queue_depth)
+
+
+class WorkerExporter:
+    """Serves the worker's Prometheus metrics and tracks segment timings"""
+
+    def __init__(self, worker, queues, port: int = METRICS_PORT):
+        self.worker = worker
+        self.queues = queues
+        self.port = port
+        self.trackers: Dict[str, SegmentTracker] = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        REGISTRY.register(WorkerCollector(self.worker, self))
+        start_http_server(self.port)
+        threading.Thread(target=self._poll_segments, name="segment-tracker", daemon=True).start()
+        logger.info(f"Serving worker metrics on :{self.port}/metrics")
+
+    def track(self, stream_id: str, output_path: str, dequeued_at: float, playlist_name: str = "playlist.m3u8"):
+        with self.lock:
+            self.trackers[stream_id] = SegmentTracker(output_path, dequeued_at, playlist_name)
+
+    def untrack(self, stream_id: str):
+        with self.lock:
+            self.trackers.pop(stream_id, None)
+
+    def _poll_segments(self):
+        while True:
+            with self.lock:
+                trackers = list(self.trackers.values())
+            for tracker in trackers:
+                try:
+                    tracker.poll()
+                except Exception as e:
+                    logger.debug(f"Error reading {tracker.playlist}: {str(e)}")
+            time.sleep(SEGMENT_POLL_INTERVAL)
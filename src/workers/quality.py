@@ -0,0 +1,143 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
+
+from redis import Redis
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from src.database.models import QualityMinute, QualitySample
+from src.workers.supervisor import FFmpegSupervisor, StreamStats
+
+logger = logging.getLogger(__name__)
+
+# Quality history configuration
+QUALITY_SAMPLE_INTERVAL = float(os.getenv("QUALITY_SAMPLE_INTERVAL", 5))  # Seconds between samples of a stream
+QUALITY_FLUSH_INTERVAL = float(os.getenv("QUALITY_FLUSH_INTERVAL", 30))  # Seconds between bulk inserts
+QUALITY_BUFFER_SIZE = int(os.getenv("QUALITY_BUFFER_SIZE", 100000))  # Samples kept while the database is down
+QUALITY_RAW_RETENTION_DAYS = int(os.getenv("QUALITY_RAW_RETENTION_DAYS", 7))
+QUALITY_MINUTE_RETENTION_DAYS = int(os.getenv("QUALITY_MINUTE_RETENTION_DAYS", 90))  # Hourly roll-ups are kept
+QUALITY_PARTITIONS_AHEAD = 3  # Daily partitions created ahead of time
+QUALITY_CLOCK_SKEW = timedelta(minutes=5)  # How far ahead of ours a sender's clock may be
+QUALITY_MAINTENANCE_INTERVAL = 60  # Seconds between roll-ups
+QUALITY_ROLLUP_LOOKBACK = timedelta(minutes=15)  # Recomputed each time, for samples that arrive late
+MAINTENANCE_LOCK_KEY = "quality:maintenance_lock"
+
+# Executed with a list of rows, which SQLAlchemy sends as multi-row VALUES
+# batches. Samples already stored, e.g. resent by an agent, are skipped.
+INSERT_SAMPLES = insert(QualitySample.__table__).on_conflict_do_nothing()
+
+
+def sample_window(now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """Times a sample may have: the days that still have a partition, up to a little ahead of now.
+
+    stream_quality_samples has no default partition, so a sample outside
+    would fail the whole insert.
+    """
+    now = now or datetime.now(timezone.utc)
+    oldest_day = now.date() - timedelta(days=QUALITY_RAW_RETENTION_DAYS)
+    oldest = datetime(oldest_day.year, oldest_day.month, oldest_day.day, tzinfo=timezone.utc)
+    return oldest, now + QUALITY_CLOCK_SKEW
+
+
+def maintain_history(db, now: Optional[datetime] = None):
+    """Roll up recent samples, add upcoming partitions and apply retention"""
+    now = now or datetime.now(timezone.utc)
+    db.execute(select(func.rollup_stream_quality(now - QUALITY_ROLLUP_LOOKBACK)))
+    db.execute(select(func.create_quality_partitions(QUALITY_PARTITIONS_AHEAD)))
+    dropped = db.scalar(select(func.drop_quality_partitions(QUALITY_RAW_RETENTION_DAYS)))
+    db.execute(
+        QualityMinute.__table__.delete().where(
+            QualityMinute.bucket < now - timedelta(days=QUALITY_MINUTE_RETENTION_DAYS)
+        )
+    )
+    if dropped:
+        logger.info(f"Dropped {dropped} expired quality sample partitions")
+
+
+class QualityRecorder:
+    """Samples the progress stats of every supervised ffmpeg into the quality history.
+
+    Samples are buffered and written in one bulk insert per flush interval,
+    so a worker with fifty streams costs the database one statement every
+    QUALITY_FLUSH_INTERVAL seconds. The worker holding the Redis lock also
+    runs the roll-ups and retention.
+    """
+
+    def __init__(self, supervisor: FFmpegSupervisor, redis_client: Redis, session_factory):
+        self.supervisor = supervisor
+        self.redis_client = redis_client
+        self.session_factory = session_factory
+        self.buffer: deque = deque(maxlen=QUALITY_BUFFER_SIZE)
+        self.frame_counts: Dict[str, Tuple[int, int]] = {}  # Stream id -> cumulative (dropped, duplicated)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="quality", daemon=True)
+        self._thread.start()
+
+    def sample(self, now: Optional[float] = None):
+        now = now or time.time()
+        stats = self.supervisor.stats()
+        for stream_id in list(self.frame_counts):
+            if stream_id not in stats:
+                del self.frame_counts[stream_id]
+        for stream_id, stream_stats in stats.items():
+            # Only stream_metadata ids have a history; skip children not reporting
+            if not stream_id.isdigit() or now - stream_stats.updated_at > 2 * QUALITY_SAMPLE_INTERVAL:
+                continue
+            self.buffer.append(self._row(stream_id, stream_stats, now))
+
+    def _row(self, stream_id: str, stats: StreamStats, now: float) -> dict:
+        # ffmpeg counts frames since it started; store what changed since the last sample
+        previous = self.frame_counts.get(stream_id, (0, 0))
+        if stats.drop_frames < previous[0] or stats.dup_frames < previous[1]:
+            previous = (0, 0)  # ffmpeg was restarted
+        self.frame_counts[stream_id] = (stats.drop_frames, stats.dup_frames)
+        return {
+            "stream_id": int(stream_id),
+            "sampled_at": datetime.fromtimestamp(now, timezone.utc),
+            "source": "worker",
+            "bitrate_kbps": stats.bitrate_kbps,
+            "fps": stats.fps,
+            "speed": stats.speed,
+            "dropped_frames": stats.drop_frames - previous[0],
+            "duplicated_frames": stats.dup_frames - previous[1],
+        }
+
+    def flush(self):
+        rows = list(self.buffer)
+        if not rows:
+            return
+        with self.session_factory() as db:
+            db.execute(INSERT_SAMPLES, rows)
+            db.commit()
+        self.buffer.clear()
+
+    def maintain(self):
+        # Expires before the next run so another worker can take over
+        if not self.redis_client.set(MAINTENANCE_LOCK_KEY, 1, nx=True, px=int(QUALITY_MAINTENANCE_INTERVAL * 900)):
+            return
+        with self.session_factory() as db:
+            maintain_history(db)
+            db.commit()
+
+    def run(self):
+        next_flush = time.monotonic() + QUALITY_FLUSH_INTERVAL
+        next_maintenance = time.monotonic()
+        while True:
+            time.sleep(QUALITY_SAMPLE_INTERVAL)
+            try:
+                self.sample()
+                if time.monotonic() >= next_flush:
+                    next_flush = time.monotonic() + QUALITY_FLUSH_INTERVAL
+                    self.flush()
+                if time.monotonic() >= next_maintenance:
+                    next_maintenance = time.monotonic() + QUALITY_MAINTENANCE_INTERVAL
+                    self.maintain()
+            except Exception as e:
+                logger.error(f"Error recording stream quality: {str(e)}")
@@ -0,0 +1,477 @@
+import os
+import time
+import fcntl
+import shutil
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from prometheus_client import Counter
+
+from src.workers.hls import DVR_WINDOW_SIZE, HLS_SEGMENT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Archive configuration
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "/var/www/streaming/recordings")  # Empty disables archiving
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", 10))  # Seconds of segments gathered per write
+BACKFILL_DIR = os.getenv("BACKFILL_DIR", "/var/www/streaming/backfill")  # Agent segments waiting to be stitched
+SEGMENT_BACKFILL_QUEUE = "segment_backfill"
+BACKFILL_PLAYLIST = "backfill.m3u8"  # Used where backfilled TS segments cannot join the recording
+BACKFILL_MAX_WAIT = 3600  # Seconds a segment waits for its recording to finish before it is kept apart
+STREAM_KBPS_ESTIMATE = int(os.getenv("HLS_STORE_STREAM_KBPS", 3000))  # Output bitrate budgeted per stream
+
+# Segments a live directory holds besides the playlist window: the one being
+# written and the one delete_segments keeps around for slow clients
+EXTRA_SEGMENTS = 2
+
+ARCHIVED_SEGMENTS = Counter("hls_archived_segments", "Segments copied into lecture recordings")
+MISSED_SEGMENTS = Counter(
+    "hls_archive_missed_segments", "Segments deleted from the live store before they were archived"
+)
+ARCHIVED_BYTES = Counter("hls_archived_bytes", "Bytes appended to lecture recordings")
+BACKFILLED_SEGMENTS = Counter(
+    "hls_backfilled_segments", "Segments an agent buffered during an outage and stitched into a recording"
+)
+
+
+def required_store_bytes(streams: int, stream_kbps: int = STREAM_KBPS_ESTIMATE) -> int:
+    """RAM the live segment store needs for the DVR window of every stream"""
+    seconds = DVR_WINDOW_SIZE + EXTRA_SEGMENTS * HLS_SEGMENT_SECONDS
+    return int(streams * seconds * stream_kbps * 1000 / 8)
+
+
+def _filesystem_type(path: str) -> Optional[str]:
+    """Type of the filesystem mounted closest above path, from /proc/mounts"""
+    path = os.path.realpath(path)
+    best, best_type = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                mount_point, fs_type = fields[1], fields[2]
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) \
+                        and len(mount_point) > len(best):
+                    best, best_type = mount_point, fs_type
+    except OSError:
+        return None
+    return best_type
+
+
+def check_store(path: str, streams: int):
+    """Warn when the live segment store is on disk or too small for its streams"""
+    os.makedirs(path, exist_ok=True)
+    fs_type = _filesystem_type(path)
+    if fs_type not in ("tmpfs", "ramfs"):
+        logger.warning(f"Live segments in {path} are on {fs_type or 'an unknown filesystem'}, not tmpfs")
+    needed = required_store_bytes(streams)
+    size = shutil.disk_usage(path).total
+    if size < needed:
+        logger.warning(
+            f"Segment store {path} holds {size // 2**20} MiB, "
+            f"{streams} streams need about {needed // 2**20} MiB"
+        )
+
+
+def store_backfill_segment(stream_id: int, started_at: float, duration: float, data: bytes) -> Optional[str]:
+    """Save an uploaded segment for the workers; returns None if it was already received"""
+    directory = os.path.join(BACKFILL_DIR, str(stream_id))
+    # Named by capture time in ms, so names sort in playback order
+    path = os.path.join(directory, f"{int(started_at * 1000):015d}-{int(duration * 1000)}.ts")
+    if os.path.exists(path):
+        return None
+    os.makedirs(directory, exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return path
+
+
+def parse_media_playlist(path: str) -> Tuple[int, Optional[str], List[Tuple[float, str, Optional[str]]]]:
+    """Return (media sequence, init segment uri, [(duration, uri, program date time)])"""
+    sequence = 0
+    init_uri = None
+    segments = []
+    duration = None
+    program_date_time = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+                sequence = int(line.split(":", 1)[1])
+            elif line.startswith("#EXT-X-MAP:"):
+                init_uri = line.split('URI="', 1)[1].split('"', 1)[0]
+            elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+                program_date_time = line.split(":", 1)[1]
+            elif line.startswith("#EXTINF:"):
+                duration = float(line[8:].split(",", 1)[0])
+            elif line and not line.startswith("#") and duration is not None:
+                segments.append((duration, line, program_date_time))
+                duration = None
+                program_date_time = None
+    return sequence, init_uri, segments
+
+
+class Recording:
+    """One rendition of a lecture, appended to a single file with a byte-range playlist"""
+
+    # Written by write_playlist; everything else in a playlist is an entry
+    HEADER_TAGS = (
+        "#EXTM3U", "#EXT-X-VERSION", "#EXT-X-TARGETDURATION",
+        "#EXT-X-MEDIA-SEQUENCE", "#EXT-X-PLAYLIST-TYPE", "#EXT-X-ENDLIST"
+    )
+
+    def __init__(self, live_playlist: str, archive_playlist: str):
+        self.live_playlist = live_playlist
+        self.live_dir = os.path.dirname(live_playlist)
+        self.archive_playlist = archive_playlist
+        self.archive_dir = os.path.dirname(archive_playlist)
+        self.data_name: Optional[str] = None
+        self.size = 0
+        self.next_sequence = 0  # Media sequence of the next segment to archive
+        self.entries: List[str] = []
+        self.target_duration = HLS_SEGMENT_SECONDS
+        self.end_time: Optional[float] = None  # Wall clock end of a resumed recording, if it is dated
+        self.last_uri: Optional[str] = None  # File holding the last segment of a resumed recording
+        self.restarted_at: Optional[float] = None  # When ffmpeg was relaunched, until its playlist shows up
+        self.live_files: Set[str] = set()  # Files the live playlist listed when last read
+
+    @classmethod
+    def resume(cls, archive_playlist: str, data_name: str) -> "Recording":
+        """Reopen a finished recording to append segments to it from data_name"""
+        recording = cls(archive_playlist, archive_playlist)
+        recording.data_name = data_name
+        data_path = os.path.join(recording.archive_dir, data_name)
+        recording.size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+        if os.path.exists(archive_playlist):
+            with open(archive_playlist) as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith("#EXT-X-TARGETDURATION:"):
+                        recording.target_duration = int(line.split(":", 1)[1])
+                        continue
+                    if line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+                        recording.end_time = datetime.fromisoformat(line.split(":", 1)[1]).timestamp()
+                    elif line.startswith("#EXTINF:") and recording.end_time is not None:
+                        recording.end_time += float(line[8:].split(",", 1)[0])
+                    elif line and not line.startswith("#"):
+                        recording.last_uri = line
+                    if line and not line.startswith(cls.HEADER_TAGS):
+                        recording.entries.append(line)
+        return recording
+
+    def append_segment(self, path: str, duration: float, program_date_time: str, discontinuity: bool):
+        """Append one segment file that did not come through the live playlist"""
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = self.size
+        self._append(data)
+        if discontinuity:
+            self.entries += ["#EXT-X-DISCONTINUITY", f"#EXT-X-PROGRAM-DATE-TIME:{program_date_time}"]
+        self.entries += [f"#EXTINF:{duration:.3f},", f"#EXT-X-BYTERANGE:{len(data)}@{offset}", self.data_name]
+        self.target_duration = max(self.target_duration, int(duration + 0.5))
+
+    def pending(self) -> List[Tuple[float, str, Optional[str]]]:
+        """Segments that are complete in the live playlist but not archived yet"""
+        restarted_at = self.restarted_at
+        modified = self._playlist_mtime()
+        try:
+            sequence, init_uri, segments = parse_media_playlist(self.live_playlist)
+        except FileNotFoundError:
+            return []
+        if not segments:
+            return []
+        # Segments are numbered from the start time, so a restarted ffmpeg
+        # only jumps ahead, just as if segments were lost; the supervisor's
+        # word tells the two apart. A playlist written since the relaunch is
+        # the new run's; an older one may still hold segments of the last.
+        restarted = False
+        if restarted_at is not None:
+            if self._playlist_mtime() != modified:
+                return []  # Rewritten while we read it; which run it was is unknown
+            if modified >= restarted_at:
+                self.restarted_at = None
+                restarted = bool(self.entries)
+                self._remove_previous_run(init_uri, segments)
+        # Numbering that went backwards, e.g. after a clock change
+        restarted = restarted or sequence + len(segments) < self.next_sequence
+        if restarted:
+            self.next_sequence = sequence
+            self.entries.append("#EXT-X-DISCONTINUITY")
+        if self.data_name is None:
+            # Named after the playlist, as renditions may share a directory
+            name = os.path.splitext(os.path.basename(self.archive_playlist))[0]
+            self.data_name = name + os.path.splitext(segments[0][1])[1]
+        if init_uri and (restarted or not self.entries):
+            self._append_init(init_uri)
+
+        skip = max(0, self.next_sequence - sequence)
+        if sequence > self.next_sequence and self.next_sequence:
+            MISSED_SEGMENTS.inc(sequence - self.next_sequence)
+            logger.warning(f"{self.live_playlist} lost {sequence - self.next_sequence} segments before archiving")
+        self.next_sequence = max(self.next_sequence, sequence + len(segments))
+        self.live_files = {uri for _, uri, _ in segments} | ({init_uri} if init_uri else set())
+        return segments[skip:]
+
+    def _remove_previous_run(self, init_uri: Optional[str], segments: List[Tuple[float, str, Optional[str]]]):
+        # A new run names its files anew and only ever deletes its own
+        current = {uri for _, uri, _ in segments} | {init_uri}
+        for name in self.live_files - current:
+            try:
+                os.remove(os.path.join(self.live_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def _playlist_mtime(self) -> float:
+        try:
+            return os.path.getmtime(self.live_playlist)
+        except FileNotFoundError:
+            return 0.0
+
+    def _append_init(self, init_uri: str):
+        with open(os.path.join(self.live_dir, init_uri), "rb") as f:
+            init = f.read()
+        offset = self.size
+        self._append(init)
+        self.entries.append(f'#EXT-X-MAP:URI="{self.data_name}",BYTERANGE="{len(init)}@{offset}"')
+
+    def _append(self, data: bytes):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with open(os.path.join(self.archive_dir, self.data_name), "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.size += len(data)
+        ARCHIVED_BYTES.inc(len(data))
+
+    def archive(self):
+        """Append every finished segment in one write and rewrite the playlist"""
+        segments = self.pending()  # May append an init segment first
+        chunks = []
+        entries = []
+        offset = self.size
+        for duration, uri, program_date_time in segments:
+            try:
+                with open(os.path.join(self.live_dir, uri), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                MISSED_SEGMENTS.inc()
+                continue
+            if program_date_time:
+                entries.append(f"#EXT-X-PROGRAM-DATE-TIME:{program_date_time}")
+            entries += [f"#EXTINF:{duration:.3f},", f"#EXT-X-BYTERANGE:{len(data)}@{offset}", self.data_name]
+            self.target_duration = max(self.target_duration, int(duration + 0.5))
+            chunks.append(data)
+            offset += len(data)
+
+        if not chunks:
+            return
+        self._append(b"".join(chunks))
+        self.entries += entries
+        ARCHIVED_SEGMENTS.inc(len(chunks))
+        self.write_playlist(ended=False)
+
+    def write_playlist(self, ended: bool):
+        if self.data_name is None:
+            return
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:7",
+            f"#EXT-X-TARGETDURATION:{self.target_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            f"#EXT-X-PLAYLIST-TYPE:{'VOD' if ended else 'EVENT'}",
+            *self.entries,
+        ]
+        if ended:
+            lines.append("#EXT-X-ENDLIST")
+        temp_path = self.archive_playlist + ".tmp"
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with open(temp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.archive_playlist)
+
+
+class Lecture:
+    """Every rendition of one stream's recording"""
+
+    def __init__(self, output_path: str, archive_path: str, playlists: List[str]):
+        self.output_path = output_path
+        self.archive_path = archive_path
+        self.recordings = [
+            Recording(os.path.join(output_path, name), os.path.join(archive_path, name)) for name in playlists
+        ]
+        self.closing = False
+
+    def archive(self):
+        for recording in self.recordings:
+            recording.archive()
+        master = os.path.join(self.output_path, "master.m3u8")
+        # Renditions keep their relative paths, so the live master playlist works for replay
+        if len(self.recordings) > 1 and os.path.exists(master) \
+                and not os.path.exists(os.path.join(self.archive_path, "master.m3u8")):
+            shutil.copyfile(master, os.path.join(self.archive_path, "master.m3u8"))
+
+    def restarted(self, at: float):
+        for recording in self.recordings:
+            recording.restarted_at = at
+
+    def finish(self):
+        self.archive()
+        for recording in self.recordings:
+            recording.write_playlist(ended=True)
+
+
+class SegmentArchiver:
+    """Copies finished live segments into per-lecture recordings in batches.
+
+    Live segments stay in the RAM-backed HLS_OUTPUT_DIR where ffmpeg writes
+    and delete_segments removes them; only the archiver touches the disk,
+    with one sequential append per rendition every ARCHIVE_INTERVAL.
+    """
+
+    def __init__(self, archive_dir: str = ARCHIVE_DIR, interval: float = ARCHIVE_INTERVAL):
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.lectures: Dict[str, Lecture] = {}
+        self.backfills: Set[str] = set()  # Streams with uploaded agent segments to stitch
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.archive_dir)
+
+    def start(self):
+        if not self.enabled:
+            logger.info("Lecture archiving is disabled")
+            return
+        threading.Thread(target=self._run, name="segment-archiver", daemon=True).start()
+        logger.info(f"Archiving lectures to {self.archive_dir} every {self.interval}s")
+
+    def track(self, stream_id: str, output_path: str, playlists: List[str]):
+        if not self.enabled:
+            return
+        started = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+        lecture = Lecture(output_path, os.path.join(self.archive_dir, stream_id, started), playlists)
+        with self.lock:
+            if stream_id not in self.lectures or self.lectures[stream_id].closing:
+                self.lectures[stream_id] = lecture
+
+    def restarted(self, stream_id: str):
+        """Mark where a relaunched ffmpeg continues the stream's recording"""
+        with self.lock:
+            lecture = self.lectures.get(stream_id)
+        if lecture:
+            lecture.restarted(time.time())
+
+    def untrack(self, stream_id: str):
+        # The final segments are archived by the archiver thread, not the caller
+        with self.lock:
+            lecture = self.lectures.get(stream_id)
+            if lecture:
+                lecture.closing = True
+        self.wake.set()
+
+    def backfill(self, stream_id: str):
+        """Stitch the segments an agent uploaded for a stream after an outage"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.backfills.add(stream_id)
+        self.wake.set()
+
+    def _stitch_backfills(self):
+        with self.lock:
+            stream_ids = list(self.backfills)
+        for stream_id in stream_ids:
+            try:
+                done = self._stitch_stream(stream_id)
+            except Exception as e:
+                logger.error(f"Error stitching backfill of stream {stream_id}: {str(e)}")
+                done = False
+            if done:
+                with self.lock:
+                    self.backfills.discard(stream_id)
+
+    def _stitch_stream(self, stream_id: str) -> bool:
+        """Stitch a stream's uploaded segments in capture order; False if some have to wait"""
+        directory = os.path.join(BACKFILL_DIR, stream_id)
+        if not os.path.isdir(directory):
+            return True
+        with open(os.path.join(directory, ".lock"), "w") as lock_file:
+            try:
+                # Every worker may be told about the same stream; one stitches at a time
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            for name in sorted(name for name in os.listdir(directory) if name.endswith(".ts")):
+                if not self._stitch(stream_id, os.path.join(directory, name)):
+                    return False
+        return True
+
+    def _stitch(self, stream_id: str, path: str) -> bool:
+        """Append a backfilled segment to the recording it belongs to; False while that is still live"""
+        started_ms, duration_ms = os.path.splitext(os.path.basename(path))[0].split("-")
+        started_at, duration = int(started_ms) / 1000, int(duration_ms) / 1000
+        # The recording that was running when the segment was captured
+        label = time.strftime("%Y%m%dT%H%M%S", time.gmtime(started_at))
+        stream_dir = os.path.join(self.archive_dir, stream_id)
+        os.makedirs(stream_dir, exist_ok=True)
+        earlier = sorted(name for name in os.listdir(stream_dir) if name <= label)
+        lecture_dir = os.path.join(stream_dir, earlier[-1] if earlier else label)
+
+        playlist = os.path.join(lecture_dir, "playlist.m3u8")
+        finished = False
+        if os.path.exists(playlist):
+            with open(playlist) as f:
+                finished = "#EXT-X-ENDLIST" in f.read()
+            if not finished and time.time() - os.path.getmtime(path) < BACKFILL_MAX_WAIT:
+                return False  # Still being archived; the outage belongs after its end
+        if finished:
+            # Only single MPEG-TS renditions take the segments in place
+            data_name = "playlist_backfill.ts"
+        else:
+            # LL-HLS and ABR recordings, or one left open, get a playlist of their own
+            playlist, data_name = os.path.join(lecture_dir, BACKFILL_PLAYLIST), "backfill.ts"
+
+        recording = Recording.resume(playlist, data_name)
+        # Contiguous segments of one outage play as a run; anything else starts a new timeline
+        discontinuity = recording.last_uri != data_name or recording.end_time is None \
+            or abs(started_at - recording.end_time) > 1
+        program_date_time = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(started_at)) \
+            + f".{int(started_at * 1000) % 1000:03d}Z"
+        recording.append_segment(path, duration, program_date_time, discontinuity)
+        recording.write_playlist(ended=True)
+        os.remove(path)
+        BACKFILLED_SEGMENTS.inc()
+        return True
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self._stitch_backfills()
+            with self.lock:
+                lectures = list(self.lectures.items())
+            for stream_id, lecture in lectures:
+                closing = lecture.closing
+                try:
+                    if closing:
+                        lecture.finish()
+                    else:
+                        lecture.archive()
+                except Exception as e:
+                    logger.error(f"Error archiving stream {stream_id}: {str(e)}")
+                if closing:
+                    self._retire(stream_id, lecture)
+
+    def _retire(self, stream_id: str, lecture: Lecture):
+        with self.lock:
+            if self.lectures.get(stream_id) is not lecture:
+                return  # Restarted meanwhile, the live directory is in use again
+            del self.lectures[stream_id]
+        # The recording has everything, so give the RAM back to live streams
+        shutil.rmtree(lecture.output_path, ignore_errors=True)
+        logger.info(f"Finished recording of stream {stream_id} in {lecture.archive_path}")
@@ -0,0 +1,354 @@
+import os
+import time
+import random
+import logging
+import selectors
+import subprocess
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Supervisor configuration
+RESTART_BASE_DELAY = float(os.getenv("RESTART_BASE_DELAY", 1))  # Seconds before the first restart
+RESTART_MAX_DELAY = float(os.getenv("RESTART_MAX_DELAY", 30))
+RESTART_MAX_ATTEMPTS = int(os.getenv("RESTART_MAX_ATTEMPTS", 10))
+STABLE_RUN_SECONDS = 60  # A child that ran this long gets a fresh restart budget
+STDERR_TAIL_LINES = 50  # Lines of ffmpeg stderr kept per stream for diagnostics
+POLL_INTERVAL = 0.5
+READ_SIZE = 65536
+
+
+@dataclass
+class StreamStats:
+    frame: int = 0
+    fps: float = 0.0
+    bitrate_kbps: float = 0.0
+    speed: float = 0.0
+    drop_frames: int = 0
+    dup_frames: int = 0
+    total_size: int = 0
+    out_time_us: int = 0
+    updated_at: float = 0.0
+
+
+def _parse_number(value: str, suffix: str = "") -> Optional[float]:
+    # ffmpeg reports N/A until it has enough data
+    value = value.strip()
+    if suffix and value.endswith(suffix):
+        value = value[:-len(suffix)]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def apply_progress(stats: StreamStats, fields: Dict[str, str]):
+    """Fold one block of `-progress` key=value output into the stream stats"""
+    for key, attr, suffix, cast in (
+        ("frame", "frame", "", int),
+        ("fps", "fps", "", float),
+        ("bitrate", "bitrate_kbps", "kbits/s", float),
+        ("speed", "speed", "x", float),
+        ("drop_frames", "drop_frames", "", int),
+        ("dup_frames", "dup_frames", "", int),
+        ("total_size", "total_size", "", int),
+        ("out_time_us", "out_time_us", "", int),
+    ):
+        if key in fields:
+            value = _parse_number(fields[key], suffix)
+            if value is not None:
+                setattr(stats, attr, cast(value))
+    stats.updated_at = time.time()
+
+
+class SupervisedProcess:
+    # A callable command is called again for every launch, e.g. to name a run's files
+    def __init__(self, stream_id: str, command: Union[List[str], Callable[[], List[str]]]):
+        self.stream_id = stream_id
+        self.command = command
+        self.process: Optional[subprocess.Popen] = None
+        self.stats = StreamStats()
+        self.stderr_tail: deque = deque(maxlen=STDERR_TAIL_LINES)
+        self.started_at = 0.0
+        self.restarts = 0
+        self.restart_at: Optional[float] = None
+        self.stopping = False
+        self.pipes: list = []  # Pipes currently registered with the selector
+        self._buffers: Dict[int, bytes] = {}
+        self._progress: Dict[str, str] = {}
+
+
+class FFmpegSupervisor:
+    """Watches every ffmpeg child from a single selector thread.
+
+    Both pipes of each child are non-blocking and drained as soon as they are
+    readable, so ffmpeg never stalls on a full pipe. stdout carries
+    `-progress pipe:1` output which is parsed into StreamStats; stderr is kept
+    as a short tail for diagnostics. Children that exit with an error are
+    restarted with exponential backoff; clean exits are reported through
+    on_exit. on_restart is told about a relaunch just before it happens,
+    with the supervisor's lock held, so it must not call back into it.
+    """
+
+    def __init__(
+        self,
+        on_exit: Optional[Callable[[str, int], None]] = None,
+        on_restart: Optional[Callable[[str], None]] = None
+    ):
+        self.on_exit = on_exit
+        self.on_restart = on_restart
+        self.children: Dict[str, SupervisedProcess] = {}
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self._retired: List[SupervisedProcess] = []
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Self-pipe so other threads can wake the selector
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    def __contains__(self, stream_id: str) -> bool:
+        return stream_id in self.children
+
+    def __len__(self) -> int:
+        return len(self.children)
+
+    def stream_ids(self) -> List[str]:
+        with self.lock:
+            return list(self.children)
+
+    def supervised(self) -> List[SupervisedProcess]:
+        with self.lock:
+            return list(self.children.values())
+
+    def stats(self) -> Dict[str, StreamStats]:
+        with self.lock:
+            return {stream_id: child.stats for stream_id, child in self.children.items()}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="supervisor", daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopped.set()
+        self._wake()
+        for stream_id in self.stream_ids():
+            self.stop(stream_id)
+
+    def spawn(self, stream_id: str, command: Union[List[str], Callable[[], List[str]]]):
+        """Start and supervise a child; raises if it cannot be launched"""
+        child = SupervisedProcess(stream_id, command)
+        with self.lock:
+            previous = self.children.get(stream_id)
+        if previous is not None:
+            # Exited but not reaped yet; its pipes would leak if it were simply replaced
+            self._retire(previous)
+            if self.on_restart:
+                try:
+                    self.on_restart(stream_id)
+                except Exception as e:
+                    logger.error(f"Error in restart handler for {stream_id}: {str(e)}")
+        self._launch(child)
+        with self.lock:
+            self.children[stream_id] = child
+        self._wake()
+
+    def is_running(self, stream_id: str) -> bool:
+        with self.lock:
+            child = self.children.get(stream_id)
+            # A child waiting for its restart still counts as supervised
+            return child is not None and (child.restart_at is not None or child.process.poll() is None)
+
+    def stop(self, stream_id: str) -> bool:
+        with self.lock:
+            child = self.children.get(stream_id)
+        return child is not None and self._retire(child)
+
+    def _retire(self, child: SupervisedProcess) -> bool:
+        """Stop supervising a child, terminating it if it still runs"""
+        with self.lock:
+            if self.children.get(child.stream_id) is not child:
+                return False  # Retired by someone else meanwhile
+            del self.children[child.stream_id]
+            child.stopping = True
+            process = child.process
+
+        if process and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+        # Pipes are released on the supervisor thread, which owns the selector
+        with self.lock:
+            self._retired.append(child)
+        self._wake()
+        return True
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"\0")
+        except BlockingIOError:
+            pass  # Already awake
+
+    def _launch(self, child: SupervisedProcess):
+        process = subprocess.Popen(
+            child.command() if callable(child.command) else child.command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        os.set_blocking(process.stdout.fileno(), False)
+        os.set_blocking(process.stderr.fileno(), False)
+        child.process = process
+        child.started_at = time.monotonic()
+        child.restart_at = None
+        child.stats = StreamStats()
+
+    def _register(self, child: SupervisedProcess):
+        for pipe, kind in ((child.process.stdout, "progress"), (child.process.stderr, "stderr")):
+            self.selector.register(pipe, selectors.EVENT_READ, (child, kind))
+            child.pipes.append(pipe)
+
+    def _release(self, child: SupervisedProcess, pipe=None):
+        for registered in list(child.pipes):
+            if pipe is not None and registered is not pipe:
+                continue
+            self.selector.unregister(registered)
+            registered.close()
+            child.pipes.remove(registered)
+            child._buffers.pop(id(registered), None)
+        if pipe is None and child.process:
+            # Pipes of children that were never registered
+            child.process.stdout.close()
+            child.process.stderr.close()
+
+    def _sync(self):
+        with self.lock:
+            retired, self._retired = self._retired, []
+            unregistered = [
+                child for child in self.children.values()
+                if child.process and not child.pipes and child.restart_at is None
+                and not child.process.stdout.closed
+            ]
+        for child in retired:
+            self._release(child)
+        for child in unregistered:
+            self._register(child)
+
+    def _read(self, pipe, child: SupervisedProcess, kind: str):
+        try:
+            data = os.read(pipe.fileno(), READ_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            self._release(child, pipe)
+            return
+
+        lines = (child._buffers.pop(id(pipe), b"") + data).split(b"\n")
+        if lines[-1]:
+            child._buffers[id(pipe)] = lines[-1]  # Keep the partial line for the next read
+        for line in lines[:-1]:
+            text = line.decode(errors="replace").strip()
+            if not text:
+                continue
+            if kind == "progress":
+                self._handle_progress(child, text)
+            else:
+                child.stderr_tail.append(text)
+
+    def _handle_progress(self, child: SupervisedProcess, line: str):
+        key, _, value = line.partition("=")
+        if key != "progress":
+            child._progress[key] = value
+            return
+        # "progress=continue|end" terminates a block
+        apply_progress(child.stats, child._progress)
+        child._progress = {}
+
+    def _reap(self):
+        now = time.monotonic()
+        exited = []
+        with self.lock:
+            for child in list(self.children.values()):
+                if child.restart_at is not None:
+                    if now >= child.restart_at:
+                        self._restart(child)
+                    continue
+
+                returncode = child.process.poll()
+                if returncode is None:
+                    continue
+                if returncode == 0 or child.restarts >= RESTART_MAX_ATTEMPTS:
+                    # Input ended normally, or the child keeps crashing
+                    del self.children[child.stream_id]
+                    self._retired.append(child)
+                    exited.append((child, returncode))
+                    continue
+
+                if now - child.started_at >= STABLE_RUN_SECONDS:
+                    child.restarts = 0
+                delay = min(RESTART_MAX_DELAY, RESTART_BASE_DELAY * 2 ** child.restarts)
+                delay += random.uniform(0, 0.1 * delay)  # 10% jitter
+                child.restart_at = now + delay
+                child.restarts += 1
+                logger.warning(
+                    f"ffmpeg for stream {child.stream_id} exited with {returncode}, "
+                    f"restarting in {delay:.1f}s: {' | '.join(list(child.stderr_tail)[-3:])}"
+                )
+
+        for child, returncode in exited:
+            logger.info(f"ffmpeg for stream {child.stream_id} finished with {returncode}")
+            if self.on_exit:
+                try:
+                    self.on_exit(child.stream_id, returncode)
+                except Exception as e:
+                    logger.error(f"Error in exit handler for {child.stream_id}: {str(e)}")
+
+    def _restart(self, child: SupervisedProcess):
+        # Called with the lock held, so stop() cannot race with the relaunch
+        self._release(child)
+        if self.on_restart:
+            try:
+                self.on_restart(child.stream_id)
+            except Exception as e:
+                logger.error(f"Error in restart handler for {child.stream_id}: {str(e)}")
+        try:
+            self._launch(child)
+            self._register(child)
+            logger.info(f"Restarted ffmpeg for stream {child.stream_id} (attempt {child.restarts})")
+        except Exception as e:
+            logger.error(f"Error restarting stream {child.stream_id}: {str(e)}")
+            child.restart_at = time.monotonic() + RESTART_MAX_DELAY
+
+    def run(self):
+        next_reap = 0.0
+        while not self._stopped.is_set():
+            try:
+                self._sync()
+                for key, _ in self.selector.select(timeout=POLL_INTERVAL):
+                    if key.data is None:
+                        try:
+                            while os.read(self._wake_r, READ_SIZE):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        continue
+                    child, kind = key.data
+                    self._read(key.fileobj, child, kind)
+
+                # Polling every child is O(n), so do it at a fixed rate rather than per event
+                if time.monotonic() >= next_reap:
+                    self._reap()
+                    next_reap = time.monotonic() + POLL_INTERVAL
+            except Exception as e:
+                logger.error(f"Error in supervisor loop: {str(e)}")
+                time.sleep(POLL_INTERVAL)
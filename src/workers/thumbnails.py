@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Dict, List, Tuple
+
+from redis import Redis
+
+from src.workers.hls import DVR_WINDOW_SIZE, THUMBNAIL_DIR, THUMBNAIL_FORMAT, THUMBNAIL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Thumbnail configuration
+THUMBNAIL_POLL_INTERVAL = 1  # Seconds between checks for new thumbnails
+THUMBNAIL_TTL = THUMBNAIL_INTERVAL * 6  # Seconds a stream's latest thumbnail is kept without a newer one
+KEYFRAME_INDEX = "keyframes.json"  # Next to the playlists
+
+
+def thumbnail_key(stream_id: str) -> str:
+    # Hash of the stream's latest thumbnail: image, captured_at and format
+    return f"thumbnail:{stream_id}"
+
+
+def list_thumbnails(directory: str) -> List[Tuple[int, str]]:
+    """(capture time, file name) of the finished thumbnails in a directory, oldest first"""
+    thumbnails = []
+    try:
+        with os.scandir(directory) as scan:
+            for entry in scan:
+                # ffmpeg writes <time>.<format>.tmp and renames it when done
+                captured_at, extension = os.path.splitext(entry.name)
+                if extension == f".{THUMBNAIL_FORMAT}" and captured_at.isdigit():
+                    thumbnails.append((int(captured_at), entry.name))
+    except FileNotFoundError:
+        pass
+    return sorted(thumbnails)
+
+
+class ThumbnailPublisher:
+    """Publishes the thumbnails ffmpeg takes of each stream's keyframes.
+
+    The latest one goes to Redis, where the API builds sprite sheets from
+    them without touching the HLS store. All of a stream's thumbnails in
+    the DVR window are listed in keyframes.json, so players can show
+    previews when seeking; older ones are deleted.
+    """
+
+    def __init__(self, redis_client: Redis, interval: float = THUMBNAIL_POLL_INTERVAL):
+        # Needs a client without decode_responses, images are binary
+        self.redis_client = redis_client
+        self.interval = interval
+        self.streams: Dict[str, str] = {}  # Stream id -> output path
+        self.latest: Dict[str, int] = {}  # Stream id -> capture time of its published thumbnail
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name="thumbnails", daemon=True).start()
+
+    def track(self, stream_id: str, output_path: str):
+        with self.lock:
+            self.streams[stream_id] = output_path
+            self.latest.pop(stream_id, None)
+
+    def untrack(self, stream_id: str):
+        # The Redis copy expires by itself; the API only shows live streams anyway
+        with self.lock:
+            self.streams.pop(stream_id, None)
+            self.latest.pop(stream_id, None)
+
+    def update(self, stream_id: str, output_path: str):
+        directory = os.path.join(output_path, THUMBNAIL_DIR)
+        thumbnails = list_thumbnails(directory)
+        if not thumbnails:
+            return
+        cutoff = time.time() - DVR_WINDOW_SIZE
+        while len(thumbnails) > 1 and thumbnails[0][0] < cutoff:
+            _, name = thumbnails.pop(0)
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+        captured_at, name = thumbnails[-1]
+        if self.latest.get(stream_id) == captured_at:
+            return
+        with open(os.path.join(directory, name), "rb") as f:
+            image = f.read()
+        pipe = self.redis_client.pipeline()
+        pipe.hset(thumbnail_key(stream_id), mapping={
+            "image": image, "captured_at": captured_at, "format": THUMBNAIL_FORMAT
+        })
+        pipe.expire(thumbnail_key(stream_id), THUMBNAIL_TTL)
+        pipe.execute()
+        self._write_index(output_path, thumbnails)
+        with self.lock:
+            if stream_id in self.streams:
+                self.latest[stream_id] = captured_at
+
+    def _write_index(self, output_path: str, thumbnails: List[Tuple[int, str]]):
+        # Times are wall clock, as the playlists' program_date_time
+        index = {
+            "interval": THUMBNAIL_INTERVAL,
+            "keyframes": [
+                {"time": captured_at, "thumbnail": f"{THUMBNAIL_DIR}/{name}"} for captured_at, name in thumbnails
+            ],
+        }
+        temp_path = os.path.join(output_path, KEYFRAME_INDEX + ".tmp")
+        with open(temp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(temp_path, os.path.join(output_path, KEYFRAME_INDEX))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                streams = list(self.streams.items())
+            for stream_id, output_path in streams:
+                try:
+                    self.update(stream_id, output_path)
+                except Exception as e:
+                    logger.error(f"Error publishing thumbnails of stream {stream_id}: {str(e)}")